@@ -6,16 +6,30 @@ It includes handlers for creating and managing categories, relationships, and fi
 """
 
 # Standard library imports
+import calendar
+import contextvars
 import csv
+import hashlib
+import heapq
+import json
+import math
 import os
+import random
+import re
+import threading
 import time
 import traceback
-from collections import Counter, defaultdict
+from array import array
+from http.cookiejar import DefaultCookiePolicy
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
 from datetime import datetime, timedelta
 from logging import Logger
 
 # Third-party imports
+import idna
 import pytz
+import requests
 
 # CrowdStrike imports
 from crowdstrike.foundry.function import (
@@ -25,6 +39,7 @@ from crowdstrike.foundry.function import (
     Response,
     cloud,
 )
+from crowdstrike.foundry.function.context import ctx_request
 from falconpy import (
     APIHarnessV2,
     CustomStorage,
@@ -36,17 +51,386 @@ from falconpy import (
 # Initialize FUNCtion
 FUNC = Function.instance()
 
+# Bulk import settings
+IMPORT_MAX_WORKERS = int(os.environ.get("IMPORT_MAX_WORKERS", "20"))
+IMPORT_MAX_WORKERS_LIMIT = 64  # highest max_workers a request may ask for
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+DEFAULT_RETRY_POLICY = {
+    "max_attempts": 5,
+    "base_delay": 0.5,  # seconds, doubled on every retry
+    "max_delay": 10.0
+}
+RETRY_POLICY_LIMITS = {  # (type, minimum, maximum) a request may set
+    "max_attempts": (int, 1, 10),
+    "base_delay": (float, 0.0, 30.0),
+    "max_delay": (float, 0.0, 120.0)
+}
+
+# Bundled category list and its parsed, process-wide index
+CATEGORIES_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'output.csv')
+_CATEGORY_INDEX = {"current": {"signature": None, "categories": {}, "summary": [], "etag": None}}
+CATEGORIES_PAGE_MAX = 1000
+_CATEGORY_INDEX_LOCK = threading.Lock()
+
+# Valid (punycode) DNS label; underscores are allowed as they appear in real-world host names
+_DOMAIN_LABEL = re.compile(r'[a-z0-9_](?:[a-z0-9_-]*[a-z0-9_])?')
+_DOMAIN_SEPARATORS = re.compile(r'[;,\s]+')
+
+# FQDN rule sharding: limits for the domains packed into a single firewall rule
+RULE_MAX_DOMAINS = int(os.environ.get("RULE_MAX_DOMAINS", "500"))
+RULE_MAX_FQDN_LENGTH = int(os.environ.get("RULE_MAX_FQDN_LENGTH", "16000"))  # characters of the joined fqdn
+
+# Rule group update fan-out
+RULE_UPDATE_MAX_WORKERS = int(os.environ.get("RULE_UPDATE_MAX_WORKERS", "8"))
+RULE_UPDATE_MAX_WORKERS_LIMIT = 50  # highest max_workers a request may ask for
+RULE_GROUP_LOOKUP_CHUNK = 100  # IDs per get_rule_groups call
+TRACKING_CONFLICT_RETRIES = 3
+RULE_GROUP_STATE_TTL = int(os.environ.get("RULE_GROUP_STATE_TTL", "300"))  # seconds a cached group state is trusted
+_RULE_GROUP_STATES = {}
+_RULE_GROUP_STATES_LOCK = threading.Lock()
+RULE_MERGE_THRESHOLD = int(os.environ.get("RULE_MERGE_THRESHOLD", str(RULE_MAX_DOMAINS // 4)))  # "small" rule size
+
+# Host group listing
+HOST_GROUP_PAGE_SIZE = 500  # IDs per query_host_groups call (API maximum)
+HOST_GROUP_DETAILS_CHUNK = 100  # IDs per get_host_groups call
+HOST_GROUP_FETCH_WORKERS = int(os.environ.get("HOST_GROUP_FETCH_WORKERS", "8"))
+HOST_GROUP_CACHE_TTL = int(os.environ.get("HOST_GROUP_CACHE_TTL", "60"))  # seconds
+HOST_GROUP_CACHE_GRACE = int(os.environ.get("HOST_GROUP_CACHE_GRACE", "300"))  # seconds served stale
+
+# Compiled domain matchers, rebuilt when the category data they were built from changes
+MATCHER_TTL = int(os.environ.get("DOMAIN_MATCHER_TTL", "300"))  # seconds before the collection is re-read
+CLASSIFY_MAX_DOMAINS = 10000
+_CATEGORY_DATA = {"version": 0}  # bumped by every write to the domain collection
+_DOMAIN_MATCHERS = {}
+_DOMAIN_MATCHERS_LOCK = threading.Lock()
+
+# Domain -> category search index, updated in place by writes through this app
+SEARCH_INDEX_NGRAM = 3
+DOMAIN_SEARCH_MAX_RESULTS = 1000
+_SEARCH_INDEX = {"index": None, "version": None, "loaded_at": 0.0, "pending": None}
+_SEARCH_INDEX_LOCK = threading.RLock()
+_SEARCH_INDEX_BUILD_LOCK = threading.Lock()  # one collection reload at a time
+
+# Relationship graph paging
+RELATIONSHIP_PAGE_SIZE = 200  # keys per ListObjectsByVersion call
+RELATIONSHIP_GRAPH_LIMIT = 500  # default relationships per /get-relationship response
+RELATIONSHIP_GRAPH_MAX_LIMIT = 5000
+RELATIONSHIP_SCAN_LIMIT = int(os.environ.get("RELATIONSHIP_SCAN_LIMIT", "20000"))  # keys read per request
+RELATIONSHIP_FILTERS = ("category_name", "rule_group_id", "host_group_id")
+
+# Indexed FQL search over collections
+SEARCH_DEFAULT_LIMIT = 100
+SEARCH_MAX_LIMIT = 500  # SearchObjects page size maximum
+CONTENT_HASH_QUERY_CHUNK = 50  # content hashes per incremental import search
+LIST_CATEGORIES_LIMIT = 100
+LIST_CATEGORIES_MAX_LIMIT = 500
+CATEGORY_FIELDS = ("category", "domain", "wildcard_domain", "imported_at", "content_hash")
+RELATIONSHIP_FIELDS = ("category_name", "rule_group_id", "rule_group_name", "host_group_id",
+                       "host_group_name", "policy_name", "created_at", "created_by")
+
+# Batch category reads and their short-lived record cache
+CATEGORY_READ_CACHE_TTL = int(os.environ.get("CATEGORY_READ_CACHE_TTL", "30"))  # seconds
+CATEGORY_BATCH_MAX_KEYS = 500
+_CATEGORY_RECORDS = {}  # object key -> (record, stored_at)
+_CATEGORY_RECORDS_LOCK = threading.Lock()
+
+# Shared Falcon API connection pool, and clients with their service wrappers per access token
+TOKEN_REFRESH_MARGIN = int(os.environ.get("FALCON_TOKEN_REFRESH_MARGIN", "300"))  # seconds before expiry
+FALCON_CLIENT_CACHE_SIZE = int(os.environ.get("FALCON_CLIENT_CACHE_SIZE", "16"))  # access tokens kept
+_FALCON_SESSION = {"session": None}
+_FALCON_CLIENTS = OrderedDict()  # access token -> {"harness": ..., "services": {...}}
+_FALCON_CLIENTS_LOCK = threading.Lock()
+
+# Firewall event paging for analytics
+EVENT_PAGE_SIZE = 500
+EVENT_DETAILS_CHUNK = 100  # IDs per get_events call
+EVENT_PAGES_IN_FLIGHT = int(os.environ.get("EVENT_PAGES_IN_FLIGHT", "4"))
+
+# Persistent per-day analytics rollups
+ROLLUP_COLLECTION = "domain_rollup"
+ROLLUP_WATERMARK_KEY = "watermark"
+ROLLUP_RETENTION_DAYS = 15
+ROLLUP_SETTLE_SECONDS = int(os.environ.get("ROLLUP_SETTLE_SECONDS", "120"))  # ingest delay allowance
+ROLLUP_DAY_MAX_DOMAINS = int(os.environ.get("ROLLUP_DAY_MAX_DOMAINS", "1000"))  # top domains kept per day
+ROLLUP_MAX_ADDRESSES = int(os.environ.get("ROLLUP_MAX_ADDRESSES", "50"))  # IPs and hosts listed per domain and day
+_ROLLUP_LOCK = threading.Lock()
+
+# Approximate (fixed memory) analytics mode
+SKETCH_CAPACITY = int(os.environ.get("ANALYTICS_SKETCH_CAPACITY", "500"))  # Space-Saving counters
+SKETCH_PRECISION = 10  # HyperLogLog registers = 2 ** precision
+
+# Domain analytics response cache
+ANALYTICS_CACHE_TTL = int(os.environ.get("ANALYTICS_CACHE_TTL", "60"))  # seconds
+ANALYTICS_CACHE_GRACE = int(os.environ.get("ANALYTICS_CACHE_GRACE", "300"))  # seconds served stale
+
+
+def falcon_pool_size():
+    """Return the connection pool size needed by the largest worker pool that calls the API."""
+    return max(
+        IMPORT_MAX_WORKERS,
+        IMPORT_MAX_WORKERS_LIMIT,
+        RULE_UPDATE_MAX_WORKERS_LIMIT,
+        HOST_GROUP_FETCH_WORKERS,
+        EVENT_PAGES_IN_FLIGHT * -(-EVENT_PAGE_SIZE // EVENT_DETAILS_CHUNK)
+    )
+
+
+def get_falcon_session():
+    """Return the process-wide keep-alive session shared by every Falcon client.
+
+    The session only pools connections: it keeps no cookies and carries no
+    credentials (each client sends its own Authorization header), so worker
+    threads of different invocations can share it.
+    """
+    session = _FALCON_SESSION["session"]
+    if session is None:
+        with _FALCON_CLIENTS_LOCK:
+            session = _FALCON_SESSION["session"]
+            if session is None:
+                session = requests.Session()
+                session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+                session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=falcon_pool_size()))
+                _FALCON_SESSION["session"] = session
+    return session
+
+
+def _request_access_token():
+    """Return the access token of the invocation being handled, or None outside one."""
+    request = ctx_request.get()
+    return getattr(request, "access_token", None) or None
+
+
+def _falcon_client():
+    """Return the {"harness", "services"} entry for the current invocation's access token.
+
+    In Foundry the token comes with every request, so clients are kept per
+    token (the most recent FALCON_CLIENT_CACHE_SIZE of them) and are never
+    asked to log in; a request with a new token gets a new client. Outside
+    Foundry, without a request token, one client authenticates from the
+    environment credentials and renews its token TOKEN_REFRESH_MARGIN
+    seconds before it expires. All clients share one pooled session.
+    """
+    token = _request_access_token()
+    with _FALCON_CLIENTS_LOCK:
+        client = _FALCON_CLIENTS.get(token)
+        if client is not None:
+            _FALCON_CLIENTS.move_to_end(token)
+    if client is None:
+        if token:
+            harness = APIHarnessV2(access_token=token, session=get_falcon_session())
+        else:
+            harness = APIHarnessV2(session=get_falcon_session(), renew_window=TOKEN_REFRESH_MARGIN)
+        with _FALCON_CLIENTS_LOCK:
+            client = _FALCON_CLIENTS.setdefault(token, {"harness": harness, "services": {}})
+            _FALCON_CLIENTS.move_to_end(token)
+            while len(_FALCON_CLIENTS) > FALCON_CLIENT_CACHE_SIZE:
+                _FALCON_CLIENTS.popitem(last=False)
+
+    harness = client["harness"]
+    if harness.auth_style not in ("CONTEXT", "TOKEN") and harness.token_stale:
+        with _FALCON_CLIENTS_LOCK:
+            if harness.token_stale:
+                harness.login()
+    return client
+
+
+def get_falcon_client():
+    """Return the APIHarnessV2 for the current invocation's access token."""
+    return _falcon_client()["harness"]
+
+
+def falcon_service(service_class):
+    """Return the instance of a FalconPy service class bound to the current invocation's client."""
+    client = _falcon_client()
+    service = client["services"].get(service_class)
+    if service is None:
+        service = client["services"].setdefault(service_class, service_class(client["harness"], base_url=cloud()))
+    return service
+
+class StaleWhileRevalidateCache:
+    """In-process response cache with a TTL, a stale grace period and miss coalescing.
+
+    Entries younger than ttl are served as-is. Entries within the following
+    grace seconds are served stale while a single background thread
+    recomputes them. Concurrent misses for the same key share one
+    computation instead of each going upstream. A computation that was
+    running when its key was invalidated still answers its own callers,
+    but its value is not cached and later callers do not share it.
+    """
+
+    def __init__(self, ttl, grace):
+        self.ttl = ttl
+        self.grace = grace
+        self._entries = {}
+        self._in_flight = {}
+        self._generations = Counter()  # bumped per key by invalidate(key), under "*" by invalidate()
+        self._lock = threading.Lock()
+
+    def _generation(self, key):
+        return self._generations["*"], self._generations[key]
+
+    def get(self, key, compute, force_refresh=False):
+        """Return (value, status, age_seconds) where status is hit, stale, miss or shared."""
+        with self._lock:
+            entry = self._entries.get(key)
+            age = time.monotonic() - entry[1] if entry else None
+            if entry and not force_refresh:
+                if age < self.ttl:
+                    return entry[0], "hit", age
+                if age < self.ttl + self.grace:
+                    if key not in self._in_flight:
+                        future = self._in_flight[key] = Future()
+                        # The refresh runs in the caller's context, so it uses the caller's Falcon client
+                        threading.Thread(
+                            target=contextvars.copy_context().run,
+                            args=(self._refresh, key, compute, future, self._generation(key)),
+                            daemon=True
+                        ).start()
+                    return entry[0], "stale", age
+
+            future = self._in_flight.get(key)
+            owner = future is None
+            generation = self._generation(key)
+            if owner:
+                future = self._in_flight[key] = Future()
+
+        if not owner:
+            return future.result(), "shared", 0.0
+        self._refresh(key, compute, future, generation)
+        return future.result(), "miss", 0.0
+
+    def invalidate(self, key=None):
+        """Drop one cached key, or every key, along with the computations running for them."""
+        with self._lock:
+            if key is None:
+                self._generations["*"] += 1
+                self._entries.clear()
+                self._in_flight.clear()
+            else:
+                self._generations[key] += 1
+                self._entries.pop(key, None)
+                self._in_flight.pop(key, None)
+
+    def _refresh(self, key, compute, future, generation):
+        """Compute a value, cache it unless the key was invalidated meanwhile, and release its waiters."""
+        try:
+            value = compute()
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            with self._lock:
+                if self._in_flight.get(key) is future:
+                    del self._in_flight[key]
+            future.set_exception(e)
+            return
+        with self._lock:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+            if self._generation(key) == generation:
+                self._entries[key] = (value, time.monotonic())
+        future.set_result(value)
+
+
+def normalize_domain(entry):
+    """Return the canonical form of a single domain entry, or None if it is not a qualified domain.
+
+    Lowercases, strips schemes, credentials, ports, paths and trailing dots,
+    and converts internationalized labels to punycode (UTS-46, IDNA 2008). Wildcard entries keep
+    their leading '*' ('*example.com') or '*.' ('*.example.com').
+    """
+    value = entry.strip().lower()
+    prefix = ''
+    if value.startswith('*'):
+        value = value.lstrip('*')
+        prefix = '*.' if value.startswith('.') else '*'
+        value = value.lstrip('.')
+    if '://' in value:
+        value = value.split('://', 1)[1]
+    for separator in '/?#':
+        value = value.split(separator, 1)[0]
+    value = value.rsplit('@', 1)[-1].split(':', 1)[0].rstrip('.')
+    if not value:
+        return None
+    labels = value.split('.')
+    if not value.isascii():
+        # UTS-46 non-transitional (IDNA 2008) mapping, as browsers resolve it: 'ß' stays 'ß', not 'ss'
+        try:
+            labels = [
+                label if label.isascii() else idna.encode(label, uts46=True, transitional=False).decode('ascii')
+                for label in labels
+            ]
+        except (idna.IDNAError, UnicodeError):
+            return None
+        value = '.'.join(labels)
+    if len(labels) < 2 or any(not label or len(label) > 63 or not _DOMAIN_LABEL.fullmatch(label) for label in labels):
+        return None
+    return prefix + value
+
+
+def split_domain_entries(value):
+    """Split a ';', ',' or whitespace separated string (or a list of them) into non-empty entries."""
+    if isinstance(value, str):
+        value = [value]
+    entries = []
+    for item in value or []:
+        entries.extend(part for part in _DOMAIN_SEPARATORS.split(str(item)) if part)
+    return entries
+
+
+def normalize_domain_list(entries):
+    """Normalize domain entries, dropping duplicates and entries a wildcard already covers.
+
+    A wildcard '*example.com' or '*.example.com' covers every subdomain of
+    example.com, and '*example.com' also covers '*.example.com'. The apex
+    'example.com' is kept next to '*example.com', as the pair is how the
+    category lists spell out "the domain and its subdomains".
+
+    Returns (domains, rejected): the canonical entries in first-seen order
+    and the entries that are not valid domains.
+    """
+    canonical = {}
+    rejected = []
+    for entry in split_domain_entries(entries):
+        domain = normalize_domain(entry)
+        if domain is None:
+            rejected.append(entry)
+        else:
+            canonical.setdefault(domain, None)
+
+    wildcards = {domain.lstrip('*').lstrip('.') for domain in canonical if domain.startswith('*')}
+    bare = {domain[1:] for domain in canonical if domain.startswith('*') and not domain.startswith('*.')}
+
+    domains = []
+    for domain in canonical:
+        base = domain.lstrip('*').lstrip('.')
+        labels = base.split('.')
+        if any('.'.join(labels[i:]) in wildcards for i in range(1, len(labels))):
+            continue
+        if domain.startswith('*.') and base in bare:
+            continue
+        domains.append(domain)
+    return domains, rejected
+
+
+def category_fingerprint(category, urls):
+    """Return a stable content hash for a category and its domain list.
+
+    Whitespace and empty entries are ignored so cosmetic edits to the CSV
+    do not register as a change.
+    """
+    url_list = [url.strip() for url in urls.split(';') if url.strip()]
+    content = f"{category.strip()}\n{';'.join(url_list)}"
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
 
 def transform_csv_row(row):
     """Transform a CSV row to match the Collection schema."""
     category = row[0].strip()
-    urls = row[1]
+    urls = ';'.join(normalize_domain_list(row[1])[0])
 
     record = {
         "category": category,
         "domain": urls,  # Keep all URLs in domain field
         "wildcard_domain": "",  # Add wildcard for category
-        "imported_at": int(time.time())
+        "imported_at": int(time.time()),
+        "content_hash": category_fingerprint(category, urls)
     }
 
     return record
@@ -58,11 +442,387 @@ def validate_record(record):
     if not record.get('domain'):
         raise ValueError("Missing required field: domain")
 
-def process_csv_records(csv_path, customobjects, collection_name="domain", collection_version="v2.0"):
-    """Process CSV records and create collection objects."""
+def _response_status(response):
+    """Return the HTTP status code of a FalconPy response.
+
+    Some CustomStorage operations (GetObject) return raw bytes on success,
+    so anything that is not a response dictionary is treated as a 200.
+    """
+    if isinstance(response, dict):
+        return response.get("status_code", 500)
+    return 200
+
+
+def _retry_after_seconds(response):
+    """Return the Retry-After delay advertised by a throttled response, if any."""
+    if not isinstance(response, dict):
+        return None
+    headers = response.get("headers") or {}
+    value = headers.get("Retry-After") or headers.get("retry-after")
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def call_with_retry(operation, *args, retry_policy=None, **kwargs):
+    """Call a FalconPy operation, retrying throttled and transient failures.
+
+    Responses with a status in RETRYABLE_STATUS_CODES and connection level
+    errors are retried with exponential backoff and full jitter. Returns a
+    tuple of (response, attempts). The last response is returned as-is when
+    the retries are exhausted; the last exception is re-raised.
+    """
+    policy = {**DEFAULT_RETRY_POLICY, **(retry_policy or {})}
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            response = operation(*args, **kwargs)
+        except (IOError, OSError):
+            if attempt >= policy["max_attempts"]:
+                raise
+            response = None
+        else:
+            if _response_status(response) not in RETRYABLE_STATUS_CODES or attempt >= policy["max_attempts"]:
+                return response, attempt
+
+        delay = min(policy["max_delay"], policy["base_delay"] * (2 ** (attempt - 1)))
+        delay = random.uniform(0, delay)
+        retry_after = _retry_after_seconds(response)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, policy["max_delay"]))
+        time.sleep(delay)
+
+
+def parse_retry_policy(value):
+    """Validate a request's retry overrides against RETRY_POLICY_LIMITS, raising ValueError."""
+    if value is None:
+        return {}
+    if not isinstance(value, dict):
+        raise ValueError("retry must be an object")
+    policy = {}
+    for key, (kind, minimum, maximum) in RETRY_POLICY_LIMITS.items():
+        if key not in value:
+            continue
+        try:
+            number = kind(value[key])
+        except (TypeError, ValueError):
+            raise ValueError(f"retry.{key} must be a number") from None
+        if isinstance(value[key], bool) or not minimum <= number <= maximum:
+            raise ValueError(f"retry.{key} must be between {minimum} and {maximum}")
+        policy[key] = number
+    return policy
+
+
+def _put_record(customobjects, record, collection_name, collection_version, retry_policy):
+    """Write a single record to a collection, returning (status_code, attempts, response)."""
+    response, attempts = call_with_retry(
+        customobjects.PutObject,
+        body=record,
+        collection_name=collection_name,
+        collection_version=collection_version,
+        object_key=record['category'],
+        limit=1000,
+        retry_policy=retry_policy
+    )
+    return _response_status(response), attempts, response
+
+
+def bulk_upload_records(records, customobjects, collection_name="domain", collection_version="v2.0",
+                        max_workers=None, retry_policy=None):
+    """Upload (row_number, record) pairs to a collection using a bounded worker pool.
+
+    Returns a summary with throughput figures and the per-row failures.
+    """
+    records = list(records)
+    max_workers = max(1, min(int(max_workers or IMPORT_MAX_WORKERS), len(records) or 1))
+    failures = []
     success_count = 0
+    total_attempts = 0
+    retries = 0
+    started = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(_put_record, customobjects, record, collection_name,
+                            collection_version, retry_policy): (row_number, record)
+            for row_number, record in records
+        }
+        for future in as_completed(futures):
+            row_number, record = futures[future]
+            try:
+                status_code, attempts, response = future.result()
+            except (IOError, OSError) as e:
+                failures.append({"row": row_number, "category": record['category'], "error": str(e)})
+                continue
+
+            total_attempts += attempts
+            retries += attempts - 1
+            if status_code == 200:
+                success_count += 1
+            else:
+                errors = response.get("body", {}).get("errors") if isinstance(response, dict) else None
+                failures.append({
+                    "row": row_number,
+                    "category": record['category'],
+                    "status_code": status_code,
+                    "error": str(errors or "Upload failed")
+                })
+
+    elapsed = time.monotonic() - started
+    return {
+        "success_count": success_count,
+        "failures": sorted(failures, key=lambda failure: failure["row"]),
+        "workers": max_workers,
+        "requests_sent": total_attempts,
+        "retries": retries,
+        "elapsed_seconds": round(elapsed, 3),
+        "records_per_second": round(len(records) / elapsed, 2) if elapsed > 0 else None
+    }
+
+
+def list_collection_page(customobjects, collection_name, collection_version=None, start=None, limit=1000):
+    """Return one page of object keys that follow the `start` key cursor."""
+    params = {"limit": limit}
+    if start:
+        params["start"] = start
+    if collection_version:
+        response, _ = call_with_retry(
+            customobjects.ListObjectsByVersion,
+            collection_name=collection_name,
+            collection_version=collection_version,
+            **params
+        )
+    else:
+        response, _ = call_with_retry(customobjects.ListObjects, collection_name=collection_name, **params)
+    if _response_status(response) != 200:
+        raise ValueError(f"Failed to list {collection_name} objects: {response.get('body', {}).get('errors')}")
+    return [key for key in response.get("body", {}).get("resources") or [] if key != start]
+
+
+def list_collection_keys(customobjects, collection_name, collection_version=None, page_size=1000):
+    """Return every object key in a collection, following the start-key cursor."""
+    keys = []
+    start = None
+    while True:
+        page = list_collection_page(customobjects, collection_name, collection_version, start, page_size)
+        keys.extend(page)
+        if not page or len(page) < page_size - 1:
+            return keys
+        start = page[-1]
+
+
+def get_collection_object(customobjects, collection_name, object_key, retry_policy=None):
+    """Fetch and decode a single collection object, returning None when it is missing."""
+    response, _ = call_with_retry(
+        customobjects.GetObject,
+        collection_name=collection_name,
+        object_key=object_key,
+        retry_policy=retry_policy
+    )
+    if isinstance(response, (bytes, bytearray)):
+        return json.loads(response)
+    if isinstance(response, dict) and response.get("status_code") == 200:
+        return response.get("body")
+    return None
+
+
+def get_collection_objects(customobjects, collection_name, object_keys, max_workers=None):
+    """Fetch several collection objects concurrently, returning a key to record dict."""
+    object_keys = list(object_keys)
+    if not object_keys:
+        return {}
+    max_workers = max(1, min(int(max_workers or IMPORT_MAX_WORKERS), len(object_keys)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        records = executor.map(
+            lambda key: get_collection_object(customobjects, collection_name, key),
+            object_keys
+        )
+        return {key: record for key, record in zip(object_keys, records) if record is not None}
+
+
+def _put_object(customobjects, collection_name, collection_version, object_key, body):
+    """Write one object, returning its PutObject status code."""
+    kwargs = {"collection_version": collection_version} if collection_version else {}
+    response, _ = call_with_retry(
+        customobjects.PutObject,
+        body=body,
+        collection_name=collection_name,
+        object_key=object_key,
+        **kwargs
+    )
+    return _response_status(response)
+
+
+def put_collection_objects(customobjects, collection_name, objects, collection_version=None, max_workers=None):
+    """Write {key: body} objects concurrently, returning (written_keys, failed_keys)."""
+    keys = list(objects)
+    if not keys:
+        return [], []
+    max_workers = max(1, min(int(max_workers or IMPORT_MAX_WORKERS), len(keys)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        statuses = list(executor.map(
+            lambda key: _put_object(customobjects, collection_name, collection_version, key, objects[key]),
+            keys
+        ))
+    written = [key for key, status in zip(keys, statuses) if status == 200]
+    failed = [key for key, status in zip(keys, statuses) if status != 200]
+    return written, failed
+
+
+def fql_string(value):
+    """Quote a value as an FQL string literal."""
+    return "'" + str(value).replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+def build_fql_filter(exact=None, contains=None):
+    """AND together exact ({field: value}) and wildcard substring ({field: fragment}) FQL terms."""
+    terms = [f"{field}:{fql_string(value)}" for field, value in (exact or {}).items()]
+    terms += [f"{field}:*{fql_string('*' + value + '*')}" for field, value in (contains or {}).items()]
+    return "+".join(terms)
+
+
+def search_collection(customobjects, collection_name, collection_version, fql_filter, limit=SEARCH_DEFAULT_LIMIT,
+                      offset=0, sort=None):
+    """Run one indexed SearchObjectsByVersion query, returning (object keys, total matches)."""
+    params = {"filter": fql_filter, "limit": limit, "offset": offset}
+    if sort:
+        params["sort"] = sort
+    response, _ = call_with_retry(
+        customobjects.SearchObjectsByVersion,
+        collection_name=collection_name,
+        collection_version=collection_version,
+        **params
+    )
+    if _response_status(response) != 200:
+        raise ValueError(f"Failed to search {collection_name}: {response.get('body', {}).get('errors')}")
+    body = response.get("body", {})
+    keys = [item["object_key"] for item in body.get("resources") or [] if item.get("object_key")]
+    total = ((body.get("meta") or {}).get("pagination") or {}).get("total", offset + len(keys))
+    return keys, total
+
+
+def parse_fields(value, allowed):
+    """Parse a comma separated `fields` projection, returning (fields, unknown fields).
+
+    All fields are returned when `fields` is absent and only object keys
+    when it is empty.
+    """
+    if value is None:
+        return list(allowed), []
+    fields = [field.strip() for field in str(value).split(',') if field.strip()]
+    return [field for field in fields if field in allowed], [field for field in fields if field not in allowed]
+
+
+def project_record(key, record, fields):
+    """Return the object key plus the requested fields of a record."""
+    projected = {"object_key": key}
+    projected.update((field, record.get(field)) for field in fields if field in record)
+    return projected
+
+
+def _delete_object(customobjects, collection_name, object_key, retry_policy):
+    """Delete a single collection object, returning its status code."""
+    response, _ = call_with_retry(
+        customobjects.DeleteObject,
+        collection_name=collection_name,
+        object_key=object_key,
+        retry_policy=retry_policy
+    )
+    return _response_status(response)
+
+
+def bulk_delete_objects(object_keys, customobjects, collection_name="domain", max_workers=None, retry_policy=None):
+    """Delete collection objects concurrently, returning (deleted_keys, failed_keys)."""
+    object_keys = list(object_keys)
+    if not object_keys:
+        return [], []
+    max_workers = max(1, min(int(max_workers or IMPORT_MAX_WORKERS), len(object_keys)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        statuses = list(executor.map(
+            lambda key: _delete_object(customobjects, collection_name, key, retry_policy),
+            object_keys
+        ))
+    deleted = [key for key, status in zip(object_keys, statuses) if status in (200, 204, 404)]
+    failed = [key for key, status in zip(object_keys, statuses) if status not in (200, 204, 404)]
+    return deleted, failed
+
+
+def plan_incremental_import(records, stored_keys, unchanged_keys, imported_keys=()):
+    """Split (row_number, record) pairs into the writes and deletes an incremental import needs.
+
+    `stored_keys` are the keys in the collection and `unchanged_keys` those
+    whose stored content_hash equals the source record's (see
+    find_unchanged_categories). `imported_keys` lists stored categories
+    that carry a content_hash, i.e. were created by an import; the ones
+    missing from the source are scheduled for deletion. Categories managed
+    by hand are never deleted.
+    """
+    stored_keys = set(stored_keys)
+    unchanged_keys = set(unchanged_keys)
+    to_write = []
+    unchanged = 0
+    added = 0
+    source_keys = set()
+    for row_number, record in records:
+        key = record['category']
+        source_keys.add(key)
+        if key not in stored_keys:
+            added += 1
+            to_write.append((row_number, record))
+        elif key not in unchanged_keys:
+            to_write.append((row_number, record))
+        else:
+            unchanged += 1
+
+    return {
+        "to_write": to_write,
+        "to_delete": sorted(set(imported_keys) - source_keys),
+        "added": added,
+        "changed": len(to_write) - added,
+        "unchanged": unchanged
+    }
+
+
+def find_unchanged_categories(customobjects, records, collection_name="domain", collection_version="v2.0",
+                              max_workers=None):
+    """Return the keys of source records whose stored content_hash is unchanged, without reading them.
+
+    The indexed content_hash field is searched for the source hashes in
+    chunks of CONTENT_HASH_QUERY_CHUNK, so an import of n categories costs
+    about n / CONTENT_HASH_QUERY_CHUNK search calls. A key counts as
+    unchanged only when it matched in the chunk holding its own record.
+    """
+    chunks = [records[offset:offset + CONTENT_HASH_QUERY_CHUNK]
+              for offset in range(0, len(records), CONTENT_HASH_QUERY_CHUNK)]
+
+    def search(chunk):
+        hashes = ",".join(fql_string(record['content_hash']) for _, record in chunk)
+        keys, _ = search_collection(
+            customobjects, collection_name, collection_version, f"content_hash:[{hashes}]", limit=SEARCH_MAX_LIMIT
+        )
+        return set(keys) & {record['category'] for _, record in chunk}
+
+    if not chunks:
+        return set()
+    max_workers = max(1, min(int(max_workers or IMPORT_MAX_WORKERS), len(chunks)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return set().union(*executor.map(search, chunks))
+
+
+def process_csv_records(csv_path, customobjects, logger, collection_name="domain", collection_version="v2.0",
+                        max_workers=None, retry_policy=None, incremental=False, prune=False):
+    """Process CSV records and create collection objects.
+
+    In incremental mode only categories whose content_hash changed are
+    written, and with prune enabled imported categories that disappeared
+    from the CSV are deleted.
+    """
     error_count = 0
     total_rows = 0
+    records = []
+    failures = []
 
     try:
         with open(csv_path, 'r', encoding='utf-8') as file:
@@ -79,80 +839,198 @@ def process_csv_records(csv_path, customobjects, collection_name="domain", colle
                         # Validate record
                         validate_record(record)
 
-                        # Create collection object
-                        customobjects.PutObject(
-                            body=record,
-                            collection_name=collection_name,
-                            collection_version=collection_version,
-                            object_key=record['category'],
-                            limit=1000
-                        )
-
-                        success_count += 1
+                        records.append((total_rows, record))
 
                 except ValueError as e:
                     error_count += 1
-                    print(f"Error processing row {total_rows}: {str(e)}")
+                    failures.append({"row": total_rows, "error": str(e)})
+                    logger.warning(f"Error processing row {total_rows}: {str(e)}")
                     continue
 
     except IOError as e:
         raise IOError(f"Error reading CSV file: {str(e)}") from e
 
-    return {
+    delta = None
+    if incremental:
+        stored_keys = list_collection_keys(customobjects, collection_name, collection_version)
+        unchanged_keys = find_unchanged_categories(
+            customobjects, records, collection_name, collection_version, max_workers
+        )
+        imported_keys = []
+        if prune:
+            # Only the stored categories missing from the CSV are read, to tell imported ones from manual ones
+            source_keys = {record['category'] for _, record in records}
+            candidates = get_collection_objects(
+                customobjects, collection_name, [key for key in stored_keys if key not in source_keys], max_workers
+            )
+            imported_keys = [key for key, record in candidates.items() if record.get('content_hash')]
+        delta = plan_incremental_import(records, stored_keys, unchanged_keys, imported_keys)
+        records = delta["to_write"]
+
+    # Create collection objects
+    upload = bulk_upload_records(
+        records,
+        customobjects,
+        collection_name=collection_name,
+        collection_version=collection_version,
+        max_workers=max_workers,
+        retry_policy=retry_policy
+    )
+
+    results = {
         "total_rows": total_rows,
-        "success_count": success_count,
-        "error_count": error_count
+        "success_count": upload["success_count"],
+        "error_count": error_count + len(upload["failures"]),
+        "failures": sorted(failures + upload["failures"], key=lambda failure: failure["row"]),
+        "throughput": {
+            "workers": upload["workers"],
+            "requests_sent": upload["requests_sent"],
+            "retries": upload["retries"],
+            "elapsed_seconds": upload["elapsed_seconds"],
+            "records_per_second": upload["records_per_second"]
+        }
     }
 
+    failed_rows = {failure["row"] for failure in upload["failures"]}
+    results["written"] = {
+        record['category']: record['domain'] for row_number, record in records if row_number not in failed_rows
+    }
+
+    if delta is not None:
+        deleted, delete_failures = bulk_delete_objects(
+            delta["to_delete"], customobjects, collection_name, max_workers, retry_policy
+        )
+        results["deleted"] = deleted
+        results["delta"] = {
+            "added": delta["added"],
+            "changed": delta["changed"],
+            "unchanged": delta["unchanged"],
+            "deleted": deleted,
+            "delete_failures": delete_failures
+        }
+
+    return results
+
 @FUNC.handler(method='POST', path='/import-csv')
-def import_csv_handler(request: Request) -> Response:
+def import_csv_handler(request: Request, _: [dict[str, any], None], logger: Logger) -> Response:
     """Import domain categorization CSV data into a Foundry Collection."""
 
     try:
-        # Initialize API client
-        api_client = APIHarnessV2()
-        customobjects = CustomStorage(api_client, base_url=cloud())
+        # Shared API client
+        customobjects = falcon_service(CustomStorage)
 
-        # Get the directory where main.py is located
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        csv_file = os.path.join(current_dir, 'output.csv')
+        csv_file = CATEGORIES_CSV
+
+        # Optional tuning from the request body
+        body = request.body or {}
+        max_workers = _int_param(body.get('max_workers'), IMPORT_MAX_WORKERS, 1, IMPORT_MAX_WORKERS_LIMIT)
+        incremental = body.get('mode', 'full') == 'incremental'
+        # Pruning deletes categories, so only an explicit true turns it on
+        prune = body.get('prune')
+        if prune is None:
+            prune = False
+        if not isinstance(prune, bool) and prune not in ('true', 'false'):
+            return Response(code=400, errors=[APIError(code=400, message="prune must be true or false")])
+        prune = prune is True or prune == 'true'
+        try:
+            retry_policy = parse_retry_policy(body.get('retry'))
+        except ValueError as e:
+            return Response(code=400, errors=[APIError(code=400, message=str(e))])
 
         # Process CSV records
         results = process_csv_records(
             csv_path=csv_file,
             customobjects=customobjects,
+            logger=logger,
             collection_name="domain",
-            collection_version="v2.0"
+            collection_version="v2.0",
+            max_workers=max_workers,
+            retry_policy=retry_policy,
+            incremental=incremental,
+            prune=prune
         )
+        apply_category_writes(results["written"], results.get("deleted", ()))
+
+        response_body = {
+            "success": True,
+            "mode": "incremental" if incremental else "full",
+            "total_rows": results["total_rows"],
+            "successful_imports": results["success_count"],
+            "failed_imports": results["error_count"],
+            "failures": results["failures"],
+            "throughput": results["throughput"],
+            "collection_name": "domain",
+            "source_file": csv_file,
+            "import_timestamp": int(time.time())
+        }
+        if "delta" in results:
+            response_body["delta"] = results["delta"]
 
         return Response(
-            body={
-                "success": True,
-                "total_rows": results["total_rows"],
-                "successful_imports": results["success_count"],
-                "failed_imports": results["error_count"],
-                "collection_name": "domain",
-                "source_file": csv_file,
-                "import_timestamp": int(time.time())
-            },
+            body=response_body,
             code=200
         )
 
     except Exception as e:
+        logger.error(f"CSV import failed: {str(e)}")
         return Response(
             code=500,
             errors=[APIError(code=500, message=f"CSV import failed: {str(e)}")]
         )
 
+def _get_host_group_details(hostgroup, ids):
+    """Fetch id/name pairs for a chunk of host group IDs."""
+    response, _ = call_with_retry(hostgroup.get_host_groups, ids=ids)
+    status = _response_status(response)
+    if status != 200:
+        raise ValueError(f"Failed to retrieve host group details. Status: {status}", status)
+    return [{"id": group["id"], "name": group["name"]} for group in response["body"]["resources"] or []]
+
+
+def list_host_groups(hostgroup, page_size=HOST_GROUP_PAGE_SIZE, chunk_size=HOST_GROUP_DETAILS_CHUNK,
+                     max_workers=HOST_GROUP_FETCH_WORKERS):
+    """Return id/name pairs for every host group in the tenant, in API order.
+
+    IDs are paged with query_host_groups until the reported total is
+    reached, and each page's details are fetched in chunk_size ID chunks
+    on a thread pool while the next page is being queried. Raises
+    ValueError(message, status_code) if any call fails.
+    """
+    chunks = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        offset = 0
+        while True:
+            response, _ = call_with_retry(hostgroup.query_host_groups, limit=page_size, offset=offset)
+            status = _response_status(response)
+            if status != 200:
+                raise ValueError(f"Failed to retrieve host groups. Status: {status}", status)
+            ids = response["body"].get("resources") or []
+            chunks.extend(
+                executor.submit(_get_host_group_details, hostgroup, ids[start:start + chunk_size])
+                for start in range(0, len(ids), chunk_size)
+            )
+            offset += len(ids)
+            total = response["body"].get("meta", {}).get("pagination", {}).get("total", offset)
+            if not ids or offset >= total:
+                break
+        return [group for chunk in chunks for group in chunk.result()]
+
+
+_HOST_GROUP_CACHE = StaleWhileRevalidateCache(ttl=HOST_GROUP_CACHE_TTL, grace=HOST_GROUP_CACHE_GRACE)
+
 @FUNC.handler(method='GET', path='/urlblock')
-def on_create(_: Request, config: [dict[str, any], None], logger: Logger) -> Response:
-    """Handle requests to retrieve host groups."""
+def on_create(request: Request, config: [dict[str, any], None], logger: Logger) -> Response:
+    """Handle requests to retrieve host groups.
+
+    The list is cached for HOST_GROUP_CACHE_TTL seconds. This app never
+    creates or renames host groups, so changes made in the console show up
+    after the TTL; `refresh=true` re-reads them right away.
+    """
     logger.info("Starting host groups handler")
     try:
         # Initialize Falcon client
         try:
-            falcon = APIHarnessV2(debug=True)
-            hostgroup = HostGroup(falcon, base_url=cloud())
+            hostgroup = falcon_service(HostGroup)
             logger.info("Successfully initialized Falcon client")
         except Exception as e:
             logger.error(f"Failed to initialize Falcon client: {str(e)}")
@@ -164,33 +1042,32 @@ def on_create(_: Request, config: [dict[str, any], None], logger: Logger) -> Res
                 }
             )
 
-        # Query host groups
+        # Query host groups, served from a short-lived cache
         try:
-            response = hostgroup.query_host_groups()
-            logger.info(f"Query response status: {response.get('status_code')}")
-
-            if response["status_code"] == 200:
-                groups = response["body"]["resources"]
-                groups_details = hostgroup.get_host_groups(ids=groups)
-
-                # Format host groups data
-                host_groups_list = []
-                for group in groups_details["body"]["resources"]:
-                    host_groups_list.append({
-                        "id": group["id"],
-                        "name": group["name"]
-                    })
-
-                logger.info(f"Successfully retrieved {len(host_groups_list)} host groups")
-                return Response(
-                    code=200,
-                    body={"host_groups": host_groups_list}
-                )
+            force_refresh = str(get_query_param(request, 'refresh', 'false')).lower() == 'true'
+            host_groups_list, cache_status, age = _HOST_GROUP_CACHE.get(
+                "host_groups", lambda: list_host_groups(hostgroup), force_refresh=force_refresh
+            )
 
-            error_msg = f"Failed to retrieve host groups. Status: {response['status_code']}"
+            logger.info(f"Successfully retrieved {len(host_groups_list)} host groups ({cache_status})")
+            return Response(
+                code=200,
+                body={
+                    "host_groups": host_groups_list,
+                    "cache": {
+                        "status": cache_status,
+                        "age_seconds": round(age, 1),
+                        "ttl_seconds": HOST_GROUP_CACHE_TTL
+                    }
+                }
+            )
+
+        except ValueError as e:
+            error_msg = e.args[0]
+            status_code = e.args[1] if len(e.args) > 1 else 500
             logger.error(error_msg)
             return Response(
-                code=response["status_code"],
+                code=status_code,
                 body={"error": error_msg}
             )
 
@@ -218,16 +1095,124 @@ def on_create(_: Request, config: [dict[str, any], None], logger: Logger) -> Res
             }
         )
 
+def get_header(request, name):
+    """Return the first value of a request header, matching the name case-insensitively."""
+    headers = getattr(request.params, 'header', None) or {}
+    for key, values in headers.items():
+        if key.lower() == name.lower():
+            if isinstance(values, (list, tuple)):
+                return values[0] if values else None
+            return values
+    return None
+
+def get_query_param(request, name, default=None):
+    """Return the first value of a query string parameter, or default when it is absent."""
+    query = getattr(request.params, 'query', None) or {}
+    values = query.get(name)
+    if isinstance(values, (list, tuple)):
+        return values[0] if values else default
+    return values if values is not None else default
+
+def _int_param(value, default, minimum, maximum):
+    """Convert a request parameter to an int clamped to [minimum, maximum]."""
+    try:
+        return max(minimum, min(maximum, int(value)))
+    except (TypeError, ValueError):
+        return default
+
+def parse_categories_csv(csv_file):
+    """Parse the category CSV into a {category: 'url;url;...'} dict."""
+    categories_dict = {}
+    with open(csv_file, 'r', encoding='utf-8') as f:
+        csv_reader = csv.reader(f)
+        next(csv_reader)  # Skip header row
+
+        for row in csv_reader:
+            if len(row) >= 2:  # Ensure row has at least 2 columns
+                category = row[0].strip()
+                urls = row[1].strip()
+
+                # Clean and format URLs
+                url_list = [url.strip() for url in urls.split(';') if url.strip()]
+                if url_list:  # Only add if there are valid URLs
+                    categories_dict[category] = ';'.join(url_list)
+
+    return categories_dict
+
+def load_category_index(csv_file=CATEGORIES_CSV):
+    """Return the parsed category index, re-parsing the CSV only when its mtime or size changed.
+
+    The returned dict holds the categories and a strong ETag for them and
+    must be treated as read-only, as it is shared across requests. A
+    re-parse builds a new dict and swaps it in with a single assignment, so
+    a caller never sees an ETag paired with another version's categories.
+    """
+    stat = os.stat(csv_file)
+    signature = (csv_file, stat.st_mtime_ns, stat.st_size)
+    index = _CATEGORY_INDEX["current"]
+    if index["signature"] == signature:
+        return index
+
+    with _CATEGORY_INDEX_LOCK:
+        index = _CATEGORY_INDEX["current"]
+        if index["signature"] != signature:
+            categories = parse_categories_csv(csv_file)
+            digest = hashlib.sha256(json.dumps(categories, sort_keys=True).encode('utf-8')).hexdigest()
+            index = {
+                "signature": signature,
+                "categories": categories,
+                "summary": [
+                    {"name": name, "urlCount": urls.count(';') + 1}
+                    for name, urls in sorted(categories.items())
+                ],
+                "etag": f'"{digest[:32]}"'
+            }
+            _CATEGORY_INDEX["current"] = index
+        return index
+
+def page_categories(index, request):
+    """Build the /categories body for the view, paging and single-category query parameters."""
+    name = get_query_param(request, 'category')
+    if name is not None:
+        urls = index["categories"].get(name)
+        if urls is None:
+            return None
+        return {"category": name, "urls": urls, "urlCount": urls.count(';') + 1}
+
+    summary = index["summary"]
+    limit = get_query_param(request, 'limit')
+    if limit is None and get_query_param(request, 'view') != 'summary':
+        return {'categories': index["categories"]}
+
+    limit = _int_param(limit, CATEGORIES_PAGE_MAX, 1, CATEGORIES_PAGE_MAX)
+    offset = _int_param(get_query_param(request, 'cursor'), 0, 0, len(summary))
+    page = summary[offset:offset + limit]
+    if get_query_param(request, 'view') == 'summary':
+        categories = page
+    else:
+        categories = {item["name"]: index["categories"][item["name"]] for item in page}
+    return {
+        'categories': categories,
+        'total': len(summary),
+        'pagination': {
+            'limit': limit,
+            'cursor': str(offset),
+            'nextCursor': str(offset + limit) if offset + limit < len(summary) else None
+        }
+    }
+
 @FUNC.handler(method='GET', path='/categories')
-def get_categories(_: Request, __: [dict[str, any], None], logger: Logger) -> Response:
-    """Retrieve categories from CSV file."""
+def get_categories(request: Request, __: [dict[str, any], None], logger: Logger) -> Response:
+    """Retrieve categories from CSV file.
+
+    By default every category is returned with its full URL list.
+    `view=summary` returns only names and URL counts, sorted by name.
+    `limit` and `cursor` page through the categories. `category` returns
+    a single category's URLs.
+    """
     logger.info("Starting categories handler")
     try:
-        # Get the directory where main.py is located
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        csv_file = os.path.join(current_dir, 'output.csv')
-
-        logger.info(f"Looking for CSV file at: {csv_file}")
+        csv_file = CATEGORIES_CSV
 
         # Check if file exists
         if not os.path.exists(csv_file):
@@ -241,30 +1226,26 @@ def get_categories(_: Request, __: [dict[str, any], None], logger: Logger) -> Re
             )
 
         try:
-            categories_dict = {}
-            with open(csv_file, 'r', encoding='utf-8') as f:
-                csv_reader = csv.reader(f)
-                next(csv_reader)  # Skip header row
+            index = load_category_index(csv_file)
+            etag = index["etag"]
+            cache_headers = {"ETag": [etag], "Cache-Control": ["no-cache"]}
 
-                for row in csv_reader:
-                    if len(row) >= 2:  # Ensure row has at least 2 columns
-                        category = row[0].strip()
-                        urls = row[1].strip()
+            # Let callers revalidate their copy without downloading it again
+            if_none_match = get_header(request, 'If-None-Match') or ''
+            client_tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+            if etag in client_tags or '*' in client_tags:
+                return Response(code=304, header=cache_headers)
 
-                        # Clean and format URLs
-                        url_list = [url.strip() for url in urls.split(';') if url.strip()]
-                        if url_list:  # Only add if there are valid URLs
-                            clean_urls = ';'.join(url_list)
-                            categories_dict[category] = clean_urls
+            logger.info(f"Number of categories found: {len(index['categories'])}")
 
-            logger.info(f"Number of categories found: {len(categories_dict)}")
-            logger.info(f"Categories: {list(categories_dict.keys())}")
+            body = page_categories(index, request)
+            if body is None:
+                return Response(code=404, body={"error": "Category not found"})
 
             return Response(
                 code=200,
-                body={
-                    'categories': categories_dict
-                }
+                body=body,
+                header=cache_headers
             )
 
         except IOError as csv_error:
@@ -289,6 +1270,704 @@ def get_categories(_: Request, __: [dict[str, any], None], logger: Logger) -> Re
             }
         )
 
+def mark_category_data_changed():
+    """Record that the domain collection was written, so derived indexes are rebuilt."""
+    with _DOMAIN_MATCHERS_LOCK:
+        _CATEGORY_DATA["version"] += 1
+    with _CATEGORY_RECORDS_LOCK:
+        _CATEGORY_RECORDS.clear()
+
+
+def read_category_records(customobjects, keys):
+    """Return ({key: record}, missing keys, cache hits) for domain collection keys.
+
+    Records younger than CATEGORY_READ_CACHE_TTL are served from memory and
+    the rest are fetched concurrently. Writes through this app clear the
+    cache (mark_category_data_changed).
+    """
+    now = time.monotonic()
+    records = {}
+    with _CATEGORY_RECORDS_LOCK:
+        for key in keys:
+            cached = _CATEGORY_RECORDS.get(key)
+            if cached is not None and now - cached[1] < CATEGORY_READ_CACHE_TTL:
+                records[key] = cached[0]
+    hits = len(records)
+
+    fetched = get_collection_objects(customobjects, "domain", [key for key in keys if key not in records])
+    with _CATEGORY_RECORDS_LOCK:
+        for key, record in fetched.items():
+            _CATEGORY_RECORDS[key] = (record, now)
+    records.update(fetched)
+    return records, [key for key in keys if key not in records], hits
+
+
+class _TrieNode:
+    """A node of the reversed-label trie: one DNS label plus the categories ending there."""
+
+    __slots__ = ("children", "exact", "wildcard")
+
+    def __init__(self):
+        self.children = {}
+        self.exact = None
+        self.wildcard = None
+
+
+class DomainMatcher:
+    """Classify domains against category domain lists with a reversed-label suffix trie.
+
+    Category entries are domain names such as 'example.com', which match
+    that name only, and wildcard entries such as '*example.com' or
+    '*.example.com', which match the name and all of its subdomains.
+    Labels are matched whole, so '*example.com' does not match
+    'myexample.com'. A lookup walks at most one trie node per label of the
+    queried domain, independent of the number of categories.
+    """
+
+    def __init__(self, categories):
+        """Compile a {category: 'domain;*domain;...'} mapping."""
+        self.root = _TrieNode()
+        self.category_count = 0
+        self.pattern_count = 0
+        for category, domains in categories.items():
+            self.category_count += 1
+            for pattern in domains.split(';'):
+                self._insert(category, pattern)
+
+    def _insert(self, category, pattern):
+        pattern = normalize_domain(pattern)
+        if pattern is None:
+            return
+        wildcard = pattern.startswith('*')
+        labels = pattern.lstrip('*').lstrip('.').split('.')
+        node = self.root
+        for label in reversed(labels):
+            node = node.children.setdefault(label, _TrieNode())
+        attribute = "wildcard" if wildcard else "exact"
+        matched = getattr(node, attribute)
+        if matched is None:
+            setattr(node, attribute, [category])
+            self.pattern_count += 1
+        elif category not in matched:
+            matched.append(category)
+            self.pattern_count += 1
+
+    def match(self, domain):
+        """Return [(category, pattern)] matches for a normalized domain, most specific first."""
+        labels = domain.split('.')
+        node = self.root
+        levels = []
+        depth = 0
+        for depth, label in enumerate(reversed(labels), start=1):
+            node = node.children.get(label)
+            if node is None:
+                break
+            if node.wildcard:
+                suffix = '.'.join(labels[-depth:])
+                levels.append([(category, f"*{suffix}") for category in node.wildcard])
+        else:
+            if depth and node.exact:
+                levels.append([(category, '.'.join(labels)) for category in node.exact])
+        return [match for level in reversed(levels) for match in level]
+
+    def classify(self, domain):
+        """Return the classification of a single domain, URL or host name."""
+        normalized = normalize_domain(domain)
+        matches = self.match(normalized) if normalized and not normalized.startswith('*') else []
+        categories = list(dict.fromkeys(category for category, _ in matches))
+        return {
+            "domain": domain,
+            "normalized": normalized,
+            "matched": bool(matches),
+            "categories": categories,
+            "matches": [{"category": category, "pattern": pattern} for category, pattern in matches]
+        }
+
+
+def load_collection_categories(customobjects):
+    """Read every category of the domain collection into a {category: 'domain;...'} mapping."""
+    keys = list_collection_keys(customobjects, "domain", "v2.0")
+    records = get_collection_objects(customobjects, "domain", keys)
+    return {
+        record.get("category") or key: record.get("domain", "")
+        for key, record in records.items()
+    }
+
+
+def get_domain_matcher(source="collection"):
+    """Return the compiled DomainMatcher for a category source, rebuilding it only on change.
+
+    The CSV source is re-compiled when the file's ETag changes. The
+    collection source is re-read after a write through this function app
+    (mark_category_data_changed) or after MATCHER_TTL seconds, to pick up
+    changes made elsewhere; it is re-compiled only if the content differs.
+    """
+    now = time.monotonic()
+    cached = _DOMAIN_MATCHERS.get(source)
+    if source == "csv":
+        index = load_category_index()
+        if cached and cached["signature"] == index["etag"]:
+            return cached
+        categories, signature = index["categories"], index["etag"]
+    else:
+        version = _CATEGORY_DATA["version"]
+        if cached and cached["version"] == version and now - cached["loaded_at"] < MATCHER_TTL:
+            return cached
+        categories = load_collection_categories(falcon_service(CustomStorage))
+        signature = hashlib.sha256(json.dumps(categories, sort_keys=True).encode('utf-8')).hexdigest()
+        if cached and cached["signature"] == signature:
+            cached.update({"version": version, "loaded_at": now})
+            return cached
+
+    entry = {
+        "matcher": DomainMatcher(categories),
+        "signature": signature,
+        "version": _CATEGORY_DATA["version"],
+        "loaded_at": now,
+        "built_at": datetime.now(pytz.UTC).isoformat()
+    }
+    with _DOMAIN_MATCHERS_LOCK:
+        _DOMAIN_MATCHERS[source] = entry
+    return entry
+
+class CategorySearchIndex:
+    """Inverted index from listed domains to the categories that list them.
+
+    Entries are keyed by their domain with any wildcard prefix removed, so
+    'example.com' and '*example.com' are one entry. An exact lookup is one
+    dict access. Substring, prefix and suffix queries intersect the posting
+    sets of the fragment's character n-grams and verify the few candidates
+    left. Categories can be replaced or removed one at a time, so writes
+    update the index without rebuilding it.
+    """
+
+    def __init__(self, categories=None, ngram=SEARCH_INDEX_NGRAM):
+        self.ngram = ngram
+        self.domains = {}  # domain -> {category}
+        self.by_category = {}  # category -> {domain}
+        self.grams = {}  # n-gram -> {domain}
+        for category, domains in (categories or {}).items():
+            self.update(category, domains)
+
+    def _grams(self, domain):
+        padded = f"^{domain}$"
+        return {padded[i:i + self.ngram] for i in range(len(padded) - self.ngram + 1)}
+
+    def _add(self, category, domain):
+        categories = self.domains.get(domain)
+        if categories is None:
+            categories = self.domains[domain] = set()
+            for gram in self._grams(domain):
+                self.grams.setdefault(gram, set()).add(domain)
+        categories.add(category)
+
+    def _discard(self, category, domain):
+        categories = self.domains.get(domain)
+        if categories is None:
+            return
+        categories.discard(category)
+        if not categories:
+            del self.domains[domain]
+            for gram in self._grams(domain):
+                postings = self.grams.get(gram)
+                if postings is not None:
+                    postings.discard(domain)
+                    if not postings:
+                        del self.grams[gram]
+
+    def update(self, category, domains):
+        """Replace the domains of one category ('domain;*domain;...' or a list)."""
+        new = set()
+        for entry in split_domain_entries(domains):
+            domain = normalize_domain(entry)
+            if domain is not None:
+                new.add(domain.lstrip('*').lstrip('.'))
+        old = self.by_category.get(category, set())
+        for domain in old - new:
+            self._discard(category, domain)
+        for domain in new - old:
+            self._add(category, domain)
+        if new:
+            self.by_category[category] = new
+        else:
+            self.by_category.pop(category, None)
+
+    def remove(self, category):
+        """Drop a category and every domain only it listed."""
+        self.update(category, [])
+
+    def _candidates(self, fragment, anchor_start=False, anchor_end=False):
+        """Return the domains whose n-grams include every n-gram of the (anchored) fragment."""
+        padded = ("^" if anchor_start else "") + fragment + ("$" if anchor_end else "")
+        if len(padded) < self.ngram:
+            return self.domains.keys()
+        grams = sorted(
+            (self.grams.get(padded[i:i + self.ngram], set()) for i in range(len(padded) - self.ngram + 1)),
+            key=len
+        )
+        return set.intersection(*grams) if grams[0] else set()
+
+    def search(self, query, mode="exact", limit=100):
+        """Return ([(domain, sorted categories)], truncated) for an exact, contains, prefix or suffix query."""
+        query = query.strip().lower()
+        if mode == "exact":
+            domain = normalize_domain(query)
+            domain = domain.lstrip('*').lstrip('.') if domain else query
+            categories = self.domains.get(domain)
+            return ([(domain, sorted(categories))] if categories else []), False
+        if mode == "prefix":
+            candidates = self._candidates(query, anchor_start=True)
+            matched = (domain for domain in candidates if domain.startswith(query))
+        elif mode == "suffix":
+            candidates = self._candidates(query, anchor_end=True)
+            matched = (domain for domain in candidates if domain.endswith(query))
+        else:
+            candidates = self._candidates(query)
+            matched = (domain for domain in candidates if query in domain)
+        found = heapq.nsmallest(limit + 1, matched, key=domain_sort_key)
+        return [(domain, sorted(self.domains[domain])) for domain in found[:limit]], len(found) > limit
+
+    def stats(self):
+        """Return the category, domain and n-gram counts of the index."""
+        return {"categories": len(self.by_category), "domains": len(self.domains), "ngrams": len(self.grams)}
+
+
+def _search_index_current(now):
+    """Return True if the loaded search index can be served as it is (call with _SEARCH_INDEX_LOCK held)."""
+    return (_SEARCH_INDEX["index"] is not None and _SEARCH_INDEX["version"] == _CATEGORY_DATA["version"]
+            and now - _SEARCH_INDEX["loaded_at"] < MATCHER_TTL)
+
+
+def get_search_index():
+    """Return a snapshot of the domain collection's CategorySearchIndex entry, loading it on first use.
+
+    Writes through this app update the loaded index in place
+    (apply_category_writes). It is reloaded after MATCHER_TTL seconds to
+    pick up changes made elsewhere, or when a write was recorded without
+    being applied to it. The collection is read and the new index built
+    without holding _SEARCH_INDEX_LOCK, so searches and writes carry on
+    meanwhile: searches keep using the loaded index, and writes are
+    applied to it and replayed onto the new one before it is swapped in.
+    Only the first load, with no index to serve yet, waits for a reload
+    in progress.
+    """
+    with _SEARCH_INDEX_LOCK:
+        if _search_index_current(time.monotonic()):
+            return dict(_SEARCH_INDEX)
+        loaded = _SEARCH_INDEX["index"] is not None
+
+    if not _SEARCH_INDEX_BUILD_LOCK.acquire(blocking=not loaded):
+        with _SEARCH_INDEX_LOCK:
+            return dict(_SEARCH_INDEX)
+    try:
+        with _SEARCH_INDEX_LOCK:
+            if _search_index_current(time.monotonic()):
+                return dict(_SEARCH_INDEX)
+            version = _CATEGORY_DATA["version"]
+            _SEARCH_INDEX["pending"] = []
+
+        loaded_at = time.monotonic()
+        try:
+            index = CategorySearchIndex(load_collection_categories(falcon_service(CustomStorage)))
+        except Exception:
+            with _SEARCH_INDEX_LOCK:
+                _SEARCH_INDEX["pending"] = None
+            raise
+
+        with _SEARCH_INDEX_LOCK:
+            for updated, removed, write_version in _SEARCH_INDEX["pending"] or []:
+                _apply_to_index(index, updated, removed)
+                version = max(version, write_version)
+            _SEARCH_INDEX.update({
+                "index": index,
+                "version": version,
+                "loaded_at": loaded_at,
+                "built_at": datetime.now(pytz.UTC).isoformat(),
+                "pending": None
+            })
+            return dict(_SEARCH_INDEX)
+    finally:
+        _SEARCH_INDEX_BUILD_LOCK.release()
+
+
+def _apply_to_index(index, updated, removed):
+    """Apply category writes to a CategorySearchIndex."""
+    for category, domains in (updated or {}).items():
+        index.update(category, domains)
+    for category in removed:
+        index.remove(category)
+
+
+def apply_category_writes(updated=None, removed=()):
+    """Record domain collection writes and apply them to a loaded search index.
+
+    `updated` maps category names to their new domain lists and `removed`
+    lists deleted category names. Writes made while the index is being
+    reloaded are also queued for the new index.
+    """
+    mark_category_data_changed()
+    with _SEARCH_INDEX_LOCK:
+        if _SEARCH_INDEX["pending"] is not None:
+            _SEARCH_INDEX["pending"].append((dict(updated or {}), list(removed), _CATEGORY_DATA["version"]))
+        index = _SEARCH_INDEX["index"]
+        if index is None:
+            return
+        _apply_to_index(index, updated, removed)
+        _SEARCH_INDEX["version"] = _CATEGORY_DATA["version"]
+
+
+@FUNC.handler(method='GET', path='/search-domains')
+def search_domains(request: Request, __: [dict[str, any], None], logger: Logger) -> Response:
+    """Find the categories listing a domain, or the listed domains matching a fragment.
+
+    `q` is the domain or fragment and `mode` is 'exact' (default),
+    'contains', 'prefix' or 'suffix'. Matches are returned in domain
+    order, at most `limit` of them.
+    """
+    try:
+        query = str(get_query_param(request, 'q', '') or '').strip()
+        if not query:
+            return Response(code=400, body={"error": "q is required"})
+        mode = get_query_param(request, 'mode', 'exact')
+        if mode not in ('exact', 'contains', 'prefix', 'suffix'):
+            return Response(code=400, body={"error": "mode must be 'exact', 'contains', 'prefix' or 'suffix'"})
+        limit = _int_param(get_query_param(request, 'limit'), 100, 1, DOMAIN_SEARCH_MAX_RESULTS)
+
+        entry = get_search_index()
+        started = time.perf_counter()
+        with _SEARCH_INDEX_LOCK:
+            matches, truncated = entry["index"].search(query, mode, limit)
+            stats = entry["index"].stats()
+        elapsed_us = round((time.perf_counter() - started) * 1e6, 1)
+        logger.info(f"Domain search '{query}' ({mode}) matched {len(matches)} domains in {elapsed_us} us")
+
+        return Response(
+            code=200,
+            body={
+                "query": query,
+                "mode": mode,
+                "results": [{"domain": domain, "categories": categories} for domain, categories in matches],
+                "truncated": truncated,
+                "elapsed_us": elapsed_us,
+                "index": dict(stats, built_at=entry["built_at"])
+            }
+        )
+
+    except Exception as e:
+        logger.error(f"Error searching domains: {str(e)}")
+        logger.error(f"Traceback: {traceback.format_exc()}")
+        return Response(
+            code=500,
+            body={
+                "error": "Failed to search domains",
+                "details": str(e)
+            }
+        )
+
+@FUNC.handler(method='POST', path='/batch-categories')
+def batch_categories(request: Request, __: [dict[str, any], None], logger: Logger) -> Response:
+    """Read several domain collection records in one request."""
+    try:
+        body = request.body or {}
+        keys = body.get('keys')
+        if not isinstance(keys, list) or not keys:
+            return Response(code=400, body={"error": "keys is required"})
+        keys = list(dict.fromkeys(str(key) for key in keys))
+        if len(keys) > CATEGORY_BATCH_MAX_KEYS:
+            return Response(
+                code=400,
+                body={"error": f"At most {CATEGORY_BATCH_MAX_KEYS} categories can be read per request"}
+            )
+
+        records, missing, hits = read_category_records(falcon_service(CustomStorage), keys)
+        logger.info(f"Read {len(records)} categories, {hits} from cache, {len(missing)} missing")
+
+        return Response(
+            code=200,
+            body={
+                "records": records,
+                "missing": missing,
+                "cache": {"hits": hits, "misses": len(keys) - hits}
+            }
+        )
+
+    except Exception as e:
+        logger.error(f"Error reading categories: {str(e)}")
+        logger.error(f"Traceback: {traceback.format_exc()}")
+        return Response(
+            code=500,
+            body={
+                "error": "Failed to read categories",
+                "details": str(e)
+            }
+        )
+
+@FUNC.handler(method='POST', path='/classify-domain')
+def classify_domain(request: Request, __: [dict[str, any], None], logger: Logger) -> Response:
+    """Classify one domain or a batch of domains into categories."""
+    logger.info("Starting classify domain handler")
+    try:
+        body = request.body or {}
+        domains = body.get('domains')
+        if domains is None and body.get('domain'):
+            domains = [body['domain']]
+        if not isinstance(domains, list) or not domains:
+            return Response(code=400, body={"error": "domain or domains is required"})
+        if len(domains) > CLASSIFY_MAX_DOMAINS:
+            return Response(
+                code=400,
+                body={"error": f"At most {CLASSIFY_MAX_DOMAINS} domains can be classified per request"}
+            )
+
+        source = body.get('source', 'collection')
+        if source not in ('collection', 'csv'):
+            return Response(code=400, body={"error": "source must be 'collection' or 'csv'"})
+
+        entry = get_domain_matcher(source)
+        matcher = entry["matcher"]
+        results = [matcher.classify(str(domain)) for domain in domains]
+        matched = sum(1 for result in results if result["matched"])
+        logger.info(f"Classified {len(results)} domains, {matched} matched")
+
+        return Response(
+            code=200,
+            body={
+                "source": source,
+                "results": results,
+                "matched": matched,
+                "unmatched": len(results) - matched,
+                "index": {
+                    "categories": matcher.category_count,
+                    "patterns": matcher.pattern_count,
+                    "built_at": entry["built_at"]
+                }
+            }
+        )
+
+    except Exception as e:
+        logger.error(f"Error classifying domains: {str(e)}")
+        logger.error(f"Traceback: {traceback.format_exc()}")
+        return Response(
+            code=500,
+            body={
+                "error": "Failed to classify domains",
+                "details": str(e)
+            }
+        )
+
+def domain_sort_key(domain):
+    """Sort key that orders domains by reversed labels, keeping a domain next to its wildcard."""
+    wildcard = domain.startswith('*')
+    return domain.lstrip('*').lstrip('.').split('.')[::-1], wildcard
+
+
+def shard_domains(domains, max_domains=RULE_MAX_DOMAINS, max_length=RULE_MAX_FQDN_LENGTH):
+    """Pack domains into the fewest rules that respect the per-rule limits.
+
+    Domains are sorted by domain_sort_key and packed greedily, so the same
+    domain set always produces the same shards and related domains share a
+    rule. A domain longer than max_length on its own gets a shard of its own.
+    """
+    shards = []
+    current = []
+    length = 0
+    for domain in sorted(set(domains), key=domain_sort_key):
+        added = len(domain) + (1 if current else 0)
+        if current and (len(current) >= max_domains or length + added > max_length):
+            shards.append(current)
+            current, length, added = [], 0, len(domain)
+        current.append(domain)
+        length += added
+    if current:
+        shards.append(current)
+    return shards
+
+
+def build_fqdn_rule(name, description, domains, temp_id):
+    """Build a DENY rule for the given domains in the shape create_rule_group and diffs expect."""
+    return {
+        "action": "DENY",
+        "address_family": "NONE",
+        "description": description,
+        "direction": "OUT",
+        "enabled": True,
+        "fields": [
+            {
+                "name": "image_name",
+                "value": "",
+                "type": "windows_path",
+                "values": []
+            }
+        ],
+        "fqdn_enabled": True,
+        "fqdn": ';'.join(domains),
+        "icmp": {"icmp_code": "", "icmp_type": ""},
+        "local_address": [{"address": "*", "netmask": 0}],
+        "log": False,
+        "monitor": {"count": "1", "period_ms": "1000000"},
+        "name": name,
+        "protocol": "*",
+        "remote_address": [{"address": "*", "netmask": 0}],
+        "temp_id": temp_id
+    }
+
+
+def shard_layout(rules):
+    """Describe the rules built from shard_domains for API responses."""
+    layout = []
+    for rule in rules:
+        domains = rule["fqdn"].split(';')
+        layout.append({
+            "name": rule["name"],
+            "domain_count": len(domains),
+            "fqdn_length": len(rule["fqdn"]),
+            "first": domains[0],
+            "last": domains[-1]
+        })
+    return layout
+
+def _require_ok(response, action):
+    """Raise ValueError unless a FalconPy response reports success."""
+    status = _response_status(response)
+    if status >= 300:
+        body = (response.get("body") or {}) if isinstance(response, dict) else {}
+        messages = "; ".join(error.get("message", "") for error in body.get("errors") or [])
+        raise ValueError(f"{action} failed (status {status}){': ' + messages if messages else ''}")
+    return response
+
+
+def _checked_body(response, action):
+    """Return the body of a successful FalconPy response with resources, raising ValueError otherwise."""
+    body = _require_ok(response, action).get("body", {})
+    if "resources" not in body:
+        raise ValueError(f"{action} returned no resources")
+    return body
+
+
+def create_firewall_policy(policies, policy_name):
+    """Create a Windows firewall policy and return its ID."""
+    body = _checked_body(policies.create_policies(
+        description=f"Firewall policy for {policy_name}",
+        name=policy_name,
+        platform_name="Windows"
+    ), "Policy creation")
+    return body["resources"][0]["id"]
+
+
+def create_domain_rule_group(mgmt, name, description, rules):
+    """Create an enabled Windows rule group holding the given rules and return its ID."""
+    body = _checked_body(mgmt.create_rule_group(
+        description=description,
+        enabled=True,
+        name=name,
+        platform="windows",
+        rules=rules
+    ), "Rule group creation")
+    return body["resources"][0]
+
+
+def policy_action(policies, action_name, policy_ids, group_id=None):
+    """Run a firewall policy action (enable, add-host-group, ...) on one or more policies."""
+    kwargs = {"group_id": group_id} if group_id else {}
+    return _require_ok(
+        policies.perform_action(action_name=action_name, ids=policy_ids, **kwargs),
+        f"Policy action {action_name}"
+    )
+
+
+def attach_rule_groups(mgmt, policy_id, rule_group_ids):
+    """Set the rule groups of a policy's container."""
+    return _require_ok(mgmt.update_policy_container(
+        default_inbound="ALLOW",
+        default_outbound="ALLOW",
+        platform_id="windows",
+        enforce=True,
+        local_logging=True,
+        is_default_policy=False,
+        test_mode=False,
+        rule_group_ids=rule_group_ids,
+        policy_id=policy_id,
+        body={}  # Add empty body parameter to fix E1120 error
+    ), "Policy container update")
+
+
+def _run_step(run, results):
+    """Run one plan step, returning (started, finished, value, error)."""
+    started = time.monotonic()
+    try:
+        value = run(results)
+        return started, time.monotonic(), value, None
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        return started, time.monotonic(), None, e
+
+
+def run_step_plan(steps, logger, max_workers=4):
+    """Run a dependency graph of API steps, overlapping independent steps.
+
+    `steps` maps a step name to {"requires": [step names], "run":
+    callable(results) -> value, "undo": optional callable(results)}. A step
+    starts as soon as everything it requires has finished; `results` maps
+    finished step names to their values. If a step fails, no new steps
+    start and the completed steps are undone in reverse completion order.
+
+    Returns (results, timings, failure, rollback) where failure is None or
+    (step name, exception) and rollback lists the undo outcomes.
+    """
+    results, timings, completed, rollback = {}, {}, [], []
+    pending = dict(steps)
+    running = {}
+    failure = None
+    origin = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            if failure is None:
+                ready = [name for name, step in pending.items() if all(r in results for r in step.get("requires", ()))]
+                for name in ready:
+                    running[executor.submit(_run_step, pending.pop(name)["run"], results)] = name
+            if not running:
+                if failure is None:
+                    raise ValueError(f"Unsatisfiable step dependencies: {sorted(pending)}")
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                started, finished, value, error = future.result()
+                timings[name] = {
+                    "status": "failed" if error else "ok",
+                    "start_ms": round((started - origin) * 1000, 1),
+                    "duration_ms": round((finished - started) * 1000, 1)
+                }
+                if error is not None:
+                    logger.error(f"Step {name} failed: {str(error)}")
+                    failure = failure or (name, error)
+                else:
+                    results[name] = value
+                    completed.append(name)
+
+    for name in pending:
+        timings[name] = {"status": "skipped"}
+    if failure is not None:
+        for name in reversed(completed):
+            undo = steps[name].get("undo")
+            if undo is None:
+                continue
+            try:
+                undo(results)
+                rollback.append({"step": name, "status": "undone"})
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                logger.error(f"Rollback of step {name} failed: {str(e)}")
+                rollback.append({"step": name, "status": "failed", "error": str(e)})
+    return results, timings, failure, rollback
+
+
+def plan_timing(timings):
+    """Summarize step timings: wall clock (critical path) versus the sum of all steps."""
+    finished = [t for t in timings.values() if "duration_ms" in t]
+    return {
+        "total_ms": round(max((t["start_ms"] + t["duration_ms"] for t in finished), default=0), 1),
+        "sum_of_steps_ms": round(sum(t["duration_ms"] for t in finished), 1)
+    }
+
 @FUNC.handler(method='POST', path='/create-rule')
 def create_rule(request: Request, config: [dict[str, any], None], logger: Logger) -> Response:
     """Create a firewall rule for blocking domains."""
@@ -319,269 +1998,1115 @@ def create_rule(request: Request, config: [dict[str, any], None], logger: Logger
         if not policy_name:
             return Response(code=400, body={"error": "policyName is required"})
 
-        # Clean URLs
-        url_list = [url.strip() for url in urls.split(';') if url.strip()]
-        if not url_list:
-            return Response(code=400, body={"error": "No valid URLs provided"})
+        # Normalize URLs and drop entries a wildcard already covers
+        url_list, rejected = normalize_domain_list(urls)
+        if not url_list:
+            return Response(code=400, body={"error": "No valid URLs provided", "rejected": rejected})
+        if rejected:
+            logger.warning(f"Ignoring invalid domains: {rejected}")
+
+        clean_urls = ';'.join(url_list)
+        logger.info(f"Cleaned URLs: {clean_urls}")
+
+        # Split large domain sets across several rules
+        max_domains = _int_param(request.body.get('maxDomainsPerRule'), RULE_MAX_DOMAINS, 1, RULE_MAX_DOMAINS)
+        shards = shard_domains(url_list, max_domains=max_domains)
+        rules = []
+        for number, shard in enumerate(shards, start=1):
+            description = f"Domain blocking rule for {policy_name}"
+            if len(shards) > 1:
+                description += f" ({number}/{len(shards)})"
+            rules.append(build_fqdn_rule(f"rule{number}", description, shard, str(number)))
+        logger.info(f"Packed {len(url_list)} domains into {len(rules)} rules")
+
+        # Shared Falcon client
+        mgmt = falcon_service(FirewallManagement)
+        policies = falcon_service(FirewallPolicies)
+        logger.info("Successfully initialized Falcon client")
+
+        # Policy and rule group creation are independent; the policy actions
+        # only need the policy and the container update needs both
+        steps = {
+            "create_policy": {
+                "run": lambda _: create_firewall_policy(policies, policy_name),
+                "undo": lambda results: _require_ok(
+                    policies.delete_policies(ids=[results["create_policy"]]), "Policy deletion"
+                )
+            },
+            "create_rule_group": {
+                "run": lambda _: create_domain_rule_group(
+                    mgmt, f"{policy_name}_RuleGroup", f"Domain blocking rule group for {policy_name}", rules
+                ),
+                "undo": lambda results: _require_ok(
+                    mgmt.delete_rule_groups(ids=[results["create_rule_group"]]), "Rule group deletion"
+                )
+            },
+            "enable_policy": {
+                "requires": ["create_policy"],
+                "run": lambda results: policy_action(policies, "enable", results["create_policy"]),
+                "undo": lambda results: policy_action(policies, "disable", results["create_policy"])
+            },
+            "add_host_group": {
+                "requires": ["create_policy"],
+                "run": lambda results: policy_action(
+                    policies, "add-host-group", results["create_policy"], group_id=host_group_id
+                ),
+                "undo": lambda results: policy_action(
+                    policies, "remove-host-group", results["create_policy"], group_id=host_group_id
+                )
+            },
+            "update_policy_container": {
+                "requires": ["create_policy", "create_rule_group"],
+                "run": lambda results: attach_rule_groups(
+                    mgmt, results["create_policy"], results["create_rule_group"]
+                )
+            }
+        }
+        steps_results, timings, failure, rollback = run_step_plan(steps, logger)
+        logger.info(f"Create rule steps: {timings}")
+
+        if failure is not None:
+            failed_step, error = failure
+            return Response(
+                code=500,
+                body={
+                    "error": f"Failed to create rule: {str(error)}",
+                    "failedStep": failed_step,
+                    "rolledBack": rollback,
+                    "steps": timings,
+                    "timing": plan_timing(timings)
+                }
+            )
+
+        policy_id = steps_results["create_policy"]
+        rule_group_id = steps_results["create_rule_group"]
+        logger.info(f"Created policy {policy_id} with rule group {rule_group_id}")
+
+        return Response(
+            code=200,
+            body={
+                "message": "Successfully created blocking rule",
+                "policyName": policy_name,
+                "domainCount": len(url_list),
+                "rejected": rejected,
+                "shards": shard_layout(rules),
+                "ruleGroupId": rule_group_id,
+                "policyId": policy_id,
+                "steps": timings,
+                "timing": plan_timing(timings)
+            }
+        )
+
+    except ValueError as e:
+        logger.error(f"Validation error: {str(e)}")
+        return Response(
+            code=400,
+            body={
+                "error": f"Validation error: {str(e)}"
+            }
+        )
+    except Exception as e:
+        logger.error(f"Error creating rule: {str(e)}")
+        logger.error(f"Traceback: {traceback.format_exc()}")
+        return Response(
+            code=500,
+            body={
+                "error": f"Failed to create rule: {str(e)}"
+            }
+        )
+
+
+def make_relationship_key(category_name, rule_group_id, host_group_id):
+    """Return the relationship collection key for a category deployed to a host group."""
+    return f"{category_name}_{rule_group_id}_{host_group_id}"
+
+
+def load_category_domains(category_names, source="collection"):
+    """Return ({category: 'domain;...'}, missing_names) for the named categories."""
+    if source == "csv":
+        categories = load_category_index()["categories"]
+        found = {name: categories[name] for name in category_names if name in categories}
+    else:
+        # Imported categories are keyed by name, manage-category keys replace spaces with underscores
+        keys = {key for name in category_names for key in (name, name.replace(' ', '_'))}
+        records = get_collection_objects(falcon_service(CustomStorage), "domain", keys)
+        found = {}
+        for name in category_names:
+            record = records.get(name) or records.get(name.replace(' ', '_'))
+            if record:
+                found[name] = record.get("domain", "")
+    return found, [name for name in category_names if name not in found]
+
+
+def plan_bulk_deployments(body):
+    """Group a categories x host groups matrix into deployments that can share a policy.
+
+    The matrix is `categories` x `hostGroupIds`, plus any number of
+    `assignments` entries with their own `categories` and `hostGroupIds`.
+    A host group only gets one effective firewall policy, so host groups
+    are grouped by the full set of categories they should block and each
+    distinct set becomes one policy and rule group.
+    Returns [(sorted categories, [host group IDs])] in first-seen order.
+    """
+    wanted = {}
+    entries = [body] + list(body.get('assignments') or [])
+    for entry in entries:
+        for host_group_id in entry.get('hostGroupIds') or []:
+            wanted.setdefault(host_group_id, set()).update(entry.get('categories') or [])
+    buckets = {}
+    for host_group_id, categories in wanted.items():
+        if categories:
+            buckets.setdefault(tuple(sorted(categories)), []).append(host_group_id)
+    return list(buckets.items())
+
+
+def _deployment_steps(index, policies, mgmt, deployment):
+    """Build the run_step_plan steps that create and assign one deployment's policy and rule group.
+
+    Enabling is left to the caller, as one perform_action call can enable
+    every deployment's policy at once.
+    """
+    policy = f"policy_{index}"
+    rule_group = f"rule_group_{index}"
+    steps = {
+        policy: {
+            "run": lambda _: create_firewall_policy(policies, deployment["policyName"]),
+            "undo": lambda results: _require_ok(policies.delete_policies(ids=[results[policy]]), "Policy deletion")
+        },
+        rule_group: {
+            "run": lambda _: create_domain_rule_group(
+                mgmt, deployment["ruleGroupName"],
+                f"Domain blocking rule group for {deployment['policyName']}", deployment["rules"]
+            ),
+            "undo": lambda results: _require_ok(
+                mgmt.delete_rule_groups(ids=[results[rule_group]]), "Rule group deletion"
+            )
+        },
+        f"container_{index}": {
+            "requires": [policy, rule_group],
+            "run": lambda results: attach_rule_groups(mgmt, results[policy], results[rule_group])
+        }
+    }
+    for host_group_id in deployment["hostGroupIds"]:
+        steps[f"assign_{index}_{host_group_id}"] = {
+            "requires": [policy],
+            "run": lambda results, group_id=host_group_id: policy_action(
+                policies, "add-host-group", results[policy], group_id=group_id
+            ),
+            "undo": lambda results, group_id=host_group_id: policy_action(
+                policies, "remove-host-group", results[policy], group_id=group_id
+            )
+        }
+    return steps
+
+
+def host_group_names(host_group_ids, provided=None):
+    """Return {id: name} for host groups, using the names given by the caller or the cached listing."""
+    names = dict(provided or {})
+    if any(host_group_id not in names for host_group_id in host_group_ids):
+        try:
+            groups, _, _ = _HOST_GROUP_CACHE.get("host_groups", lambda: list_host_groups(falcon_service(HostGroup)))
+            for group in groups:
+                names.setdefault(group["id"], group["name"])
+        except ValueError:
+            pass
+    return {host_group_id: names.get(host_group_id, "") for host_group_id in host_group_ids}
+
+
+@FUNC.handler(method='POST', path='/bulk-deploy')
+def bulk_deploy(request: Request, __: [dict[str, any], None], logger: Logger) -> Response:
+    """Deploy a matrix of categories to host groups, sharing policies and rule groups where possible."""
+    logger.info("Starting bulk deploy handler")
+    try:
+        body = request.body or {}
+        policy_name = str(body.get('policyName', '')).strip()
+        if not policy_name:
+            return Response(code=400, body={"error": "policyName is required"})
+
+        planned = plan_bulk_deployments(body)
+        if not planned:
+            return Response(code=400, body={"error": "At least one category and host group is required"})
+
+        source = body.get('source', 'collection')
+        category_names = sorted({name for categories, _ in planned for name in categories})
+        category_domains, missing = load_category_domains(category_names, source)
+        if missing:
+            return Response(code=400, body={"error": "Unknown categories", "missingCategories": missing})
+
+        # One policy and rule group per distinct category set
+        max_domains = _int_param(body.get('maxDomainsPerRule'), RULE_MAX_DOMAINS, 1, RULE_MAX_DOMAINS)
+        deployments = []
+        for index, (categories, host_group_ids) in enumerate(planned, start=1):
+            name = policy_name if len(planned) == 1 else f"{policy_name}_{index}"
+            domains, rejected = normalize_domain_list([category_domains[category] for category in categories])
+            shards = shard_domains(domains, max_domains=max_domains)
+            deployments.append({
+                "policyName": name,
+                "ruleGroupName": f"{name}_RuleGroup",
+                "categories": list(categories),
+                "hostGroupIds": host_group_ids,
+                "domainCount": len(domains),
+                "rejected": rejected,
+                "rules": [
+                    build_fqdn_rule(f"rule{number}", f"Domain blocking rule for {name}", shard, str(number))
+                    for number, shard in enumerate(shards, start=1)
+                ]
+            })
+
+        # Create and assign everything as one dependency graph, rolled back as a whole on failure
+        mgmt = falcon_service(FirewallManagement)
+        policies = falcon_service(FirewallPolicies)
+        steps = {}
+        for index, deployment in enumerate(deployments, start=1):
+            steps.update(_deployment_steps(index, policies, mgmt, deployment))
+        policy_steps = [f"policy_{index}" for index in range(1, len(deployments) + 1)]
+        steps["enable"] = {
+            "requires": policy_steps,
+            "run": lambda results: policy_action(policies, "enable", [results[step] for step in policy_steps]),
+            "undo": lambda results: policy_action(policies, "disable", [results[step] for step in policy_steps])
+        }
+        results, timings, failure, rollback = run_step_plan(steps, logger, max_workers=RULE_UPDATE_MAX_WORKERS)
+
+        if failure is not None:
+            failed_step, error = failure
+            return Response(
+                code=500,
+                body={
+                    "error": f"Bulk deployment failed: {str(error)}",
+                    "failedStep": failed_step,
+                    "rolledBack": rollback,
+                    "steps": timings,
+                    "timing": plan_timing(timings)
+                }
+            )
+
+        # Record every category/host group relationship in one concurrent pass
+        names = host_group_names(
+            [host_group_id for deployment in deployments for host_group_id in deployment["hostGroupIds"]],
+            body.get('hostGroupNames')
+        )
+        created_at = datetime.now(pytz.UTC).isoformat()
+        relationships = {}
+        for index, deployment in enumerate(deployments, start=1):
+            deployment["policyId"] = results[f"policy_{index}"]
+            deployment["ruleGroupId"] = results[f"rule_group_{index}"]
+            deployment["shards"] = shard_layout(deployment.pop("rules"))
+            for category in deployment["categories"]:
+                for host_group_id in deployment["hostGroupIds"]:
+                    relationships[make_relationship_key(category, deployment["ruleGroupId"], host_group_id)] = {
+                        "category_name": category,
+                        "rule_group_id": deployment["ruleGroupId"],
+                        "rule_group_name": deployment["ruleGroupName"],
+                        "host_group_id": host_group_id,
+                        "host_group_name": names[host_group_id],
+                        "policy_name": deployment["policyName"],
+                        "created_at": created_at,
+                        "created_by": body.get('created_by', 'unknown')
+                    }
+        written, failed = put_collection_objects(
+            falcon_service(CustomStorage), "relationship", relationships, collection_version="v5.0"
+        )
+        logger.info(f"Deployed {len(deployments)} policies with {len(steps)} API steps, "
+                    f"{len(written)} relationships written")
+
+        return Response(
+            code=200 if not failed else 207,
+            body={
+                "success": not failed,
+                "deployments": deployments,
+                "relationships": {"written": len(written), "failed": failed},
+                "apiCalls": len(steps),
+                "steps": timings,
+                "timing": plan_timing(timings)
+            }
+        )
+
+    except Exception as e:
+        logger.error(f"Error in bulk deploy: {str(e)}")
+        logger.error(f"Traceback: {traceback.format_exc()}")
+        return Response(
+            code=500,
+            body={
+                "error": "Bulk deployment failed",
+                "details": str(e)
+            }
+        )
+
+
+def parse_event_timestamp(timestamp):
+    """Parse a firewall event timestamp ('2024-01-31T12:00:00Z') into an aware datetime."""
+    return datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+
+
+def parse_timestamp_epoch(timestamp):
+    """Parse a firewall event timestamp into integer UTC epoch seconds.
+
+    The common 'YYYY-MM-DDTHH:MM:SS[.fff]Z' form is sliced directly; other
+    ISO 8601 forms fall back to the datetime parser.
+    """
+    if len(timestamp) >= 20 and timestamp[10] == 'T' and timestamp[-1] == 'Z':
+        try:
+            return calendar.timegm((
+                int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]),
+                int(timestamp[11:13]), int(timestamp[14:16]), int(timestamp[17:19]), 0, 0, 0
+            ))
+        except ValueError:
+            pass
+    return int(parse_event_timestamp(timestamp).timestamp())
+
+
+def format_epoch(epoch):
+    """Format epoch seconds as an ISO 8601 UTC timestamp."""
+    return datetime.fromtimestamp(epoch, pytz.UTC).isoformat()
+
+
+def day_string(day_number):
+    """Format a day number (epoch seconds // 86400) as YYYY-MM-DD."""
+    return time.strftime('%Y-%m-%d', time.gmtime(day_number * 86400))
+
+
+def day_index(day):
+    """Convert a YYYY-MM-DD day into its day number (epoch seconds // 86400)."""
+    return calendar.timegm(time.strptime(day, '%Y-%m-%d')) // 86400
+
+
+class StringPool:
+    """Dictionary encoding for repeated strings: each distinct value is stored once."""
+
+    __slots__ = ("codes", "values")
+
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def intern(self, value):
+        """Return the integer code for a string, adding it to the pool if needed."""
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def __getitem__(self, code):
+        return self.values[code]
+
+
+class EventBuffer:
+    """Columnar, array-backed storage for blocked-domain firewall events.
+
+    String fields are dictionary-encoded into a (possibly shared) StringPool
+    and stored as 32-bit codes; timestamps are parsed once into 64-bit epoch
+    seconds. Each event costs a few dozen bytes instead of a six-key dict.
+    """
+
+    def __init__(self, pool=None):
+        self.pool = pool if pool is not None else StringPool()
+        self.timestamps = array('q')
+        self.domains = array('I')
+        self.remote_addresses = array('I')
+        self.host_names = array('I')
+        self.policy_names = array('I')
+        self.rule_names = array('I')
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def append_events(self, events):
+        """Append the raw firewall events that carry a domain."""
+        intern = self.pool.intern
+        for event in events:
+            domain = event.get('domain_name_list')
+            if domain is None:
+                continue
+            self.timestamps.append(parse_timestamp_epoch(event['timestamp']))
+            self.domains.append(intern(domain))
+            self.remote_addresses.append(intern(event['remote_address']))
+            self.host_names.append(intern(event.get('host_name', 'Unknown')))
+            self.policy_names.append(intern(event.get('policy_name', 'Unknown')))
+            self.rule_names.append(intern(event.get('rule_name', 'Unknown')))
+
+    def columns(self):
+        """Return the code columns in (timestamp, domain, ip, host, policy, rule) order for zip()."""
+        return (self.timestamps, self.domains, self.remote_addresses,
+                self.host_names, self.policy_names, self.rule_names)
+
+    def clear(self):
+        """Drop the buffered events, keeping the string pool."""
+        for column in self.columns():
+            del column[:]
+
+
+class DomainStats:
+    """Running aggregates for a single blocked domain, over StringPool codes and epoch seconds."""
+
+    __slots__ = ("count", "ips", "hosts", "ip_floor", "host_floor", "first_seen", "last_seen",
+                 "policy_name", "rule_name", "daily")
+
+    def __init__(self, policy_name, rule_name):
+        self.count = 0
+        self.ips = set()
+        self.hosts = set()
+        self.ip_floor = 0  # distinct counts of rollup days whose lists were capped
+        self.host_floor = 0
+        self.first_seen = None
+        self.last_seen = None
+        self.policy_name = policy_name
+        self.rule_name = rule_name
+        self.daily = Counter()
+
+    def add(self, remote_address, host_name, timestamp):
+        """Fold a single event into the aggregates."""
+        self.count += 1
+        self.ips.add(remote_address)
+        self.hosts.add(host_name)
+        if self.first_seen is None or timestamp < self.first_seen:
+            self.first_seen = timestamp
+        if self.last_seen is None or timestamp > self.last_seen:
+            self.last_seen = timestamp
+        self.daily[timestamp // 86400] += 1
+
+    def merge(self, other):
+        """Fold another DomainStats for the same domain (and pool) into this one."""
+        if self.last_seen is None or (other.last_seen is not None and other.last_seen > self.last_seen):
+            self.policy_name = other.policy_name
+            self.rule_name = other.rule_name
+        self.count += other.count
+        self.ips.update(other.ips)
+        self.hosts.update(other.hosts)
+        self.ip_floor = max(self.ip_floor, other.ip_floor)
+        self.host_floor = max(self.host_floor, other.host_floor)
+        if self.first_seen is None or (other.first_seen is not None and other.first_seen < self.first_seen):
+            self.first_seen = other.first_seen
+        if self.last_seen is None or (other.last_seen is not None and other.last_seen > self.last_seen):
+            self.last_seen = other.last_seen
+        self.daily.update(other.daily)
+
+    @property
+    def unique_ips(self):
+        """Distinct IPs seen; a lower bound once capped rollup days were merged in."""
+        return max(len(self.ips), self.ip_floor)
+
+    @property
+    def unique_hosts(self):
+        """Distinct hosts seen; a lower bound once capped rollup days were merged in."""
+        return max(len(self.hosts), self.host_floor)
+
+    def to_dict(self, pool):
+        """Serialize the aggregates of a single day for the rollup collection.
+
+        At most ROLLUP_MAX_ADDRESSES IPs and hosts are listed; the distinct
+        counts are stored alongside so a capped list is not undercounted.
+        """
+        return {
+            "count": self.count,
+            "ips": sorted(pool[code] for code in self.ips)[:ROLLUP_MAX_ADDRESSES],
+            "hosts": sorted(pool[code] for code in self.hosts)[:ROLLUP_MAX_ADDRESSES],
+            "unique_ips": self.unique_ips,
+            "unique_hosts": self.unique_hosts,
+            "first_seen": format_epoch(self.first_seen),
+            "last_seen": format_epoch(self.last_seen),
+            "policy_name": pool[self.policy_name],
+            "rule_name": pool[self.rule_name]
+        }
+
+    @classmethod
+    def from_dict(cls, data, day, pool):
+        """Rebuild the aggregates of a single day stored by to_dict."""
+        stats = cls(pool.intern(data.get("policy_name", "Unknown")), pool.intern(data.get("rule_name", "Unknown")))
+        stats.count = data["count"]
+        stats.ips = {pool.intern(ip) for ip in data.get("ips", [])}
+        stats.hosts = {pool.intern(host) for host in data.get("hosts", [])}
+        stats.ip_floor = data.get("unique_ips", 0)
+        stats.host_floor = data.get("unique_hosts", 0)
+        stats.first_seen = parse_timestamp_epoch(data["first_seen"])
+        stats.last_seen = parse_timestamp_epoch(data["last_seen"])
+        stats.daily[day_index(day)] = data["count"]
+        return stats
+
+
+class DomainAnalyticsAggregator:
+    """Single-pass aggregation of firewall block events by domain.
+
+    Event batches are folded in from EventBuffers as they arrive, so memory
+    grows with the number of distinct domains, IPs and hosts rather than
+    with the number of events. All state is kept as StringPool codes.
+    """
+
+    def __init__(self, pool=None):
+        self.pool = pool if pool is not None else StringPool()
+        self.domains = {}
+        self.event_count = 0
+
+    def add_row(self, timestamp, domain, address, host, policy, rule):
+        """Fold a single encoded event into the running aggregates."""
+        stats = self.domains.get(domain)
+        if stats is None:
+            stats = self.domains[domain] = DomainStats(policy, rule)
+        stats.add(address, host, timestamp)
+        self.event_count += 1
+
+    def add_buffer(self, buffer):
+        """Fold every event of an EventBuffer that shares this aggregator's pool."""
+        for row in zip(*buffer.columns()):
+            self.add_row(*row)
+
+    def add_events(self, events):
+        """Fold a batch of raw firewall events into the running aggregates."""
+        buffer = EventBuffer(self.pool)
+        buffer.append_events(events)
+        self.add_buffer(buffer)
+
+    def merge(self, domain, stats):
+        """Fold pre-aggregated DomainStats (for example a stored rollup) into the aggregates."""
+        existing = self.domains.get(domain)
+        if existing is None:
+            self.domains[domain] = stats
+        else:
+            existing.merge(stats)
+        self.event_count += stats.count
+
+    def top_domains(self, top_n=20):
+        """Return (domain_code, stats) pairs for the most blocked domains, ties in arrival order."""
+        ranked = sorted(self.domains.items(), key=lambda item: item[1].count, reverse=True)
+        return ranked[:top_n]
+
+    def result(self, top_n=20):
+        """Build the analysis and visualization payload for the top domains."""
+        pool = self.pool
+        top = self.top_domains(top_n)
+        unique_hosts = set()
+        rows = []
+        for domain, stats in top:
+            unique_hosts.update(stats.hosts)
+            rows.append((pool[domain], {
+                'count': stats.count,
+                'unique_ips': stats.unique_ips,
+                'unique_hosts': stats.unique_hosts,
+                'first_seen': stats.first_seen,
+                'last_seen': stats.last_seen,
+                'policy_name': pool[stats.policy_name],
+                'rule_name': pool[stats.rule_name],
+                'daily': stats.daily
+            }))
+        return build_analytics_payload(rows, len(unique_hosts))
+
+
+def build_analytics_payload(rows, unique_host_count):
+    """Format ranked (domain, summary) rows into the analysis and visualization payload."""
+    domain_analysis = {}
+    daily_blocks = Counter()
+    for domain, summary in rows:
+        domain_analysis[domain] = {
+            'visit_count': summary['count'],  # Named visit_count to match React component
+            'unique_ips': summary['unique_ips'],
+            'unique_hosts': summary['unique_hosts'],
+            'first_seen': format_epoch(summary['first_seen']),
+            'last_seen': format_epoch(summary['last_seen']),
+            'policy_name': summary['policy_name'],
+            'rule_name': summary['rule_name']
+        }
+        daily_blocks.update(summary['daily'])
+
+    days = sorted(daily_blocks)
+
+    # Prepare visualization data to match what the React component expects
+    visualization_data = {
+        'bar_chart': {
+            'domains': [domain for domain, _ in rows],
+            'visits': [summary['count'] for _, summary in rows]
+        },
+        'comparison_chart': {
+            'domains': [domain for domain, _ in rows[:10]],
+            'visits': [summary['count'] for _, summary in rows[:10]],
+            'unique_ips': [summary['unique_ips'] for _, summary in rows[:10]]
+        },
+        'daily_blocks': {
+            'dates': [day_string(day) for day in days],
+            'blocks': [daily_blocks[day] for day in days]
+        },
+        'summary': {
+            'total_blocks': sum(summary['count'] for _, summary in rows),
+            'unique_domains': len(domain_analysis),
+            'unique_hosts': unique_host_count
+        }
+    }
+
+    return domain_analysis, visualization_data
+
+
+def hash64(value):
+    """Return a stable 64-bit hash of a string, for the HyperLogLog sketches."""
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class HyperLogLog:
+    """HyperLogLog cardinality sketch using 2**precision one-byte registers.
+
+    The relative standard error of count() is about 1.04 / sqrt(2**precision),
+    i.e. ~3.3% at the default precision of 10 (1 KiB of registers), no matter
+    how many values are added.
+    """
+
+    __slots__ = ("precision", "registers")
+
+    def __init__(self, precision=10):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add_hash(self, hashed):
+        """Add a value given its 64-bit hash (see hash64)."""
+        index = hashed >> (64 - self.precision)
+        remainder = hashed & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - remainder.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        """Fold another sketch of the same precision into this one."""
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+
+    def count(self):
+        """Return the estimated number of distinct values added."""
+        size = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = alpha * size * size / sum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * size and zeros:
+            estimate = size * math.log(size / zeros)  # Linear counting for small cardinalities
+        return int(round(estimate))
+
+
+class SketchedDomainStats:
+    """Bounded-size aggregates for a domain tracked by the Space-Saving summary."""
+
+    __slots__ = ("count", "error", "ips", "hosts", "first_seen", "last_seen", "policy_name", "rule_name", "daily")
+
+    def __init__(self, count, error, policy_name, rule_name, precision):
+        self.count = count
+        self.error = error
+        self.ips = HyperLogLog(precision)
+        self.hosts = HyperLogLog(precision)
+        self.first_seen = None
+        self.last_seen = None
+        self.policy_name = policy_name
+        self.rule_name = rule_name
+        self.daily = Counter()
+
+
+class ApproximateDomainAggregator:
+    """Fixed-memory heavy-hitter aggregation of firewall block events.
+
+    Domain counts use a Space-Saving summary of `capacity` counters: a
+    reported count never underestimates the true count and overestimates it
+    by at most N / capacity for N events, so any domain with more than
+    N / capacity blocks is guaranteed to be tracked. Unique IPs and hosts
+    are HyperLogLog estimates (see HyperLogLog for the error). A domain
+    that was evicted and re-admitted only counts IPs and hosts seen after
+    its re-admission. Daily buckets hold at most one entry per day.
+
+    Raw events are folded in directly. IPs and hosts are only hashed into
+    the sketches and domain strings are only held by their counter, so
+    memory depends on capacity and precision, not on the number of events
+    or distinct values.
+    """
+
+    def __init__(self, capacity=SKETCH_CAPACITY, precision=SKETCH_PRECISION):
+        self.capacity = capacity
+        self.precision = precision
+        self.domains = {}
+        self.event_count = 0
+        self._heap = []  # (count, domain) entries, refreshed lazily on eviction
+
+    def _evict_smallest(self):
+        """Remove the domain with the smallest counter and return that count."""
+        while True:
+            count, domain = heapq.heappop(self._heap)
+            stats = self.domains.get(domain)
+            if stats is None:
+                continue
+            if stats.count == count:
+                del self.domains[domain]
+                return count
+            heapq.heappush(self._heap, (stats.count, domain))
+
+    def _track(self, domain, policy, rule):
+        """Return the stats slot for a domain, evicting the smallest counter if full."""
+        stats = self.domains.get(domain)
+        if stats is not None:
+            return stats
+        count = error = 0
+        if len(self.domains) >= self.capacity:
+            count = error = self._evict_smallest()
+        stats = self.domains[domain] = SketchedDomainStats(count, error, policy, rule, self.precision)
+        heapq.heappush(self._heap, (count + 1, domain))
+        return stats
+
+    def add_event(self, timestamp, domain, address, host, policy, rule):
+        """Fold a single event (epoch seconds and plain strings) into the sketches."""
+        stats = self._track(domain, policy, rule)
+        stats.count += 1
+        stats.ips.add_hash(hash64(address))
+        stats.hosts.add_hash(hash64(host))
+        if stats.first_seen is None or timestamp < stats.first_seen:
+            stats.first_seen = timestamp
+        if stats.last_seen is None or timestamp > stats.last_seen:
+            stats.last_seen = timestamp
+        stats.daily[timestamp // 86400] += 1
+        self.event_count += 1
+
+    def add_events(self, events):
+        """Fold a batch of raw firewall events into the sketches."""
+        for event in events:
+            domain = event.get('domain_name_list')
+            if domain is None:
+                continue
+            self.add_event(
+                parse_timestamp_epoch(event['timestamp']),
+                domain,
+                event['remote_address'],
+                event.get('host_name', 'Unknown'),
+                event.get('policy_name', 'Unknown'),
+                event.get('rule_name', 'Unknown')
+            )
+
+    def result(self, top_n=20):
+        """Build the analysis payload for the estimated top domains, plus the error bounds."""
+        top = sorted(self.domains.items(), key=lambda item: item[1].count, reverse=True)[:top_n]
+        all_hosts = HyperLogLog(self.precision)
+        rows = []
+        for domain, stats in top:
+            all_hosts.merge(stats.hosts)
+            rows.append((domain, {
+                'count': stats.count,
+                'unique_ips': stats.ips.count(),
+                'unique_hosts': stats.hosts.count(),
+                'first_seen': stats.first_seen,
+                'last_seen': stats.last_seen,
+                'policy_name': stats.policy_name,
+                'rule_name': stats.rule_name,
+                'daily': stats.daily
+            }))
+        domain_analysis, visualization_data = build_analytics_payload(rows, all_hosts.count())
+        for domain, stats in top:
+            domain_analysis[domain]['max_count_error'] = stats.error
+        visualization_data['approximation'] = {
+            'events': self.event_count,
+            'counters': self.capacity,
+            'count_error_bound': self.event_count // self.capacity,
+            'cardinality_relative_error': round(1.04 / math.sqrt(1 << self.precision), 4)
+        }
+        return domain_analysis, visualization_data
+
+
+def _fetch_event_details(firewall_mgmt, event_ids):
+    """Fetch the details for a chunk of event IDs, returning an empty list on failure."""
+    events_response, _ = call_with_retry(firewall_mgmt.get_events, ids=event_ids)
+    if _response_status(events_response) != 200:
+        return []
+    return events_response['body']['resources'] or []
+
+
+def iter_event_batches(firewall_mgmt, time_filter, logger, page_size=EVENT_PAGE_SIZE,
+                       max_in_flight=EVENT_PAGES_IN_FLIGHT):
+    """Yield batches of firewall event details, overlapping ID paging with detail fetches.
+
+    ID pages are walked with the query_events `after` cursor (falling back to
+    offsets if the API returns no cursor). Each page's get_events calls are
+    handed to a worker pool while the next ID page is requested, with at most
+    max_in_flight pages outstanding. Batches are yielded in query order.
+    """
+    chunks_per_page = max(1, -(-page_size // EVENT_DETAILS_CHUNK))
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_in_flight * chunks_per_page) as executor:
+        after = None
+        offset = 0
+        while True:
+            parameters = {'filter': time_filter, 'limit': page_size, 'sort': 'timestamp.desc'}
+            if after:
+                parameters['after'] = after
+            elif offset:
+                parameters['offset'] = offset
+
+            try:
+                query_response, _ = call_with_retry(firewall_mgmt.query_events, parameters=parameters)
+            except (IOError, OSError) as e:
+                logger.error(f"Error fetching events page: {str(e)}")
+                break
+            if query_response['status_code'] != 200 or not query_response['body']['resources']:
+                break
 
-        clean_urls = ';'.join(url_list)
-        logger.info(f"Cleaned URLs: {clean_urls}")
+            event_ids = query_response['body']['resources']
+            pending.append([
+                executor.submit(_fetch_event_details, firewall_mgmt, event_ids[i:i + EVENT_DETAILS_CHUNK])
+                for i in range(0, len(event_ids), EVENT_DETAILS_CHUNK)
+            ])
 
-        # Initialize Falcon client
-        falcon = APIHarnessV2(debug=True)
-        mgmt = FirewallManagement(falcon, base_url=cloud())
-        policies = FirewallPolicies(falcon, base_url=cloud())
-        logger.info("Successfully initialized Falcon client")
+            # Hand back finished pages without stalling the ID cursor
+            while pending and (len(pending) >= max_in_flight or all(f.done() for f in pending[0])):
+                yield from _collect_page(pending.popleft(), logger)
 
-        # Create policy
-        policy_response = policies.create_policies(
-            description=f"Firewall policy for {policy_name}",
-            name=policy_name,
-            platform_name="Windows"
-        )
+            pagination = (query_response['body'].get('meta') or {}).get('pagination') or {}
+            after = pagination.get('after')
+            offset += len(event_ids)
+            if len(event_ids) < page_size:
+                break
 
-        logger.info(f"Policy creation response: {policy_response}")
+        while pending:
+            yield from _collect_page(pending.popleft(), logger)
 
-        if "body" not in policy_response or "resources" not in policy_response["body"]:
-            raise ValueError("Invalid policy creation response")
 
-        policy_id = policy_response["body"]["resources"][0]["id"]
-        logger.info(f"Created policy: {policy_id}")
+def _collect_page(futures, logger):
+    """Yield the event batches of one page's detail fetches, logging failed chunks."""
+    for future in futures:
+        try:
+            yield future.result()
+        except (IOError, OSError) as e:
+            logger.error(f"Error fetching events batch: {str(e)}")
 
-        # Enable policy and add host group
-        enable_response = policies.perform_action(action_name="enable", ids=policy_id)
-        logger.info(f"Policy enable response: {enable_response}")
 
-        add_host_response = policies.perform_action(
-            action_name="add-host-group",
-            group_id=host_group_id,
-            ids=policy_id
-        )
-        logger.info(f"Add host group response: {add_host_response}")
-
-        # Create rule group
-        rule_group_response = mgmt.create_rule_group(
-            description=f"Domain blocking rule group for {policy_name}",
-            enabled=True,
-            name=f"{policy_name}_RuleGroup",
-            platform="windows",
-            rules={
-                "action": "DENY",
-                "address_family": "NONE",
-                "description": f"Domain blocking rule for {policy_name}",
-                "direction": "OUT",
-                "enabled": True,
-                "fields": [
-                    {
-                        "name": "image_name",
-                        "value": "",
-                        "type": "windows_path",
-                        "values": []
-                    }
-                ],
-                "fqdn_enabled": True,
-                "fqdn": urls,  # Use cleaned URLs
-                "icmp": {"icmp_code": "", "icmp_type": ""},
-                "local_address": [{"address": "*", "netmask": 0}],
-                "log": False,
-                "monitor": {"count": "1", "period_ms": "1000000"},
-                "name": "rule1",
-                "protocol": "*",
-                "remote_address": [{"address": "*", "netmask": 0}],
-                "temp_id": "1"
-            }
-        )
+def _rollup_key(day):
+    """Return the rollup collection key for a YYYY-MM-DD day."""
+    return f"day-{day}"
 
-        logger.info(f"Rule group creation response: {rule_group_response}")
-
-        if "body" not in rule_group_response or "resources" not in rule_group_response["body"]:
-            raise ValueError("Invalid rule group creation response")
-
-        rule_group_id = rule_group_response["body"]["resources"][0]
-        logger.info(f"Created rule group: {rule_group_id}")
-
-        # Update policy with rule group
-        update_response = mgmt.update_policy_container(
-            default_inbound="ALLOW",
-            default_outbound="ALLOW",
-            platform_id="windows",
-            enforce=True,
-            local_logging=True,
-            is_default_policy=False,
-            test_mode=False,
-            rule_group_ids=rule_group_id,
-            policy_id=policy_id,
-            body={}  # Add empty body parameter to fix E1120 error
-        )
 
-        logger.info(f"Policy update response: {update_response}")
+def load_rollup_days(customobjects, days, pool):
+    """Load stored per-day rollups.
 
-        return Response(
-            code=200,
-            body={
-                "message": "Successfully created blocking rule",
-                "policyName": policy_name,
-                "ruleGroupId": rule_group_id,
-                "policyId": policy_id
-            }
-        )
+    Returns ({day: {domain_code: DomainStats}}, {day: meta}) where meta
+    holds the epoch second the day's events were merged up to ("through")
+    and the blocks of domains trimmed from it ("dropped_blocks").
+    """
+    records = get_collection_objects(customobjects, ROLLUP_COLLECTION, [_rollup_key(day) for day in days])
+    rollups = {}
+    meta = {}
+    for record in records.values():
+        day = record["day"]
+        rollups[day] = {
+            pool.intern(domain): DomainStats.from_dict(data, day, pool)
+            for domain, data in (record.get("domains") or {}).items()
+        }
+        meta[day] = {
+            "through": parse_timestamp_epoch(record["through"]) if record.get("through") else None,
+            "dropped_blocks": record.get("dropped_blocks", 0)
+        }
+    return rollups, meta
+
+
+def _write_rollup_day(customobjects, day, domains, pool, through, dropped_blocks):
+    """Store the top ROLLUP_DAY_MAX_DOMAINS domains of a day, returning (status code, domains trimmed)."""
+    ranked = sorted(domains.items(), key=lambda item: item[1].count, reverse=True)
+    kept, trimmed = ranked[:ROLLUP_DAY_MAX_DOMAINS], ranked[ROLLUP_DAY_MAX_DOMAINS:]
+    response, _ = call_with_retry(
+        customobjects.PutObject,
+        body={
+            "day": day,
+            "domains": {pool[domain]: stats.to_dict(pool) for domain, stats in kept},
+            "through": format_epoch(through),
+            "dropped_blocks": dropped_blocks + sum(stats.count for _, stats in trimmed),
+            "updated_at": int(time.time())
+        },
+        collection_name=ROLLUP_COLLECTION,
+        object_key=_rollup_key(day)
+    )
+    return _response_status(response), len(trimmed)
+
+
+def refresh_rollups(customobjects, firewall_mgmt, logger, now=None, retention_days=ROLLUP_RETENTION_DAYS):
+    """Merge events newer than the stored watermark into the per-day rollups.
+
+    Only events in [watermark, now - ROLLUP_SETTLE_SECONDS) are fetched, so
+    events still being ingested are left for the next refresh instead of
+    being counted twice. Each day also records the whole second it was
+    merged up to, and earlier events are skipped for it, so a refresh whose watermark
+    write failed cannot count the same events twice. Days that fall out of
+    the retention window are deleted. Returns a summary of the refresh.
+    """
+    now = now or datetime.now(pytz.UTC)
+    window_start = now - timedelta(days=retention_days)
+    cutoff = (now - timedelta(seconds=ROLLUP_SETTLE_SECONDS)).replace(microsecond=0)
+
+    with _ROLLUP_LOCK:
+        state = get_collection_object(customobjects, ROLLUP_COLLECTION, ROLLUP_WATERMARK_KEY) or {}
+        watermark = parse_event_timestamp(state["watermark"]) if state.get("watermark") else None
+        fetch_from = max(watermark, window_start) if watermark else window_start
+        cutoff_epoch = int(cutoff.timestamp())
+
+        # Load the days the new events can fall in, with the time each is already merged up to
+        pool = StringPool()
+        days = []
+        if fetch_from < cutoff:
+            days = [day_string(day) for day in range(int(fetch_from.timestamp()) // 86400, cutoff_epoch // 86400 + 1)]
+        stored, meta = load_rollup_days(customobjects, days, pool)
+        covered = {day_index(day): info["through"] for day, info in meta.items() if info["through"] is not None}
+
+        # Aggregate the new events per day
+        buffer = EventBuffer(pool)
+        new_days = {}
+        new_events = 0
+        skipped = 0
+        if fetch_from < cutoff:
+            time_filter = f"timestamp:>='{fetch_from.isoformat()}'+timestamp:<'{cutoff.isoformat()}'"
+            for events in iter_event_batches(firewall_mgmt, time_filter, logger):
+                buffer.append_events(events)
+                for row in zip(*buffer.columns()):
+                    day = row[0] // 86400
+                    if row[0] < covered.get(day, 0):
+                        skipped += 1
+                        continue
+                    new_days.setdefault(day_string(day), DomainAnalyticsAggregator(pool)).add_row(*row)
+                    new_events += 1
+                buffer.clear()
+
+        # Merge them into the stored days and persist the touched days
+        for day, aggregator in new_days.items():
+            merged = stored.setdefault(day, {})
+            for domain, stats in aggregator.domains.items():
+                if domain in merged:
+                    merged[domain].merge(stats)
+                else:
+                    merged[domain] = stats
+        trimmed = 0
+        if new_days:
+            with ThreadPoolExecutor(max_workers=min(len(new_days), IMPORT_MAX_WORKERS)) as executor:
+                writes = list(executor.map(
+                    lambda day: _write_rollup_day(
+                        customobjects, day, stored[day], pool, cutoff_epoch,
+                        meta.get(day, {}).get("dropped_blocks", 0)
+                    ),
+                    new_days
+                ))
+            if any(status != 200 for status, _ in writes):
+                raise ValueError("Failed to store analytics rollups; watermark not advanced")
+            trimmed = sum(count for _, count in writes)
+            if trimmed:
+                logger.warning(f"Trimmed {trimmed} low-count domains from analytics rollups")
+
+        if fetch_from < cutoff:
+            response, _ = call_with_retry(
+                customobjects.PutObject,
+                body={"watermark": cutoff.isoformat(), "updated_at": int(time.time())},
+                collection_name=ROLLUP_COLLECTION,
+                object_key=ROLLUP_WATERMARK_KEY
+            )
+            if _response_status(response) != 200:
+                raise ValueError("Failed to store analytics rollup watermark")
 
-    except ValueError as e:
-        logger.error(f"Validation error: {str(e)}")
-        return Response(
-            code=400,
-            body={
-                "error": f"Validation error: {str(e)}"
-            }
-        )
-    except Exception as e:
-        logger.error(f"Error creating rule: {str(e)}")
-        logger.error(f"Traceback: {traceback.format_exc()}")
-        return Response(
-            code=500,
-            body={
-                "error": f"Failed to create rule: {str(e)}"
-            }
-        )
+        # Drop days that left the retention window
+        oldest_day = window_start.date().isoformat()
+        expired = [
+            key for key in list_collection_keys(customobjects, ROLLUP_COLLECTION)
+            if key.startswith("day-") and key[len("day-"):] < oldest_day
+        ]
+        bulk_delete_objects(expired, customobjects, ROLLUP_COLLECTION)
 
+    return {
+        "watermark": cutoff.isoformat() if fetch_from < cutoff else state.get("watermark"),
+        "fetched_from": fetch_from.isoformat(),
+        "new_events": new_events,
+        "already_merged_events": skipped,
+        "days_updated": sorted(new_days),
+        "days_expired": len(expired),
+        "domains_trimmed": trimmed
+    }
 
-@FUNC.handler(method='GET', path='/domain-analytics')
-def get_domain_analytics(_: Request, __: [dict[str, any], None], logger: Logger) -> Response:
-    """Generate analytics for domain blocking events."""
-    logger.info("Starting domain analytics handler")
-    try:
-        # Initialize Falcon client
-        try:
-            falcon = APIHarnessV2(debug=True)
-            firewall_mgmt = FirewallManagement(falcon, base_url=cloud())
-            logger.info("Successfully initialized Falcon client")
-        except Exception as e:
-            logger.error(f"Failed to initialize Falcon client: {str(e)}")
-            return Response(
-                code=500,
-                body={
-                    "error": "Falcon client initialization failed",
-                    "details": str(e)
-                }
-            )
 
-        # Fetch events for the last 15 days
-        end_time = datetime.now(pytz.UTC)
-        start_time = end_time - timedelta(days=15)
-        time_filter = f"timestamp:>'{start_time.isoformat()}'"
+def aggregate_from_rollups(customobjects, now=None, retention_days=ROLLUP_RETENTION_DAYS):
+    """Build a DomainAnalyticsAggregator from the stored rollups of the retention window."""
+    now = now or datetime.now(pytz.UTC)
+    days = [(now - timedelta(days=offset)).date().isoformat() for offset in range(retention_days + 1)]
+    aggregator = DomainAnalyticsAggregator()
+    rollups, _ = load_rollup_days(customobjects, days, aggregator.pool)
+    # Newest day first, so ties keep the same order as the live path
+    for day in sorted(rollups, reverse=True):
+        for domain, stats in rollups[day].items():
+            aggregator.merge(domain, stats)
+    return aggregator
 
-        logger.info(f"Fetching events from {start_time} to {end_time}")
 
-        all_events = []
-        offset = 0
-        limit = 500
+_ANALYTICS_CACHE = StaleWhileRevalidateCache(ttl=ANALYTICS_CACHE_TTL, grace=ANALYTICS_CACHE_GRACE)
 
-        while True:
-            try:
-                query_response = firewall_mgmt.query_events(parameters={
-                    'filter': time_filter,
-                    'limit': limit,
-                    'offset': offset,
-                    'sort': 'timestamp.desc'
-                })
 
-                if query_response['status_code'] != 200 or not query_response['body']['resources']:
-                    break
-
-                event_ids = query_response['body']['resources']
-                events_response = firewall_mgmt.get_events(ids=event_ids)
-
-                if events_response['status_code'] == 200:
-                    events = events_response['body']['resources']
-                    for event in events:
-                        if 'domain_name_list' in event:
-                            all_events.append({
-                                'domain': event['domain_name_list'],
-                                'timestamp': event['timestamp'],
-                                'remote_address': event['remote_address'],
-                                'host_name': event.get('host_name', 'Unknown'),
-                                'policy_name': event.get('policy_name', 'Unknown'),
-                                'rule_name': event.get('rule_name', 'Unknown')
-                            })
-
-                offset += limit
-                if len(event_ids) < limit:
-                    break
-
-            except Exception as e:
-                logger.error(f"Error fetching events batch: {str(e)}")
-                break
+def compute_domain_analytics(source, days, top_n, logger, approximate=False):
+    """Aggregate blocked-domain events for the last `days` days and build the response body.
 
-        logger.info(f"Total events fetched: {len(all_events)}")
+    Approximate mode always streams live events into fixed-size sketches.
+    """
+    firewall_mgmt = falcon_service(FirewallManagement)
 
-        # Analyze domains
-        # Count domain occurrences
-        domain_counter = Counter(event['domain'] for event in all_events)
-        top_domains = domain_counter.most_common(20)  # Get top 20 domains
+    rollup_summary = None
+    aggregator = None
+    if source == 'rollup' and days <= ROLLUP_RETENTION_DAYS and not approximate:
+        try:
+            customobjects = falcon_service(CustomStorage)
+            rollup_summary = refresh_rollups(customobjects, firewall_mgmt, logger)
+            aggregator = aggregate_from_rollups(customobjects, retention_days=days)
+            logger.info(f"Merged {rollup_summary['new_events']} new events into rollups")
+        except (ValueError, KeyError, IOError) as rollup_error:
+            logger.error(f"Rollup refresh failed, falling back to live events: {str(rollup_error)}")
+            rollup_summary = {"fallback": True, "error": str(rollup_error)}
+            aggregator = None
+
+    if aggregator is None:
+        end_time = datetime.now(pytz.UTC)
+        start_time = end_time - timedelta(days=days)
+        time_filter = f"timestamp:>'{start_time.isoformat()}'"
 
-        # Initialize analysis data
-        domain_analysis = {}
-        daily_blocks = defaultdict(int)
-        total_blocks = 0
-        unique_hosts = set()
+        logger.info(f"Fetching events from {start_time} to {end_time}")
 
-        # Analyze each domain
-        for domain, count in top_domains:
-            domain_events = [e for e in all_events if e['domain'] == domain]
-            unique_ips = len(set(e['remote_address'] for e in domain_events))
-            domain_hosts = len(set(e['host_name'] for e in domain_events))
+        aggregator = ApproximateDomainAggregator() if approximate else DomainAnalyticsAggregator()
+        for events in iter_event_batches(firewall_mgmt, time_filter, logger):
+            aggregator.add_events(events)
 
-                # Get timestamps for first and last blocks
-            timestamps = [
-                datetime.fromisoformat(e['timestamp'].replace('Z', '+00:00'))
-                for e in domain_events
-            ]
+    logger.info(f"Total events aggregated: {aggregator.event_count}")
 
-            domain_analysis[domain] = {
-                'visit_count': count,  # Changed from block_count to visit_count to match React component
-                'unique_ips': unique_ips,
-                'unique_hosts': domain_hosts,
-                'first_seen': min(timestamps).isoformat(),
-                'last_seen': max(timestamps).isoformat(),
-                'policy_name': domain_events[0].get('policy_name', 'Unknown'),
-                'rule_name': domain_events[0].get('rule_name', 'Unknown')
-            }
+    domain_analysis, visualization_data = aggregator.result(top_n=top_n)
 
-            # Update totals
-            total_blocks += count
-            unique_hosts.update(e['host_name'] for e in domain_events)
+    response_body = {
+        'analysis': domain_analysis,
+        'visualization_data': visualization_data,
+        'generated_at': datetime.now(pytz.UTC).isoformat()
+    }
+    if rollup_summary is not None:
+        response_body['rollup'] = rollup_summary
+    return response_body
 
-            # Group by date for timeline
-            for timestamp in timestamps:
-                date_str = timestamp.date().isoformat()
-                daily_blocks[date_str] += 1
 
-        # Prepare visualization data to match what the React component expects
-        visualization_data = {
-            'bar_chart': {
-                'domains': [domain for domain, _ in top_domains],
-                'visits': [count for _, count in top_domains]  # Changed from 'counts' to 'visits'
-            },
-            'comparison_chart': {  # Changed from 'timeline' to 'comparison_chart'
-                'domains': [domain for domain, _ in top_domains[:10]],
-                'visits': [count for _, count in top_domains[:10]],
-                'unique_ips': [domain_analysis[domain]['unique_ips'] for domain, _ in top_domains[:10]]
-            },
-            'summary': {
-                'total_blocks': total_blocks,
-                'unique_domains': len(domain_analysis),
-                'unique_hosts': len(unique_hosts)
-            }
-        }
+@FUNC.handler(method='GET', path='/domain-analytics')
+def get_domain_analytics(request: Request, __: [dict[str, any], None], logger: Logger) -> Response:
+    """Generate analytics for domain blocking events.
+
+    Query parameters: days (window, default 15), top (number of domains,
+    default 20), source (rollup or live), mode (exact or approximate) and
+    refresh=true to bypass the response cache. By default events are merged into persistent per-day
+    rollups and only those newer than the stored watermark are fetched.
+    Results are cached for ANALYTICS_CACHE_TTL seconds and served stale
+    for ANALYTICS_CACHE_GRACE more while a background refresh runs.
+    """
+    logger.info("Starting domain analytics handler")
+    try:
+        source = get_query_param(request, 'source', 'rollup')
+        days = _int_param(get_query_param(request, 'days'), 15, 1, 90)
+        top_n = _int_param(get_query_param(request, 'top'), 20, 1, 100)
+        approximate = get_query_param(request, 'mode', 'exact') == 'approximate'
+        force_refresh = str(get_query_param(request, 'refresh', '')).lower() == 'true'
+
+        body, cache_status, age = _ANALYTICS_CACHE.get(
+            (source, days, top_n, approximate),
+            lambda: compute_domain_analytics(source, days, top_n, logger, approximate),
+            force_refresh=force_refresh
+        )
 
-        logger.info("Analytics processing completed successfully")
-        logger.info(f"Returning data structure: {visualization_data.keys()}")
+        logger.info(f"Analytics served ({cache_status}, age {age:.1f}s)")
 
         return Response(
             code=200,
             body={
-                'analysis': domain_analysis,
-                'visualization_data': visualization_data
+                **body,
+                'cache': {
+                    'status': cache_status,
+                    'age_seconds': round(age, 1),
+                    'ttl_seconds': _ANALYTICS_CACHE.ttl
+                }
             }
         )
 
@@ -600,137 +3125,164 @@ def get_domain_analytics(_: Request, __: [dict[str, any], None], logger: Logger)
 
 @FUNC.handler(method='GET', path='/list-categories')
 def list_categories(request: Request) -> Response:
-    """List all categories from the domain collection."""
-    try:
-        # Initialize API client
-        api_client = APIHarnessV2()
-        customobjects = CustomStorage(api_client, base_url=cloud())
-
-        # Set headers if APP_ID is available
-        # headers = {}
-        # Set headers if APP_ID is available
-        if os.environ.get("APP_ID"):
-            headers = {"X-CS-APP-ID": os.environ.get("APP_ID")}
-        else:
-            headers = {}
-
-        # Get query parameters with defaults
-        try:
-            limit = int(request.params.limit if hasattr(request.params, 'limit') else 1000)
-        except (ValueError, AttributeError):
-            limit = 1000
-
-        print(f"Query params - limit: {limit}")  # Debug logging
+    """List one page of categories from the domain collection.
 
-        # Query the collection using list method
-        response = customobjects.ListObjectsByVersion(
-            collection_name='domain',
-            limit=limit,
-            collection_version="v2.0"
+    `limit` categories per page and the `cursor` returned as `nextCursor`
+    by the previous page. `fields` projects each category: 'category' for
+    names only, 'domain_count' for counts, 'category,domain' for names and
+    domains, or empty for object keys only, which skips the record reads.
+    Defaults to names and counts.
+    """
+    try:
+        # Shared API client
+        customobjects = falcon_service(CustomStorage)
+
+        limit = _int_param(get_query_param(request, 'limit'), LIST_CATEGORIES_LIMIT, 1, LIST_CATEGORIES_MAX_LIMIT)
+        cursor = get_query_param(request, 'cursor') or None
+        fields = get_query_param(request, 'fields')
+        fields, unknown = parse_fields(
+            "category,domain_count" if fields is None else fields, CATEGORY_FIELDS + ("domain_count",)
         )
+        if unknown:
+            return Response(code=400, errors=[APIError(code=400, message=f"Unknown fields: {', '.join(unknown)}")])
 
-        print("Raw API Response:", response)  # Debug logging
-
-        # More detailed error checking
-        if not response:
-            return Response(
-                code=500,
-                errors=[APIError(code=500, message="No response received from API")]
-            )
-
-        if "errors" in response:
-            return Response(
-                code=400,
-                errors=[APIError(code=400, message=f"API Error: {response['errors']}")]
-            )
-
-        # Extract resources from response
-        resources = response.get('resources', [])
-        print(f"Found {len(resources)} resources")  # Debug logging
+        # One key past the page tells whether another page follows
+        keys = list_collection_page(customobjects, "domain", "v2.0", start=cursor, limit=limit + 2)
+        next_cursor = keys[limit - 1] if len(keys) > limit else None
+        keys = keys[:limit]
 
-        # Extract unique categories
-        categories = set()
         domains = []
+        if fields:
+            records = get_collection_objects(customobjects, "domain", keys)
+            for key in keys:
+                record = records.get(key)
+                if record is None:
+                    continue
+                item = project_record(key, record, fields)
+                if "domain_count" in fields:
+                    item["domain_count"] = len(split_domain_entries(record.get("domain", "")))
+                domains.append(item)
+        else:
+            domains = [{"object_key": key} for key in keys]
 
-        for item in resources:
-            try:
-                if item and isinstance(item, dict):
-                    if item.get('category'):
-                        categories.add(item['category'])
-                    domains.append({
-                        'category': item.get('category', ''),
-                        'domain': item.get('domain', ''),
-                        'wildcard_domain': item.get('wildcard_domain', '')
-                    })
-            except Exception as e:
-                print(f"Error processing item: {e}")
-                continue
-
-        # Prepare response data
-        response_data = {
-            "total_items": len(resources),
-            "unique_categories": len(categories),
-            "categories": sorted(list(categories)),
-            "domains": domains,
-            "metadata": {
-                "limit": limit,
-                "timestamp": int(time.time())
-            }
-        }
-
-        print(f"Processed response data: {response_data}")  # Debug logging
-
+        categories = {item.get("category") or item["object_key"] for item in domains}
         return Response(
-            body=response,
+            body={
+                "total_items": len(domains),
+                "unique_categories": len(categories),
+                "categories": sorted(categories),
+                "domains": domains,
+                "pagination": {
+                    "limit": limit,
+                    "cursor": cursor,
+                    "nextCursor": next_cursor
+                },
+                "metadata": {
+                    "limit": limit,
+                    "fields": fields,
+                    "timestamp": int(time.time())
+                }
+            },
             code=200
         )
 
     except Exception as e:
-        print(f"Error occurred: {str(e)}")  # Debug logging
         return Response(
             code=500,
             errors=[APIError(code=500, message=f"Error querying collection: {str(e)}")]
         )
 
 
-@FUNC.handler(method='GET', path='/search-categories')
-def search_categories(request: Request) -> Response:
-    """Search for categories in the domain collection."""
-    try:
-        # Initialize API client
-        api_client = APIHarnessV2()
-        customobjects= CustomStorage(api_client, base_url=cloud())
+def request_value(request, name, default=None):
+    """Return a query string parameter, falling back to the JSON body."""
+    value = get_query_param(request, name)
+    if value is None and isinstance(request.body, dict):
+        value = request.body.get(name)
+    return default if value is None else value
 
-        # Set headers if APP_ID is available
-        headers = {}
-        if os.environ.get("APP_ID"):
-            headers = {"X-CS-APP-ID": os.environ.get("APP_ID")}
 
-        # Get search parameters from request body
-        body = request.body or {}
-        limit = int(body.get('limit', 1000))
-        category = body.get('category', '')
+def search_page(customobjects, collection_name, collection_version, fql_filter, request, fields, keep=None):
+    """Run a cursor-paged indexed search for a handler and build its response body.
+
+    The cursor is the offset of the next page. Records are only fetched
+    when the `fields` projection asks for more than the object keys or
+    `keep(record)` has to confirm a match.
+    """
+    limit = _int_param(request_value(request, 'limit'), SEARCH_DEFAULT_LIMIT, 1, SEARCH_MAX_LIMIT)
+    offset = _int_param(request_value(request, 'cursor'), 0, 0, 2 ** 31)
+    keys, total = search_collection(
+        customobjects, collection_name, collection_version, fql_filter,
+        limit=limit, offset=offset, sort=request_value(request, 'sort')
+    )
+    if fields or keep is not None:
+        records = get_collection_objects(customobjects, collection_name, keys)
+        resources = [
+            project_record(key, records[key], fields) for key in keys
+            if key in records and (keep is None or keep(records[key]))
+        ]
+    else:
+        resources = [{"object_key": key} for key in keys]
+    next_offset = offset + len(keys)
+    return {
+        "resources": resources,
+        "filter": fql_filter,
+        "pagination": {
+            "limit": limit,
+            "cursor": str(offset),
+            "nextCursor": str(next_offset) if keys and next_offset < total else None,
+            "total": total
+        }
+    }
 
-        print(f"Search params - category: {category}, limit: {limit}")  # Debug logging
 
-        # Query the collection using list method with filter
-        response = api_client.command("GetObject",
-            collection_name="domain",
-            limit=1000,
-            collection_version="v2.0",
-            object_key="Games",
-            headers=headers
-        )
+@FUNC.handler(method='GET', path='/search-categories')
+def search_categories(request: Request) -> Response:
+    """Search the domain collection with an indexed FQL query.
+
+    `category` matches a category exactly and `domain` finds the
+    categories listing that domain. `contains` matches a fragment of any
+    listed domain. Results are paged with `limit` and `cursor` and
+    projected with `fields` ('category', 'domain', ...; empty for keys
+    only).
+    """
+    try:
+        customobjects = falcon_service(CustomStorage)
 
-        print("Raw Search Response:", response)  # Debug logging
+        category = request_value(request, 'category')
+        domain = request_value(request, 'domain')
+        fragment = request_value(request, 'contains')
+        if not (category or domain or fragment):
+            return Response(
+                code=400,
+                errors=[APIError(code=400, message="One of category, domain or contains is required")]
+            )
 
-        return Response(
-            body=response,
-            code=200
+        fields, unknown = parse_fields(request_value(request, 'fields'), CATEGORY_FIELDS)
+        if unknown:
+            return Response(code=400, errors=[APIError(code=400, message=f"Unknown fields: {', '.join(unknown)}")])
+
+        exact = {"category": category} if category else {}
+        contains = {}
+        keep = None
+        if domain:
+            wanted = normalize_domain(str(domain))
+            if wanted is None:
+                return Response(code=400, errors=[APIError(code=400, message=f"Invalid domain: {domain}")])
+            # The index holds the joined list, so confirm the whole entry matched and not just a fragment
+            contains["domain"] = wanted
+
+            def lists_domain(record):
+                return wanted in split_domain_entries(record.get("domain", ""))
+            keep = lists_domain
+        elif fragment:
+            contains["domain"] = str(fragment).strip().lower()
+
+        body = search_page(
+            customobjects, "domain", "v2.0", build_fql_filter(exact, contains), request, fields, keep=keep
         )
+        return Response(body=body, code=200)
 
     except Exception as e:
-        print(f"Search error occurred: {str(e)}")  # Debug logging
         return Response(
             code=500,
             errors=[APIError(code=500, message=f"Error searching collection: {str(e)}")]
@@ -748,6 +3300,8 @@ def manage_category(request: Request, _: [dict[str, any], None], logger: Logger)
 
         category_name = request.body.get('categoryName', '').strip()
         urls = request.body.get('urls', '').strip()
+        # Existing records are addressed by their key, which need not be derived from the name
+        object_key = str(request.body.get('key') or category_name.replace(' ', '_')).strip()
 
         logger.info(f"Processing category: {category_name}")
 
@@ -756,18 +3310,19 @@ def manage_category(request: Request, _: [dict[str, any], None], logger: Logger)
         if not urls:
             return Response(code=400, body={"error": "URLs are required"})
 
-        # Initialize API client
-        api_client = APIHarnessV2(debug=True)
-        customobjects = CustomStorage(api_client, base_url=cloud())
-
-        # Process comma-separated URLs and add wildcards
-        url_list = []
-        for url in urls.split(','):
-            url = url.strip()
-            if url:
-                url_list.append(url)
-                if not url.startswith('*'):
-                    url_list.append(f"*{url}")
+        # Shared API client
+        customobjects = falcon_service(CustomStorage)
+
+        # Normalize the comma-separated URLs and pair each domain with its wildcard
+        domains, rejected = normalize_domain_list(urls)
+        paired = []
+        for domain in domains:
+            paired.append(domain)
+            if not domain.startswith('*'):
+                paired.append(f"*{domain}")
+        url_list, _ = normalize_domain_list(paired)
+        if not url_list:
+            return Response(code=400, body={"error": "No valid domains provided", "rejected": rejected})
 
         logger.info(f"Processed {len(url_list)} URLs for category {category_name}")
 
@@ -785,11 +3340,12 @@ def manage_category(request: Request, _: [dict[str, any], None], logger: Logger)
                 body=record,
                 collection_name="domain",
                 collection_version="v2.0",
-                object_key=category_name.replace(' ', '_'), ##removed .lower()
+                object_key=object_key, ##removed .lower()
                 limit=1000
             )
 
             if response.get('status_code') == 200:
+                apply_category_writes({category_name: record["domain"]})
                 logger.info(f"Successfully processed category: {category_name}")
                 return Response(
                     code=200,
@@ -798,10 +3354,12 @@ def manage_category(request: Request, _: [dict[str, any], None], logger: Logger)
                         "message": "Category processed successfully",
                         "operation": "create",
                         "categoryName": category_name,
-                        "urlCount": len(url_list)
+                        "urlCount": len(url_list),
+                        "rejected": rejected
                     }
                 )
 
+            mark_category_data_changed()
             logger.error(f"Failed to process category. API Response: {response}")
             return Response(
                 code=500,
@@ -840,9 +3398,8 @@ def manage_relationship(request: Request, _: [dict[str, any], None], logger: Log
     logger.info(f"Request body: {request.body}")
 
     try:
-        # Initialize API client
-        api_client = APIHarnessV2(debug=True)
-        customobjects = CustomStorage(api_client, base_url=cloud())
+        # Shared API client
+        customobjects = falcon_service(CustomStorage)
 
         # Extract data directly from request body
         relationship_record = {
@@ -871,7 +3428,10 @@ def manage_relationship(request: Request, _: [dict[str, any], None], logger: Log
             )
 
         # Generate unique key
-        relationship_key = f"{relationship_record['category_name']}_{relationship_record['rule_group_id']}_{relationship_record['host_group_id']}"
+        relationship_key = make_relationship_key(
+            relationship_record['category_name'], relationship_record['rule_group_id'],
+            relationship_record['host_group_id']
+        )
 
         logger.info(f"Creating relationship with key: {relationship_key}")
         logger.info(f"Relationship record: {relationship_record}")
@@ -927,76 +3487,116 @@ def manage_relationship(request: Request, _: [dict[str, any], None], logger: Log
             }
         )
 
-@FUNC.handler(method='GET', path='/get-relationship')
-def get_relationship(_: Request, __: [dict[str, any], None], logger: Logger) -> Response:
-    """Get all relationship and format for graph visualization."""
-    try:
-        api_client = APIHarnessV2(debug=True)
-        customobjects = CustomStorage(api_client, base_url=cloud())
-
-        response = customobjects.ListObjectsByVersion(
-            collection_name="relationship",
-            collection_version="v5.0",
-            limit=1000
-        )
-
-        if response.get('status_code') != 200:
-            raise ValueError("Failed to fetch relationship")
-
-        relationship = response.get('resources', [])
+def iter_relationships(customobjects, start=None, page_size=RELATIONSHIP_PAGE_SIZE):
+    """Yield (key, record) for relationships after the `start` key, one page in memory at a time."""
+    while True:
+        keys = list_collection_page(customobjects, "relationship", "v5.0", start, page_size)
+        records = get_collection_objects(customobjects, "relationship", keys)
+        for key in keys:
+            if key in records:
+                yield key, records[key]
+        if not keys or len(keys) < page_size - 1:
+            return
+        start = keys[-1]
+
+
+class RelationshipGraph:
+    """Category -> rule group -> host group graph, assembled one relationship at a time."""
+
+    def __init__(self):
+        self.nodes = []
+        self.links = []
+        self._node_ids = set()
+        self._link_ids = set()
+
+    def _add_node(self, node_id, name, node_type):
+        if node_id not in self._node_ids:
+            self._node_ids.add(node_id)
+            self.nodes.append({"id": node_id, "name": name, "type": node_type})
+
+    def _add_link(self, source, target):
+        if (source, target) not in self._link_ids:
+            self._link_ids.add((source, target))
+            self.links.append({"source": source, "target": target})
+
+    def add(self, rel):
+        """Add the nodes and links of one relationship record."""
+        self._add_node(rel['category_name'], rel['category_name'], "category")
+        self._add_node(rel['rule_group_id'], rel.get('rule_group_name', ''), "rule_group")
+        self._add_node(rel['host_group_id'], rel.get('host_group_name', ''), "host_group")
+        self._add_link(rel['category_name'], rel['rule_group_id'])
+        self._add_link(rel['rule_group_id'], rel['host_group_id'])
+
+    def to_dict(self):
+        """Return the graph as the nodes/links body the UI renders."""
+        return {"nodes": self.nodes, "links": self.links}
 
-        # Transform data for graph visualization
-        nodes = []
-        links = []
-        nodes_set = set()
 
-        for rel in relationship:
-            # Add category node
-            if rel['category_name'] not in nodes_set:
-                nodes_set.add(rel['category_name'])
-                nodes.append({
-                    "id": rel['category_name'],
-                    "name": rel['category_name'],
-                    "type": "category"
-                })
-
-            # Add rule group node
-            if rel['rule_group_id'] not in nodes_set:
-                nodes_set.add(rel['rule_group_id'])
-                nodes.append({
-                    "id": rel['rule_group_id'],
-                    "name": rel['rule_group_name'],
-                    "type": "rule_group"
-                })
-
-            # Add host group node
-            if rel['host_group_id'] not in nodes_set:
-                nodes_set.add(rel['host_group_id'])
-                nodes.append({
-                    "id": rel['host_group_id'],
-                    "name": rel['host_group_name'],
-                    "type": "host_group"
-                })
-
-            # Add links
-            links.append({
-                "source": rel['category_name'],
-                "target": rel['rule_group_id']
-            })
-            links.append({
-                "source": rel['rule_group_id'],
-                "target": rel['host_group_id']
-            })
+@FUNC.handler(method='GET', path='/get-relationship')
+def get_relationship(request: Request, __: [dict[str, any], None], logger: Logger) -> Response:
+    """Get one page of relationships, optionally filtered, formatted for graph visualization.
+
+    Query parameters: `limit` relationships per page, the `cursor` returned
+    as `nextCursor` by the previous page, and `category_name`,
+    `rule_group_id` or `host_group_id` to return a subgraph. A subgraph
+    page is one indexed search of up to SEARCH_MAX_LIMIT matches. The full
+    graph is read a key page at a time, scanning at most
+    RELATIONSHIP_SCAN_LIMIT keys per request.
+    """
+    try:
+        customobjects = falcon_service(CustomStorage)
+
+        limit = _int_param(get_query_param(request, 'limit'), RELATIONSHIP_GRAPH_LIMIT, 1, RELATIONSHIP_GRAPH_MAX_LIMIT)
+        cursor = get_query_param(request, 'cursor') or None
+        filters = {name: get_query_param(request, name) for name in RELATIONSHIP_FILTERS}
+        filters = {name: value for name, value in filters.items() if value}
+
+        relationship = []
+        graph = RelationshipGraph()
+        scanned = 0
+        next_cursor = None
+        if filters:
+            # A subgraph is one indexed query; its cursor is the search offset
+            offset = _int_param(cursor, 0, 0, 2 ** 31)
+            keys, total = search_collection(
+                customobjects, "relationship", "v5.0", build_fql_filter(filters),
+                limit=min(limit, SEARCH_MAX_LIMIT), offset=offset
+            )
+            records = get_collection_objects(customobjects, "relationship", keys)
+            matches = ((key, records[key]) for key in keys if key in records)
+            scanned = len(keys)
+            if keys and offset + len(keys) < total:
+                next_cursor = str(offset + len(keys))
+        else:
+            matches = iter_relationships(customobjects, start=cursor)
+
+        for key, rel in matches:
+            if not all(rel.get(name) for name in RELATIONSHIP_FILTERS):
+                logger.warning(f"Skipping incomplete relationship {key}")
+            elif all(rel.get(name) == value for name, value in filters.items()):
+                relationship.append(rel)
+                graph.add(rel)
+            if filters:
+                continue
+            scanned += 1
+            if len(relationship) >= limit or scanned >= RELATIONSHIP_SCAN_LIMIT:
+                next_cursor = key
+                break
 
+        logger.info(f"Scanned {scanned} relationships, returning {len(relationship)}")
         return Response(
             code=200,
             body={
                 "success": True,
                 "relationship": relationship,
-                "graphData": {
-                    "nodes": nodes,
-                    "links": links
-                }
+                "graphData": graph.to_dict(),
+                "pagination": {
+                    "limit": limit,
+                    "cursor": cursor,
+                    "nextCursor": next_cursor,
+                    "scanned": scanned
+                },
+                "filters": filters
             }
         )
 
@@ -1019,8 +3619,445 @@ def get_relationship(_: Request, __: [dict[str, any], None], logger: Logger) ->
             }
         )
 
+@FUNC.handler(method='GET', path='/search-relationships')
+def search_relationships(request: Request, __: [dict[str, any], None], logger: Logger) -> Response:
+    """Find relationships by category, rule group or host group with one indexed FQL query."""
+    try:
+        exact = {name: request_value(request, name) for name in RELATIONSHIP_FILTERS}
+        exact = {name: value for name, value in exact.items() if value}
+        if not exact:
+            return Response(
+                code=400,
+                body={"error": f"One of {', '.join(RELATIONSHIP_FILTERS)} is required"}
+            )
+
+        fields, unknown = parse_fields(request_value(request, 'fields'), RELATIONSHIP_FIELDS)
+        if unknown:
+            return Response(code=400, body={"error": "Unknown fields", "unknown_fields": unknown})
+
+        body = search_page(
+            falcon_service(CustomStorage), "relationship", "v5.0", build_fql_filter(exact), request, fields
+        )
+        logger.info(f"Relationship search {body['filter']} returned {len(body['resources'])} results")
+        return Response(code=200, body=body)
+
+    except Exception as e:
+        logger.error(f"Unexpected error: {str(e)}")
+        return Response(code=500, body={"error": "Failed to search relationships", "details": str(e)})
+
 #Updates rules
 
+def _get_by_id(operation, ids):
+    """Fetch entities with as few multi-ID calls as possible, returning {id: entity}."""
+    entities = {}
+    unique_ids = list(dict.fromkeys(ids))
+    for offset in range(0, len(unique_ids), RULE_GROUP_LOOKUP_CHUNK):
+        response, _ = call_with_retry(operation, ids=unique_ids[offset:offset + RULE_GROUP_LOOKUP_CHUNK])
+        if _response_status(response) != 200:
+            raise ValueError("Error getting group details")
+        for entity in response["body"].get("resources") or []:
+            entities[entity["id"]] = entity
+    return entities
+
+
+def get_rule_groups_by_id(firewall_mgmt, rule_group_ids):
+    """Fetch rule group details with as few multi-ID get_rule_groups calls as possible."""
+    return _get_by_id(firewall_mgmt.get_rule_groups, rule_group_ids)
+
+
+def get_rules_by_id(firewall_mgmt, rule_ids):
+    """Fetch rule details (fqdn, version, ...) with as few multi-ID get_rules calls as possible."""
+    return _get_by_id(firewall_mgmt.get_rules, rule_ids)
+
+
+def is_tracking_conflict(response):
+    """Return True if a rule group update was rejected because its tracking value is stale."""
+    if not isinstance(response, dict):
+        return False
+    if _response_status(response) == 409:
+        return True
+    errors = (response.get("body") or {}).get("errors") or []
+    return any("tracking" in str(error.get("message", "")).lower() for error in errors)
+
+
+def _rule_domains(rule):
+    """Return the normalized FQDN list of a deployed rule."""
+    fqdn = rule.get("fqdn") or ""
+    return normalize_domain_list(fqdn)[0] if rule.get("fqdn_enabled", bool(fqdn)) else []
+
+
+def _matches_any_address(addresses):
+    """Return True for an address list that only holds the '*' wildcard."""
+    return all(item.get("address") == "*" for item in addresses or [{"address": "*"}])
+
+
+def _is_unscoped(rule):
+    """Return True if a rule applies to every process, address and protocol, like build_fqdn_rule.
+
+    Rules narrowed by a process or other field, a local or remote address,
+    an address family, a direction or a protocol only block their domains
+    within that scope.
+    """
+    template = build_fqdn_rule("", "", [], "")
+    return (rule.get("direction", template["direction"]) == template["direction"]
+            and rule.get("address_family", template["address_family"]) == template["address_family"]
+            and rule.get("protocol", template["protocol"]) == template["protocol"]
+            and _matches_any_address(rule.get("local_address"))
+            and _matches_any_address(rule.get("remote_address"))
+            and not any(field.get("value") or field.get("values") for field in rule.get("fields") or []))
+
+
+def _is_blocking_rule(rule):
+    """Return True for an enabled, unscoped rule that denies its FQDNs everywhere."""
+    return (rule.get("enabled", True) and rule.get("action") == "DENY" and bool(_rule_domains(rule))
+            and _is_unscoped(rule))
+
+
+def _is_plain_domain_rule(rule):
+    """Return True for a blocking rule shaped like build_fqdn_rule, whose fqdn list can be edited freely.
+
+    Besides the scope, logging and monitoring have to match the template,
+    so extending or merging such rules never changes what gets logged.
+    """
+    template = build_fqdn_rule("", "", [], "")
+    monitor = rule.get("monitor") or template["monitor"]
+    return (_is_blocking_rule(rule) and bool(rule.get("log", template["log"])) == template["log"]
+            and all(str(monitor.get(key)) == value for key, value in template["monitor"].items()))
+
+
+def _fits(domains, max_domains, max_length):
+    return len(domains) <= max_domains and len(';'.join(domains)) <= max_length
+
+
+def _merge_small_rules(slots, max_domains, max_length):
+    """Fold editable domain rules below RULE_MERGE_THRESHOLD into each other; return how many were removed."""
+    merged = 0
+    small = [slot for slot in slots if slot["editable"] and len(slot["domains"]) <= RULE_MERGE_THRESHOLD]
+    while len(small) > 1:
+        keeper = small.pop(0)
+        for slot in list(small):
+            domains = keeper["domains"] + slot["domains"]
+            if _fits(domains, max_domains, max_length):
+                keeper["domains"] = sorted(domains, key=domain_sort_key)
+                keeper["changed"] = True
+                slot["removed"] = True
+                small.remove(slot)
+                merged += 1
+    return merged
+
+
+def plan_rule_group_patch(rule_ids, rules_by_id, new_domains, category_name,
+                          max_domains=RULE_MAX_DOMAINS, max_length=RULE_MAX_FQDN_LENGTH):
+    """Plan the smallest update_rule_group patch that makes a group block new_domains.
+
+    Domains already blocked (exactly or by a wildcard) by an enabled,
+    unscoped DENY rule are skipped. The rest are added to the smallest
+    existing domain rule with room for them, or to new rules sharded like
+    create-rule. Domain rules below RULE_MERGE_THRESHOLD are then folded
+    together, so repeated small edits do not keep growing the rule count.
+    Only rules shaped like build_fqdn_rule are edited, merged or removed.
+
+    Returns None when there is nothing to add, else a dict with the
+    diff_operations, rule_ids and rule_versions to send and a summary.
+    """
+    slots = []
+    deployed = []
+    for index, rule_id in enumerate(rule_ids):
+        rule = rules_by_id.get(rule_id, {})
+        slots.append({
+            "index": index,
+            "id": rule_id,
+            "version": rule.get("version", 1),
+            "domains": _rule_domains(rule),
+            "editable": _is_plain_domain_rule(rule),
+            "changed": False,
+            "removed": False
+        })
+        if _is_blocking_rule(rule):
+            deployed.extend(slots[-1]["domains"])
+
+    deployed_set = set(deployed)
+    combined = set(normalize_domain_list(deployed + list(new_domains))[0])
+    missing = [domain for domain in new_domains if domain in combined and domain not in deployed_set]
+    if not missing:
+        return None
+
+    # Extend the smallest domain rule that has room, else add new rules
+    new_rules = []
+    candidates = sorted(
+        (slot for slot in slots if slot["editable"] and _fits(slot["domains"] + missing, max_domains, max_length)),
+        key=lambda slot: len(slot["domains"])
+    )
+    if candidates:
+        target = candidates[0]
+        target["domains"] = sorted(target["domains"] + missing, key=domain_sort_key)
+        target["changed"] = True
+        action = "extended"
+    else:
+        temp_id = str(int(time.time()))
+        for number, shard in enumerate(shard_domains(missing, max_domains, max_length), start=1):
+            new_rules.append(build_fqdn_rule(
+                name=f"{category_name}_rule_{temp_id}_{number}",
+                description=f"Domain blocking rule for {category_name} (Added: {datetime.now().isoformat()})",
+                domains=shard,
+                temp_id=f"{temp_id}_{number}"
+            ))
+        action = "added"
+
+    merged = _merge_small_rules(slots, max_domains, max_length)
+
+    # Replacements first (indexes unchanged), then removals from the end, then additions
+    diff_operations = [
+        {"op": "replace", "path": f"/rules/{slot['index']}/fqdn", "value": ';'.join(slot["domains"])}
+        for slot in slots if slot["changed"] and not slot["removed"]
+    ]
+    diff_operations.extend(
+        {"op": "remove", "path": f"/rules/{slot['index']}"}
+        for slot in reversed(slots) if slot["removed"]
+    )
+    kept = [slot for slot in slots if not slot["removed"]]
+    diff_operations.extend(
+        {"op": "add", "path": f"/rules/{len(kept) + offset}", "value": rule}
+        for offset, rule in enumerate(new_rules)
+    )
+
+    return {
+        "diff_operations": diff_operations,
+        "replaced": {slot["id"]: ';'.join(slot["domains"]) for slot in kept if slot["changed"]},
+        "rules_added": len(new_rules),
+        "rule_ids": [slot["id"] for slot in kept] + [rule["temp_id"] for rule in new_rules],
+        "rule_versions": [slot["version"] for slot in kept] + [1] * len(new_rules),
+        "summary": {
+            "action": action,
+            "added_domains": missing,
+            "already_deployed": len(new_domains) - len(missing),
+            "rules_added": len(new_rules),
+            "rules_merged": merged,
+            "rule_count": len(kept) + len(new_rules)
+        }
+    }
+
+
+def plan_append_patch(rule_ids, rules_by_id, new_domains, category_name):
+    """Plan the legacy patch that appends one rule holding new_domains, whatever is deployed.
+
+    The deployed rules keep the versions held in rules_by_id.
+    """
+    temp_id = str(int(time.time()))
+    new_rule = build_fqdn_rule(
+        name=f"{category_name}_rule_{temp_id}",
+        description=f"Domain blocking rule for {category_name} (Added: {datetime.now().isoformat()})",
+        domains=new_domains,
+        temp_id=temp_id
+    )
+    return {
+        "diff_operations": [{"value": new_rule, "op": "add", "path": f"/rules/{len(rule_ids)}"}],
+        "replaced": {},
+        "rules_added": 1,
+        "rule_ids": list(rule_ids) + [temp_id],
+        "rule_versions": [rules_by_id.get(rule_id, {}).get("version", 1) for rule_id in rule_ids] + [1],
+        "summary": {
+            "action": "added",
+            "added_domains": list(new_domains),
+            "already_deployed": 0,
+            "rules_added": 1,
+            "rules_merged": 0,
+            "rule_count": len(rule_ids) + 1
+        }
+    }
+
+
+def store_rule_group_state(group, rules):
+    """Cache a rule group's details and its rules, keyed by the group's tracking value."""
+    state = {
+        "tracking": group.get("tracking"),
+        "group": group,
+        "rules": {rule_id: rules[rule_id] for rule_id in group.get("rule_ids") or [] if rule_id in rules},
+        "stored_at": time.monotonic()
+    }
+    with _RULE_GROUP_STATES_LOCK:
+        _RULE_GROUP_STATES[group["id"]] = state
+    return state
+
+
+def invalidate_rule_group_state(rule_group_id):
+    """Drop the cached state of a rule group."""
+    with _RULE_GROUP_STATES_LOCK:
+        _RULE_GROUP_STATES.pop(rule_group_id, None)
+
+
+def record_rule_group_update(state, plan, response):
+    """Update the cached state of a group from a successful update_rule_group.
+
+    The patched fqdn lists and rule order are applied locally and changed
+    rules get their version bumped. If the response carries the updated
+    group, its tracking value is adopted; otherwise the state is kept
+    without one and is revalidated by a single get_rule_groups call on
+    the next edit. States for patches that added rules are dropped, since
+    the new rules' IDs are only known to the API.
+    """
+    group_id = state["group"]["id"]
+    if plan["rules_added"]:
+        invalidate_rule_group_state(group_id)
+        return
+    resources = response.get("body", {}).get("resources") or []
+    entity = next((item for item in resources if isinstance(item, dict) and item.get("tracking")), None)
+
+    rules = {}
+    for rule_id in plan["rule_ids"]:
+        rule = dict(state["rules"].get(rule_id, {}))
+        if rule_id in plan["replaced"]:
+            rule["fqdn"] = plan["replaced"][rule_id]
+            rule["version"] = rule.get("version", 1) + 1
+        rules[rule_id] = rule
+    group = dict(state["group"], rule_ids=plan["rule_ids"], tracking=entity["tracking"] if entity else None)
+    store_rule_group_state(group, rules)
+
+
+def load_rule_group_states(firewall_mgmt, rule_group_ids):
+    """Return {group_id: state} for update-rules, reading as little as possible.
+
+    Fresh cached states with a known tracking value are used as they are;
+    a stale tracking value surfaces as a conflict and is refreshed then.
+    Cached states whose tracking is unknown are revalidated with one
+    batched get_rule_groups call and keep their rules if the group's rule
+    IDs did not change. Everything else is read with batched
+    get_rule_groups and get_rules calls and cached.
+    """
+    now = time.monotonic()
+    states = {}
+    cached = {}
+    with _RULE_GROUP_STATES_LOCK:
+        for group_id in dict.fromkeys(rule_group_ids):
+            state = _RULE_GROUP_STATES.get(group_id)
+            if state and now - state["stored_at"] < RULE_GROUP_STATE_TTL:
+                cached[group_id] = state
+    for group_id, state in cached.items():
+        if state["tracking"]:
+            states[group_id] = dict(state, source="cache")
+
+    unresolved = [group_id for group_id in dict.fromkeys(rule_group_ids) if group_id not in states]
+    if not unresolved:
+        return states
+
+    to_read = []
+    for group_id, group in get_rule_groups_by_id(firewall_mgmt, unresolved).items():
+        state = cached.get(group_id)
+        if state and (group.get("rule_ids") or []) == (state["group"].get("rule_ids") or []):
+            states[group_id] = dict(store_rule_group_state(group, state["rules"]), source="revalidated")
+        else:
+            to_read.append(group)
+
+    rules = get_rules_by_id(firewall_mgmt, [rule_id for group in to_read for rule_id in group.get("rule_ids") or []])
+    for group in to_read:
+        states[group["id"]] = dict(store_rule_group_state(group, rules), source="read")
+    return states
+
+
+def refresh_rule_group_state(firewall_mgmt, rule_group_id):
+    """Re-read a rule group and its rules after a conflict and cache them."""
+    group = get_rule_groups_by_id(firewall_mgmt, [rule_group_id]).get(rule_group_id)
+    if group is None:
+        invalidate_rule_group_state(rule_group_id)
+        raise ValueError("Error getting group details")
+    rules = get_rules_by_id(firewall_mgmt, group.get("rule_ids") or [])
+    return dict(store_rule_group_state(group, rules), source="read")
+
+
+def patch_rule_group(firewall_mgmt, rule_group_id, state, category_name, new_domains, mode, logger):
+    """Apply the planned patch to a rule group, re-reading it on tracking conflicts.
+
+    `state` holds the group details and its rules by ID (see
+    load_rule_group_states). A failed update built from a cached state is
+    retried once from a fresh read as well. Returns (update_response,
+    summary, attempts); update_response is None when every domain was
+    already deployed.
+    """
+    attempt = 1
+    while True:
+        rule_ids = state["group"].get("rule_ids", []) or []
+        if mode == "append":
+            plan = plan_append_patch(rule_ids, state["rules"], new_domains, category_name)
+        else:
+            plan = plan_rule_group_patch(rule_ids, state["rules"], new_domains, category_name)
+        if plan is None:
+            return None, {"action": "none", "added_domains": [], "already_deployed": len(new_domains),
+                          "rules_added": 0, "rules_merged": 0, "rule_count": len(rule_ids)}, attempt
+
+        update_response, _ = call_with_retry(
+            firewall_mgmt.update_rule_group,
+            id=rule_group_id,
+            diff_type="application/json-patch+json",
+            diff_operations=plan["diff_operations"],
+            rule_ids=plan["rule_ids"],
+            rule_versions=plan["rule_versions"],
+            comment=f"Adding new domains for {category_name}",
+            tracking=state["group"]["tracking"]
+        )
+        status = _response_status(update_response)
+        if status == 200:
+            record_rule_group_update(state, plan, update_response)
+            return update_response, plan["summary"], attempt
+        stale = is_tracking_conflict(update_response) or state.get("source") != "read"
+        if not stale or attempt > TRACKING_CONFLICT_RETRIES:
+            invalidate_rule_group_state(rule_group_id)
+            return update_response, plan["summary"], attempt
+
+        logger.info(f"Stale state for rule group {rule_group_id} (status {status}), re-reading (attempt {attempt})")
+        state = refresh_rule_group_state(firewall_mgmt, rule_group_id)
+        attempt += 1
+
+
+def _update_rule_group(firewall_mgmt, rule_group_id, states, category_name, new_domains, mode, logger):
+    """Apply the update for one rule group and return its result, without the relationship fields."""
+    try:
+        logger.info(f"Updating rule group: {rule_group_id}")
+
+        state = states.get(rule_group_id)
+        if state is None:
+            raise ValueError("Error getting group details")
+
+        update_response, summary, attempts = patch_rule_group(
+            firewall_mgmt, rule_group_id, state, category_name, new_domains, mode, logger
+        )
+
+        success = update_response is None or update_response["status_code"] == 200
+        logger.info(f"Rule group update {'successful' if success else 'failed'} for {rule_group_id}: "
+                    f"{summary['action']}")
+        return {
+            "status": "success" if success else "failed",
+            "details": {
+                "added_urls": ';'.join(summary["added_domains"]),
+                "patch": summary,
+                "state": state.get("source", "read"),
+                "attempts": attempts,
+                "response": update_response.get("body", {}) if update_response else {}
+            }
+        }
+
+    except ValueError as rule_error:
+        logger.error(f"Error updating rule group {rule_group_id}: {str(rule_error)}")
+        return {"status": "failed", "error": str(rule_error)}
+    except Exception as rule_error:
+        logger.error(f"Unexpected error updating rule group {rule_group_id}: {str(rule_error)}")
+        return {"status": "failed", "error": str(rule_error)}
+
+
+def _relationship_result(relationship, group_results):
+    """Return the results entry of one relationship from the result of its rule group."""
+    rule_group_id = relationship.get('rule_group_id')
+    result = group_results.get(rule_group_id) or {"status": "failed", "error": "Missing rule_group_id"}
+    entry = {
+        "rule_group_id": rule_group_id or 'unknown',
+        "rule_group_name": relationship.get('rule_group_name', 'unknown'),
+        "status": result["status"]
+    }
+    if "details" in result:
+        entry["details"] = dict(result["details"])
+    else:
+        entry["error"] = result["error"]
+    return entry
+
 @FUNC.handler(method='POST', path='/update-rules')
 def update_rules(request: Request, _: [dict[str, any], None], logger: Logger) -> Response:
     """Update rules in rule groups with only newly added URLs."""
@@ -1033,6 +4070,7 @@ def update_rules(request: Request, _: [dict[str, any], None], logger: Logger) ->
         category_name = request.body.get('category_name')
         new_urls = request.body.get('new_urls')  # Changed from urls to new_urls
         relationships = request.body.get('relationships', [])
+        mode = request.body.get('mode', 'diff')
 
         logger.info(f"Updating rules for category: {category_name}")
         logger.info(f"New URLs to add: {new_urls}")
@@ -1043,104 +4081,40 @@ def update_rules(request: Request, _: [dict[str, any], None], logger: Logger) ->
                 "error": "Missing required fields",
                 "required": ["category_name", "new_urls", "relationships"]
             })
-
-        # Initialize Falcon client
-        api_client = APIHarnessV2(debug=True)
-        firewall_mgmt = FirewallManagement(api_client, base_url=cloud())
-
-        # Update rules for each relationship
-        update_results = []
-        for relationship in relationships:
-            try:
-                rule_group_id = relationship['rule_group_id']
-                logger.info(f"Updating rule group: {rule_group_id}")
-
-                # Get current group details
-                group_response = firewall_mgmt.get_rule_groups(ids=[rule_group_id])
-                if group_response["status_code"] != 200:
-                    raise ValueError("Error getting group details")
-
-                group_details = group_response["body"]["resources"][0]
-                tracking_number = group_details["tracking"]
-                current_rule_ids = group_details.get("rule_ids", []) or []
-
-                # Create new rule with only the new URLs
-                new_rule = {
-                    "action": "DENY",
-                    "address_family": "NONE",
-                    "description": f"Domain blocking rule for {category_name} (Added: {datetime.now().isoformat()})",
-                    "direction": "OUT",
-                    "enabled": True,
-                    "fields": [
-                        {
-                            "name": "image_name",
-                            "value": "",
-                            "type": "windows_path",
-                            "values": []
-                        }
-                    ],
-                    "fqdn_enabled": True,
-                    "fqdn": new_urls,  # Only the new URLs
-                    "icmp": {"icmp_code": "", "icmp_type": ""},
-                    "local_address": [{"address": "*", "netmask": 0}],
-                    "log": False,
-                    "monitor": {"count": "1", "period_ms": "1000000"},
-                    "name": f"{category_name}_rule_{int(time.time())}",
-                    "protocol": "*",
-                    "remote_address": [{"address": "*", "netmask": 0}],
-                    "temp_id": str(int(time.time()))
-                }
-
-                # Prepare diff operation to add new rule
-                diff_operation = [{
-                    "value": new_rule,
-                    "op": "add",
-                    "path": f"/rules/{len(current_rule_ids)}"
-                }]
-
-                # Update rule group
-                update_response = firewall_mgmt.update_rule_group(
-                    id=rule_group_id,
-                    diff_type="application/json-patch+json",
-                    diff_operations=diff_operation,
-                    rule_ids=current_rule_ids + [new_rule["temp_id"]],
-                    rule_versions=[1] * (len(current_rule_ids) + 1),
-                    comment=f"Adding new domains for {category_name}",
-                    tracking=tracking_number
-                )
-
-                success = update_response["status_code"] == 200
-                update_results.append({
-                    "rule_group_id": rule_group_id,
-                    "rule_group_name": relationship['rule_group_name'],
-                    "status": "success" if success else "failed",
-                    "details": {
-                        "added_urls": new_urls,
-                        "response": update_response.get("body", {})
-                    }
-                })
-
-                logger.info(f"Rule group update {'successful' if success else 'failed'} for {rule_group_id}")
-
-            except ValueError as rule_error:
-                logger.error(f"Error updating rule group {relationship.get('rule_group_id', 'unknown')}: {str(rule_error)}")
-                update_results.append({
-                    "rule_group_id": relationship.get('rule_group_id', 'unknown'),
-                    "rule_group_name": relationship.get('rule_group_name', 'unknown'),
-                    "status": "failed",
-                    "error": str(rule_error)
-                })
-            except Exception as rule_error:
-                logger.error(
-                    f"Unexpected error updating rule group "
-                    f"{relationship.get('rule_group_id', 'unknown')}: {str(rule_error)}"
-                )
-                update_results.append({
-                    "rule_group_id": relationship.get('rule_group_id', 'unknown'),
-                    "rule_group_name": relationship.get('rule_group_name', 'unknown'),
-                    "status": "failed",
-                    "error": str(rule_error)
-                })
+        if mode not in ('diff', 'append'):
+            return Response(code=400, body={"error": "mode must be 'diff' or 'append'"})
+
+        new_domains, rejected = normalize_domain_list(new_urls)
+        if not new_domains:
+            return Response(code=400, body={"error": "No valid URLs provided", "rejected": rejected})
+        new_urls = ';'.join(new_domains)
+
+        # Shared Falcon client
+        firewall_mgmt = falcon_service(FirewallManagement)
+
+        # Several relationships can share a rule group; each distinct group is patched once
+        rule_group_ids = [
+            group_id for group_id in dict.fromkeys(relationship.get('rule_group_id') for relationship in relationships)
+            if group_id
+        ]
+
+        # Resolve every rule group and its deployed rules, from the cache or in batches, before fanning out
+        states = load_rule_group_states(firewall_mgmt, rule_group_ids) if rule_group_ids else {}
+
+        # Patch the rule groups concurrently
+        max_workers = _int_param(request.body.get('max_workers'), RULE_UPDATE_MAX_WORKERS, 1, RULE_UPDATE_MAX_WORKERS_LIMIT)
+        group_results = {}
+        if rule_group_ids:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(rule_group_ids))) as executor:
+                group_results = dict(zip(rule_group_ids, executor.map(
+                    lambda group_id: _update_rule_group(
+                        firewall_mgmt, group_id, states, category_name, new_domains, mode, logger
+                    ),
+                    rule_group_ids
+                )))
+
+        # One entry per relationship, in request order
+        update_results = [_relationship_result(relationship, group_results) for relationship in relationships]
 
         # Return results
         success_count = len([r for r in update_results if r['status'] == 'success'])
@@ -1150,7 +4124,9 @@ def update_rules(request: Request, _: [dict[str, any], None], logger: Logger) ->
                 "success": True,
                 "message": f"Updated {success_count} of {len(update_results)} rule groups",
                 "category": category_name,
+                "mode": mode,
                 "new_urls_added": new_urls,
+                "rejected": rejected,
                 "results": update_results
             }
         )
@@ -0,0 +1,1091 @@
+"""Tests for the urlblock function handlers and helpers."""
+# pylint: disable=missing-function-docstring
+import contextvars
+import json
+import logging
+import random
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+from crowdstrike.foundry.function import Request
+
+import main
+
+
+class LatencyCustomStorage:
+    """CustomStorage stand-in that sleeps on every call, like a remote API would."""
+
+    def __init__(self, latency=0.02, throttle_first=0):
+        self.latency = latency
+        self.throttle_first = throttle_first
+        self.objects = {}
+        self.calls = 0
+        self.active = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def PutObject(self, body, collection_name, object_key, **_):  # pylint: disable=invalid-name
+        with self._lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        time.sleep(self.latency)
+        with self._lock:
+            self.active -= 1
+            self.calls += 1
+            if self.calls <= self.throttle_first:
+                return {"status_code": 429, "headers": {}, "body": {"errors": [{"message": "throttled"}]}}
+            self.objects[(collection_name, object_key)] = body
+        return {"status_code": 200, "body": {}}
+
+
+def make_records(count):
+    """Return (row_number, record) pairs for `count` synthetic categories."""
+    return [
+        (row, main.transform_csv_row([f"Category{row}", f"site{row}.example.com;*site{row}.example.com"]))
+        for row in range(1, count + 1)
+    ]
+
+
+def handler(path, method):
+    """Return the function registered for a route."""
+    return main.FUNC._router._routes[path][method].func  # pylint: disable=protected-access
+
+
+def test_bulk_upload_keeps_ten_writes_in_flight():
+    records = make_records(200)
+    storage = LatencyCustomStorage(latency=0.02)
+
+    summary = main.bulk_upload_records(records, storage, max_workers=20)
+
+    # With every write waiting on the API, 10 concurrent writes finish 10x sooner than serial ones
+    assert summary["success_count"] == len(records)
+    assert not summary["failures"]
+    assert len(storage.objects) == len(records)
+    assert 10 <= storage.peak <= 20
+
+
+def test_bulk_upload_retries_throttled_writes():
+    records = make_records(20)
+    storage = LatencyCustomStorage(latency=0.001, throttle_first=5)
+
+    summary = main.bulk_upload_records(
+        records, storage, max_workers=4, retry_policy={"base_delay": 0.001, "max_delay": 0.01}
+    )
+
+    assert summary["success_count"] == len(records)
+    assert summary["retries"] == 5
+    assert not summary["failures"]
+
+
+@pytest.mark.parametrize("retry", [
+    {"max_attempts": "abc"},
+    {"max_attempts": 0},
+    {"base_delay": -1},
+    {"max_delay": True},
+    "fast"
+])
+def test_parse_retry_policy_rejects_invalid_values(retry):
+    with pytest.raises(ValueError):
+        main.parse_retry_policy(retry)
+
+
+def test_import_csv_rejects_invalid_retry_and_clamps_workers(monkeypatch):
+    seen = {}
+
+    def fake_process(**kwargs):
+        seen.update(kwargs)
+        return {"total_rows": 0, "success_count": 0, "error_count": 0, "failures": [],
+                "throughput": {}, "written": {}}
+
+    monkeypatch.setattr(main, "falcon_service", lambda _: LatencyCustomStorage())
+    monkeypatch.setattr(main, "process_csv_records", fake_process)
+    import_csv = handler("/import-csv", "POST")
+
+    request = Request()
+    request.body = {"retry": {"max_attempts": "abc"}}
+    assert import_csv(request, None, logging.getLogger(__name__)).code == 400
+
+    request.body = {"max_workers": "abc", "retry": {"max_attempts": "3"}}
+    assert import_csv(request, None, logging.getLogger(__name__)).code == 200
+    assert seen["max_workers"] == main.IMPORT_MAX_WORKERS
+    assert seen["retry_policy"] == {"max_attempts": 3}
+
+    request.body = {"max_workers": 10000}
+    assert import_csv(request, None, logging.getLogger(__name__)).code == 200
+    assert seen["max_workers"] == main.IMPORT_MAX_WORKERS_LIMIT
+
+
+def test_category_index_swaps_in_a_new_dict_on_change(tmp_path):
+    csv_file = tmp_path / "categories.csv"
+    csv_file.write_text("category,urls\nGames,steam.com\n", encoding="utf-8")
+    first = main.load_category_index(str(csv_file))
+    etag, categories = first["etag"], first["categories"]
+
+    csv_file.write_text("category,urls\nGames,steam.com;epicgames.com\nNews,cnn.com\n", encoding="utf-8")
+    second = main.load_category_index(str(csv_file))
+
+    assert second is not first
+    assert (first["etag"], first["categories"]) == (etag, categories)
+    assert second["etag"] != etag
+    assert set(second["categories"]) == {"Games", "News"}
+
+
+class MemoryCustomStorage:
+    """CustomStorage stand-in keeping objects in memory, with injectable write failures."""
+
+    def __init__(self):
+        self.objects = {}
+        self.failing_keys = set()
+        self.reads = Counter()
+
+    def PutObject(self, body, collection_name, object_key, **_):  # pylint: disable=invalid-name
+        if object_key in self.failing_keys:
+            return {"status_code": 400, "body": {"errors": [{"message": "write failed"}]}}
+        self.objects[(collection_name, object_key)] = json.loads(json.dumps(body))
+        return {"status_code": 200, "body": {}}
+
+    def GetObject(self, collection_name, object_key, **_):  # pylint: disable=invalid-name
+        self.reads[object_key] += 1
+        if (collection_name, object_key) not in self.objects:
+            return {"status_code": 404, "body": {}}
+        return json.dumps(self.objects[(collection_name, object_key)]).encode()
+
+    def ListObjects(self, collection_name, limit, start=None, **_):  # pylint: disable=invalid-name
+        keys = sorted(key for name, key in self.objects if name == collection_name and (not start or key > start))
+        return {"status_code": 200, "body": {"resources": keys[:limit]}}
+
+    def ListObjectsByVersion(self, collection_name, limit, start=None, **_):  # pylint: disable=invalid-name
+        return self.ListObjects(collection_name, limit, start)
+
+    def SearchObjectsByVersion(self, collection_name, filter, limit, offset=0, **_):  # pylint: disable=invalid-name,redefined-builtin
+        field, values = re.fullmatch(r"(\w+):\[(.*)\]", filter).groups()
+        wanted = set(re.findall(r"'([^']*)'", values))
+        keys = sorted(key for (name, key), record in self.objects.items()
+                      if name == collection_name and record.get(field) in wanted)
+        page = [{"object_key": key} for key in keys[offset:offset + limit]]
+        return {"status_code": 200, "body": {"resources": page, "meta": {"pagination": {"total": len(keys)}}}}
+
+    def DeleteObject(self, collection_name, object_key, **_):  # pylint: disable=invalid-name
+        self.objects.pop((collection_name, object_key), None)
+        return {"status_code": 200, "body": {}}
+
+
+class EventFirewallManagement:
+    """FirewallManagement stand-in serving events that match the timestamp bounds of the filter."""
+
+    def __init__(self, events):
+        self.events = {f"event{index}": event for index, event in enumerate(events)}
+
+    def query_events(self, parameters):
+        bounds = dict(re.findall(r"timestamp:([<>]=?)'([^']+)'", parameters["filter"]))
+        low = main.parse_event_timestamp(bounds[">="]) if ">=" in bounds else None
+        high = main.parse_event_timestamp(bounds["<"]) if "<" in bounds else None
+        ids = [
+            event_id for event_id, event in self.events.items()
+            if (low is None or main.parse_event_timestamp(event["timestamp"]) >= low)
+            and (high is None or main.parse_event_timestamp(event["timestamp"]) < high)
+        ]
+        offset = parameters.get("offset", 0)
+        return {"status_code": 200, "body": {"resources": ids[offset:offset + parameters["limit"]], "meta": {}}}
+
+    def get_events(self, ids):
+        return {"status_code": 200, "body": {"resources": [self.events[event_id] for event_id in ids]}}
+
+
+def make_event(when, domain, address="10.0.0.1", host="host1"):
+    """Return a blocked-domain firewall event at an aware datetime."""
+    return {"timestamp": when.strftime("%Y-%m-%dT%H:%M:%SZ"), "domain_name_list": domain,
+            "remote_address": address, "host_name": host, "policy_name": "policy", "rule_name": "rule"}
+
+
+def rollup_counts(storage, now):
+    """Return {domain: count} aggregated from the stored rollups."""
+    aggregator = main.aggregate_from_rollups(storage, now=now)
+    return {aggregator.pool[domain]: stats.count for domain, stats in aggregator.domains.items()}
+
+
+def test_rollup_refresh_after_failed_watermark_write_does_not_double_count():
+    now = datetime(2026, 10, 17, 12, 0, tzinfo=pytz.UTC)
+    events = [make_event(now - timedelta(hours=2, seconds=i), "blocked.example.com") for i in range(10)]
+    storage = MemoryCustomStorage()
+    firewall = EventFirewallManagement(events)
+    logger = logging.getLogger(__name__)
+
+    storage.failing_keys.add(main.ROLLUP_WATERMARK_KEY)
+    with pytest.raises(ValueError):
+        main.refresh_rollups(storage, firewall, logger, now=now)
+    assert rollup_counts(storage, now) == {"blocked.example.com": 10}
+
+    storage.failing_keys.clear()
+    summary = main.refresh_rollups(storage, firewall, logger, now=now)
+    assert summary["new_events"] == 0
+    assert summary["already_merged_events"] == 10
+    assert rollup_counts(storage, now) == {"blocked.example.com": 10}
+
+    later = now + timedelta(hours=1)
+    firewall.events["late"] = make_event(now + timedelta(minutes=30), "blocked.example.com")
+    summary = main.refresh_rollups(storage, firewall, logger, now=later)
+    assert summary["new_events"] == 1
+    assert rollup_counts(storage, later) == {"blocked.example.com": 11}
+
+
+def test_rollup_days_keep_top_domains_and_capped_address_lists(monkeypatch):
+    monkeypatch.setattr(main, "ROLLUP_DAY_MAX_DOMAINS", 2)
+    monkeypatch.setattr(main, "ROLLUP_MAX_ADDRESSES", 1)
+    now = datetime(2026, 10, 17, 12, 0, tzinfo=pytz.UTC)
+    when = now - timedelta(hours=1)
+    events = (
+        [make_event(when, "a.example.com", address=f"10.0.0.{i}") for i in range(5)]
+        + [make_event(when, "b.example.com")] * 3
+        + [make_event(when, "c.example.com")]
+    )
+    storage = MemoryCustomStorage()
+
+    summary = main.refresh_rollups(storage, EventFirewallManagement(events), logging.getLogger(__name__), now=now)
+
+    record = storage.objects[(main.ROLLUP_COLLECTION, f"day-{when.date().isoformat()}")]
+    assert summary["domains_trimmed"] == 1
+    assert set(record["domains"]) == {"a.example.com", "b.example.com"}
+    assert record["dropped_blocks"] == 1
+    assert len(record["domains"]["a.example.com"]["ips"]) == 1
+    aggregator = main.aggregate_from_rollups(storage, now=now)
+    a_stats = aggregator.domains[aggregator.pool.intern("a.example.com")]
+    assert a_stats.unique_ips == 5
+
+
+def synthetic_events(count, domains, seed=7):
+    """Return `count` events over `domains` domains with a long-tailed (Zipf-like) distribution."""
+    rng = random.Random(seed)
+    weights = [1.0 / rank for rank in range(1, domains + 1)]
+    start = datetime(2026, 10, 1, tzinfo=pytz.UTC)
+    names = rng.choices([f"d{rank}.example.com" for rank in range(1, domains + 1)], weights, k=count)
+    return [
+        make_event(start + timedelta(seconds=index * 7), name,
+                   address=f"10.{rng.randrange(4)}.{rng.randrange(256)}.{rng.randrange(256)}",
+                   host=f"host{rng.randrange(500)}")
+        for index, name in enumerate(names)
+    ]
+
+
+def test_approximate_top_domains_match_the_exact_path():
+    events = synthetic_events(50000, 5000)
+    exact = main.DomainAnalyticsAggregator()
+    approximate = main.ApproximateDomainAggregator(capacity=200)
+    for offset in range(0, len(events), 1000):
+        exact.add_events(events[offset:offset + 1000])
+        approximate.add_events(events[offset:offset + 1000])
+
+    exact_analysis, _ = exact.result(top_n=10)
+    approximate_analysis, visualization = approximate.result(top_n=10)
+    bound = visualization["approximation"]["count_error_bound"]
+
+    assert bound == len(events) // 200
+    assert list(approximate_analysis) == list(exact_analysis)
+    for domain, stats in exact_analysis.items():
+        estimate = approximate_analysis[domain]
+        assert stats["visit_count"] <= estimate["visit_count"] <= stats["visit_count"] + bound
+        assert estimate["max_count_error"] <= bound
+        assert abs(estimate["unique_ips"] - stats["unique_ips"]) <= 0.15 * stats["unique_ips"]
+
+
+def test_approximate_memory_is_bounded_by_capacity():
+    approximate = main.ApproximateDomainAggregator(capacity=50)
+    approximate.add_events(synthetic_events(20000, 10000))
+
+    assert len(approximate.domains) <= 50
+    assert len(approximate._heap) <= 50  # pylint: disable=protected-access
+    assert not hasattr(approximate, "pool")
+
+
+@pytest.mark.parametrize("raw, expected", [
+    ("straße.de", "xn--strae-oqa.de"),
+    ("BÜCHER.de", "xn--bcher-kva.de"),
+    ("*.faß.de", "*.xn--fa-hia.de"),
+    ("my_host.bücher.de", "my_host.xn--bcher-kva.de"),
+    ("https://Example.COM/path", "example.com"),
+])
+def test_normalize_domain_uses_idna_2008(raw, expected):
+    assert main.normalize_domain(raw) == expected
+
+
+class RuleGroupFirewallManagement:
+    """FirewallManagement stand-in holding rule groups, rejecting updates whose tracking value is stale."""
+
+    def __init__(self, domains):
+        self.groups = {"group1": {"id": "group1", "rule_ids": ["rule1"], "tracking": "t1"}}
+        self.rules = {"rule1": dict(main.build_fqdn_rule("Games_rule", "", domains, "rule1"), id="rule1", version=1)}
+        self.updates = []
+
+    def get_rule_groups(self, ids):
+        return {"status_code": 200, "body": {"resources": [dict(self.groups[i]) for i in ids if i in self.groups]}}
+
+    def get_rules(self, ids):
+        return {"status_code": 200, "body": {"resources": [dict(self.rules[i]) for i in ids if i in self.rules]}}
+
+    def update_rule_group(self, id, tracking, diff_operations, **_):  # pylint: disable=redefined-builtin
+        self.updates.append(diff_operations)
+        group = self.groups[id]
+        if tracking != group["tracking"]:
+            return {"status_code": 409, "body": {"errors": [{"message": "tracking mismatch"}]}}
+        group["tracking"] = f"t{len(self.updates) + 1}"
+        return {"status_code": 200, "body": {"resources": [dict(group)]}}
+
+
+@pytest.mark.parametrize("mode", ["diff", "append"])
+def test_update_rules_patches_a_shared_rule_group_once(monkeypatch, mode):
+    firewall = RuleGroupFirewallManagement(["steam.com"])
+    monkeypatch.setattr(main, "falcon_service", lambda _: firewall)
+    main.invalidate_rule_group_state("group1")
+    relationships = [
+        {"rule_group_id": "group1", "rule_group_name": f"Policy {index} group"} for index in range(3)
+    ]
+
+    request = Request()
+    request.body = {"category_name": "Games", "new_urls": "epicgames.com", "relationships": relationships,
+                    "mode": mode}
+    response = handler("/update-rules", "POST")(request, None, logging.getLogger(__name__))
+
+    assert response.code == 200
+    assert len(firewall.updates) == 1
+    assert len(firewall.updates[0]) == 1
+    results = response.body["results"]
+    assert [result["rule_group_name"] for result in results] == [r["rule_group_name"] for r in relationships]
+    assert all(result["rule_group_id"] == "group1" and result["status"] == "success" for result in results)
+    assert all(result["details"]["added_urls"] == "epicgames.com" for result in results)
+    main.invalidate_rule_group_state("group1")
+
+
+def test_manage_category_write_is_visible_to_batch_reads(monkeypatch):
+    storage = MemoryCustomStorage()
+    storage.objects[("domain", "Social Media")] = {"category": "Social Media", "domain": "facebook.com;*facebook.com"}
+    monkeypatch.setattr(main, "falcon_service", lambda _: storage)
+    batch_categories = handler("/batch-categories", "POST")
+    logger = logging.getLogger(__name__)
+
+    request = Request()
+    request.body = {"keys": ["Social Media"]}
+    assert batch_categories(request, None, logger).body["records"]["Social Media"]["domain"] == "facebook.com;*facebook.com"
+
+    write = Request()
+    write.body = {"categoryName": "Social Media", "key": "Social Media", "urls": "facebook.com,*facebook.com,x.com"}
+    assert handler("/manage-category", "POST")(write, None, logger).body["success"]
+
+    assert set(storage.objects) == {("domain", "Social Media")}
+    record = batch_categories(request, None, logger).body["records"]["Social Media"]
+    assert record["domain"] == "facebook.com;*facebook.com;x.com;*x.com"
+
+
+def request_with_token(token):
+    """Return a Foundry request carrying an access token."""
+    request = Request()
+    request.access_token = token
+    return request
+
+
+def test_falcon_clients_follow_the_request_token_and_never_log_in(monkeypatch):
+    def fail_login(_):
+        raise AssertionError("context-authenticated clients must not log in")
+
+    monkeypatch.setattr(main.APIHarnessV2, "login", fail_login)
+    monkeypatch.setattr(main, "_FALCON_CLIENTS", main.OrderedDict())
+
+    def service_for(token, stale=False):
+        main.ctx_request.set(request_with_token(token))
+        if stale:
+            monkeypatch.setattr(main.APIHarnessV2, "token_stale", property(lambda _: True))
+        return main.falcon_service(main.CustomStorage)
+
+    first = contextvars.copy_context().run(service_for, "tokenA")
+    second = contextvars.copy_context().run(service_for, "tokenB", True)
+    again = contextvars.copy_context().run(service_for, "tokenA", True)
+
+    assert first.auth_object.token_value == "tokenA"
+    assert second.auth_object.token_value == "tokenB"
+    assert again is first
+    assert first.auth_object.session is second.auth_object.session
+    assert first.auth_object.session.get_adapter("https://api.crowdstrike.com")._pool_maxsize >= max(  # pylint: disable=protected-access
+        main.IMPORT_MAX_WORKERS_LIMIT, main.RULE_UPDATE_MAX_WORKERS_LIMIT
+    )
+
+
+def deployed_rule(rule_id, domains, version=1, **overrides):
+    """Return a deployed FQDN rule as get_rules returns it."""
+    return dict(main.build_fqdn_rule(f"{rule_id}_name", "", domains, rule_id), id=rule_id, version=version, **overrides)
+
+
+def plan(rules, new_domains):
+    """Plan a patch for a group holding `rules`, in order."""
+    return main.plan_rule_group_patch([rule["id"] for rule in rules], {rule["id"]: rule for rule in rules},
+                                      new_domains, "Games")
+
+
+def test_plan_rule_group_patch_extends_the_smallest_domain_rule(monkeypatch):
+    monkeypatch.setattr(main, "RULE_MERGE_THRESHOLD", 0)
+    rules = [deployed_rule("r1", ["a.com", "c.com", "d.com"], version=4), deployed_rule("r2", ["b.com"], version=2)]
+
+    patch = plan(rules, ["x.com"])
+
+    assert patch["diff_operations"] == [{"op": "replace", "path": "/rules/1/fqdn", "value": "b.com;x.com"}]
+    assert patch["rule_ids"] == ["r1", "r2"]
+    assert patch["rule_versions"] == [4, 2]
+    assert patch["summary"]["action"] == "extended"
+    assert patch["rules_added"] == 0
+
+
+def test_plan_rule_group_patch_skips_domains_already_blocked():
+    rules = [deployed_rule("r1", ["*example.com", "steam.com"])]
+
+    assert plan(rules, ["www.example.com", "steam.com"]) is None
+    patch = plan(rules, ["www.example.com", "example.com"])
+    assert patch["summary"]["added_domains"] == ["example.com"]
+    assert patch["summary"]["already_deployed"] == 1
+
+
+@pytest.mark.parametrize("scope", [
+    {"fields": [{"name": "image_name", "value": "chrome.exe", "type": "windows_path", "values": []}]},
+    {"local_address": [{"address": "10.0.0.0", "netmask": 8}]},
+    {"remote_address": [{"address": "192.168.0.0", "netmask": 16}]},
+    {"protocol": "6"},
+    {"address_family": "IP4"},
+    {"direction": "IN"},
+])
+def test_plan_rule_group_patch_never_counts_or_edits_scoped_rules(scope):
+    rules = [deployed_rule("r1", ["youtube.com"], **scope)]
+
+    patch = plan(rules, ["youtube.com"])
+
+    assert patch is not None
+    assert patch["summary"]["action"] == "added"
+    assert patch["rule_ids"][0] == "r1" and len(patch["rule_ids"]) == 2
+    assert [op["op"] for op in patch["diff_operations"]] == ["add"]
+    assert patch["diff_operations"][0]["path"] == "/rules/1"
+    assert patch["diff_operations"][0]["value"]["fqdn"] == "youtube.com"
+
+
+def test_plan_rule_group_patch_keeps_logged_rules_but_does_not_edit_them():
+    rules = [deployed_rule("r1", ["steam.com"], log=True)]
+
+    assert plan(rules, ["steam.com"]) is None
+    patch = plan(rules, ["x.com"])
+    assert [op["op"] for op in patch["diff_operations"]] == ["add"]
+
+
+def test_plan_rule_group_patch_merges_small_rules_and_removes_from_the_end():
+    scoped = {"fields": [{"name": "image_name", "value": "chrome.exe", "type": "windows_path", "values": []}]}
+    rules = [
+        deployed_rule("r0", ["a.com"], **scoped),
+        deployed_rule("r1", ["b.com"], version=3),
+        deployed_rule("r2", ["c.com"]),
+        deployed_rule("r3", ["d.com"]),
+    ]
+
+    patch = plan(rules, ["e.com"])
+
+    assert patch["diff_operations"] == [
+        {"op": "replace", "path": "/rules/1/fqdn", "value": "b.com;c.com;d.com;e.com"},
+        {"op": "remove", "path": "/rules/3"},
+        {"op": "remove", "path": "/rules/2"},
+    ]
+    assert patch["rule_ids"] == ["r0", "r1"]
+    assert patch["rule_versions"] == [1, 3]
+    assert patch["replaced"] == {"r1": "b.com;c.com;d.com;e.com"}
+    assert patch["summary"]["rules_merged"] == 2
+    assert patch["summary"]["rule_count"] == 2
+
+
+def test_plan_rule_group_patch_adds_sharded_rules_after_the_kept_ones(monkeypatch):
+    monkeypatch.setattr(main, "RULE_MERGE_THRESHOLD", 0)
+    rules = [deployed_rule("r1", ["a.com", "b.com"])]
+    new_domains = [f"site{index}.com" for index in range(5)]
+
+    patch = main.plan_rule_group_patch(["r1"], {"r1": rules[0]}, new_domains, "Games", max_domains=2)
+
+    assert [op["path"] for op in patch["diff_operations"]] == ["/rules/1", "/rules/2", "/rules/3"]
+    added = [domain for op in patch["diff_operations"] for domain in op["value"]["fqdn"].split(';')]
+    assert sorted(added) == sorted(new_domains)
+    assert patch["rule_ids"][0] == "r1" and len(patch["rule_ids"]) == 4
+    assert patch["rule_versions"] == [1, 1, 1, 1]
+
+
+def test_plan_append_patch_sends_the_deployed_rule_versions():
+    rules = [deployed_rule("r1", ["a.com"], version=7), deployed_rule("r2", ["b.com"], version=2)]
+
+    patch = main.plan_append_patch(["r1", "r2"], {rule["id"]: rule for rule in rules}, ["x.com"], "Games")
+
+    assert patch["rule_versions"] == [7, 2, 1]
+    assert patch["rule_ids"][:2] == ["r1", "r2"]
+    assert patch["diff_operations"][0]["path"] == "/rules/2"
+
+
+def test_process_csv_records_logs_invalid_rows(tmp_path, caplog):
+    csv_file = tmp_path / "categories.csv"
+    csv_file.write_text("category,urls\nGames,steam.com\nBroken,not a domain\n", encoding="utf-8")
+
+    with caplog.at_level(logging.WARNING):
+        results = main.process_csv_records(str(csv_file), LatencyCustomStorage(latency=0), logging.getLogger(__name__))
+
+    assert results["success_count"] == 1
+    assert [failure["row"] for failure in results["failures"]] == [2]
+    assert "Error processing row 2" in caplog.text
+
+
+def test_run_step_plan_undoes_completed_steps_in_reverse_and_skips_the_rest():
+    calls = []
+
+    def step(name, requires=(), fail=False):
+        def run(_):
+            calls.append(("run", name))
+            if fail:
+                raise ValueError(f"{name} failed")
+            return name
+        return {"requires": list(requires), "run": run, "undo": lambda _: calls.append(("undo", name))}
+
+    steps = {
+        "policy": step("policy"),
+        "enable": step("enable", ["policy"]),
+        "assign": step("assign", ["enable"], fail=True),
+        "container": step("container", ["assign"]),
+    }
+
+    results, timings, failure, rollback = main.run_step_plan(steps, logging.getLogger(__name__), max_workers=1)
+
+    assert failure[0] == "assign"
+    assert calls == [("run", "policy"), ("run", "enable"), ("run", "assign"), ("undo", "enable"), ("undo", "policy")]
+    assert rollback == [{"step": "enable", "status": "undone"}, {"step": "policy", "status": "undone"}]
+    assert timings["container"] == {"status": "skipped"}
+    assert timings["assign"]["status"] == "failed"
+    assert set(results) == {"policy", "enable"}
+
+
+def test_run_step_plan_waits_for_running_steps_and_reports_failed_undos():
+    running = threading.Event()
+    calls = []
+
+    def slow(_):
+        running.set()
+        time.sleep(0.05)
+        return "slow"
+
+    def failing(_):
+        running.wait(1)
+        raise ValueError("boom")
+
+    def broken_undo(_):
+        raise ValueError("cannot undo")
+
+    steps = {
+        "slow": {"run": slow, "undo": broken_undo},
+        "failing": {"run": failing},
+        "after_slow": {"requires": ["slow"], "run": lambda _: calls.append("after_slow")},
+    }
+
+    results, timings, failure, rollback = main.run_step_plan(steps, logging.getLogger(__name__))
+
+    assert failure[0] == "failing"
+    assert results == {"slow": "slow"}
+    assert not calls
+    assert timings["after_slow"] == {"status": "skipped"}
+    assert rollback == [{"step": "slow", "status": "failed", "error": "cannot undo"}]
+
+
+class RecordingFirewall:
+    """FirewallPolicies and FirewallManagement stand-in recording every call, with injectable failures."""
+
+    def __init__(self, fail=None, before=None):
+        self.calls = []
+        self.fail = fail or (lambda name, kwargs: False)
+        self.before = before or {}
+        self._lock = threading.Lock()
+        self._ids = Counter()
+
+    def _call(self, name, kwargs, resource=None):
+        if name in self.before:
+            self.before[name](kwargs)
+        with self._lock:
+            self.calls.append((name, kwargs))
+            if self.fail(name, kwargs):
+                return {"status_code": 500, "body": {"errors": [{"message": f"{name} failed"}]}}
+            if resource is None:
+                return {"status_code": 200, "body": {"resources": []}}
+            self._ids[resource] += 1
+            return {"status_code": 201, "body": {"resources": [f"{resource}{self._ids[resource]}"]}}
+
+    def create_policies(self, **kwargs):
+        response = self._call("create_policies", kwargs, "policy")
+        if response["status_code"] == 201:
+            response["body"]["resources"] = [{"id": response["body"]["resources"][0]}]
+        return response
+
+    def create_rule_group(self, **kwargs):
+        return self._call("create_rule_group", kwargs, "group")
+
+    def perform_action(self, **kwargs):
+        return self._call(kwargs["action_name"], kwargs)
+
+    def update_policy_container(self, **kwargs):
+        return self._call("update_policy_container", kwargs)
+
+    def delete_policies(self, **kwargs):
+        return self._call("delete_policies", kwargs)
+
+    def delete_rule_groups(self, **kwargs):
+        return self._call("delete_rule_groups", kwargs)
+
+    def names(self):
+        return [name for name, _ in self.calls]
+
+
+def test_create_rule_rolls_back_when_assigning_the_host_group_fails(monkeypatch):
+    failed = threading.Event()
+
+    def fail(name, _):
+        if name == "add-host-group":
+            failed.set()
+            return True
+        return False
+
+    # The rule group is only created once the host group assignment failed, so the container step never starts
+    firewall = RecordingFirewall(fail=fail, before={"create_rule_group": lambda _: failed.wait(1)})
+    monkeypatch.setattr(main, "falcon_service", lambda _: firewall)
+    request = Request()
+    request.body = {"hostGroupId": "hg1", "urls": "steam.com", "policyName": "Games"}
+
+    response = handler("/create-rule", "POST")(request, None, logging.getLogger(__name__))
+
+    assert response.code == 500
+    assert response.body["failedStep"] == "add_host_group"
+    names = firewall.names()
+    assert "update_policy_container" not in names
+    assert "remove-host-group" not in names
+    undone = [entry["step"] for entry in response.body["rolledBack"]]
+    assert set(undone) == {"create_policy", "enable_policy", "create_rule_group"}
+    assert undone.index("enable_policy") < undone.index("create_policy")
+    assert names.index("disable") < names.index("delete_policies")
+    assert response.body["steps"]["update_policy_container"] == {"status": "skipped"}
+
+
+def bulk_deploy_request(storage, firewall, monkeypatch):
+    """Return a /bulk-deploy request for two category sets over three host groups, with fakes installed."""
+    storage.objects[("domain", "Games")] = {"category": "Games", "domain": "steam.com"}
+    storage.objects[("domain", "News")] = {"category": "News", "domain": "cnn.com"}
+    services = {main.FirewallManagement: firewall, main.FirewallPolicies: firewall, main.CustomStorage: storage}
+    monkeypatch.setattr(main, "falcon_service", lambda cls: services[cls])
+    request = Request()
+    request.body = {
+        "policyName": "Block",
+        "categories": ["Games"],
+        "hostGroupIds": ["hg1", "hg2"],
+        "assignments": [{"categories": ["News"], "hostGroupIds": ["hg2", "hg3"]}],
+        "hostGroupNames": {"hg1": "One", "hg2": "Two", "hg3": "Three"}
+    }
+    return request
+
+
+def test_bulk_deploy_orders_steps_and_counts_api_calls(monkeypatch):
+    storage, firewall = MemoryCustomStorage(), RecordingFirewall()
+    request = bulk_deploy_request(storage, firewall, monkeypatch)
+
+    response = handler("/bulk-deploy", "POST")(request, None, logging.getLogger(__name__))
+
+    assert response.code == 200
+    deployments = {tuple(d["categories"]): d for d in response.body["deployments"]}
+    assert deployments[("Games",)]["hostGroupIds"] == ["hg1"]
+    assert deployments[("Games", "News")]["hostGroupIds"] == ["hg2"]
+    assert deployments[("News",)]["hostGroupIds"] == ["hg3"]
+    assert response.body["apiCalls"] == len(firewall.calls)
+    assert response.body["relationships"]["written"] == 4
+
+    names = firewall.names()
+    positions = {}
+    for position, (name, kwargs) in enumerate(firewall.calls):
+        positions.setdefault((name, kwargs.get("name") or kwargs.get("policy_id") or kwargs.get("group_id")), position)
+    for deployment in response.body["deployments"]:
+        created = positions[("create_policies", deployment["policyName"])]
+        grouped = positions[("create_rule_group", deployment["ruleGroupName"])]
+        attached = positions[("update_policy_container", deployment["policyId"])]
+        assert max(created, grouped) < attached
+        for host_group_id in deployment["hostGroupIds"]:
+            assert created < positions[("add-host-group", host_group_id)]
+    assert names.count("enable") == 1
+    assert names.index("enable") > max(i for i, name in enumerate(names) if name == "create_policies")
+
+
+def test_bulk_deploy_rolls_back_every_deployment_when_a_container_update_fails(monkeypatch):
+    storage = MemoryCustomStorage()
+    firewall = RecordingFirewall(
+        fail=lambda name, kwargs: name == "update_policy_container" and kwargs["policy_id"] == "policy2"
+    )
+    request = bulk_deploy_request(storage, firewall, monkeypatch)
+
+    response = handler("/bulk-deploy", "POST")(request, None, logging.getLogger(__name__))
+
+    assert response.code == 500
+    assert response.body["failedStep"].startswith("container_")
+    created_policies = {f"policy{index}" for index in range(1, firewall.names().count("create_policies") + 1)}
+    created_groups = {f"group{index}" for index in range(1, firewall.names().count("create_rule_group") + 1)}
+    deleted_policies = {i for name, kwargs in firewall.calls if name == "delete_policies" for i in kwargs["ids"]}
+    deleted_groups = {i for name, kwargs in firewall.calls if name == "delete_rule_groups" for i in kwargs["ids"]}
+    assert deleted_policies == created_policies
+    assert deleted_groups == created_groups
+    names = firewall.names()
+    assert names.count("remove-host-group") == names.count("add-host-group")
+    assert names.count("disable") == names.count("enable")
+    deleted_at = {kwargs["ids"][0]: i for i, (name, kwargs) in enumerate(firewall.calls) if name == "delete_policies"}
+    for position, (name, kwargs) in enumerate(firewall.calls):
+        if name in ("remove-host-group", "disable"):
+            ids = kwargs["ids"] if isinstance(kwargs["ids"], list) else [kwargs["ids"]]
+            assert all(position < deleted_at[policy_id] for policy_id in ids)
+    assert not [key for key in storage.objects if key[0] == "relationship"]
+
+
+@pytest.fixture(name="matcher")
+def matcher_fixture():
+    return main.DomainMatcher({
+        "Games": "steam.com;*store.steam.com",
+        "Social": "*facebook.com",
+        "News": "*.cnn.com",
+        "Ads": "ads.example.com",
+        "Broad": "*example.com",
+    })
+
+
+@pytest.mark.parametrize("domain, categories", [
+    ("steam.com", ["Games"]),  # exact entry
+    ("www.steam.com", []),  # an exact entry does not cover subdomains
+    ("store.steam.com", ["Games"]),  # a wildcard covers its own name...
+    ("eu.store.steam.com", ["Games"]),  # ...and every subdomain
+    ("edition.cnn.com", ["News"]),  # '*.' wildcards behave the same
+    ("cnn.com", ["News"]),
+    ("myfacebook.com", []),  # labels match whole, not as string suffixes
+    ("facebook.com.evil.net", []),
+    ("https://M.Facebook.com/path", ["Social"]),  # URLs are normalized first
+    ("ads.example.com", ["Ads", "Broad"]),  # the exact match ranks before the parent wildcard
+    ("x.ads.example.com", ["Broad"]),  # only the parent-label wildcard covers deeper names
+])
+def test_domain_matcher_matches_whole_labels(matcher, domain, categories):
+    assert matcher.classify(domain)["categories"] == categories
+
+
+def test_domain_matcher_lists_the_most_specific_pattern_first():
+    matcher = main.DomainMatcher({"A": "*example.com", "B": "*a.example.com", "C": "x.a.example.com;*example.com"})
+
+    assert matcher.match("x.a.example.com") == [
+        ("C", "x.a.example.com"), ("B", "*a.example.com"), ("A", "*example.com"), ("C", "*example.com")
+    ]
+    assert matcher.category_count == 3
+    assert matcher.pattern_count == 4
+
+
+@pytest.mark.parametrize("max_domains, max_length", [
+    (main.RULE_MAX_DOMAINS, main.RULE_MAX_FQDN_LENGTH),
+    (7, 10000),
+    (1000, 120),
+    (3, 40),
+])
+def test_shard_domains_respects_both_limits_and_keeps_every_domain(max_domains, max_length):
+    rng = random.Random(3)
+    domains = [
+        f"{'sub' * rng.randrange(1, 6)}{index}.{rng.choice(['example.com', 'example.org', 'test.net'])}"
+        for index in range(3000)
+    ]
+    domains += domains[:50] + [f"*{domain}" for domain in domains[:20]]  # duplicates and wildcards
+
+    shards = main.shard_domains(domains, max_domains=max_domains, max_length=max_length)
+
+    flattened = [domain for shard in shards for domain in shard]
+    assert sorted(flattened) == sorted(set(domains))
+    assert all(len(shard) <= max_domains for shard in shards)
+    assert all(len(';'.join(shard)) <= max_length for shard in shards)
+    assert main.shard_domains(list(reversed(domains)), max_domains=max_domains, max_length=max_length) == shards
+
+
+def test_shard_domains_gives_an_oversized_domain_its_own_shard():
+    long_domain = f"{'a' * 60}.example.com"
+
+    shards = main.shard_domains(["a.com", long_domain, "b.com"], max_domains=10, max_length=20)
+
+    assert [long_domain] in shards
+    assert sorted(domain for shard in shards for domain in shard) == sorted(["a.com", long_domain, "b.com"])
+    assert all(len(';'.join(shard)) <= 20 for shard in shards if shard != [long_domain])
+
+
+def test_category_search_index_follows_adds_updates_and_removals():
+    index = main.CategorySearchIndex({"Games": "steam.com;*steam.com;epicgames.com", "Stores": "steampowered.com"})
+
+    assert index.search("steam.com") == ([("steam.com", ["Games"])], False)
+    assert [domain for domain, _ in index.search("steam", "prefix")[0]] == ["steam.com", "steampowered.com"]
+
+    index.update("Games", "epicgames.com;store.steam.com")
+    index.update("Shops", "*steam.com")
+    assert index.search("steam.com") == ([("steam.com", ["Shops"])], False)
+    assert index.search("store.steam.com") == ([("store.steam.com", ["Games"])], False)
+    assert [domain for domain, _ in index.search(".com", "suffix")[0]] == [
+        "epicgames.com", "steam.com", "store.steam.com", "steampowered.com"
+    ]
+
+    index.remove("Shops")
+    index.remove("Stores")
+    assert index.search("steam.com") == ([], False)
+    assert [domain for domain, _ in index.search("team", "contains")[0]] == ["store.steam.com"]
+    assert index.search("com", "contains", limit=1)[1] is True
+    assert index.stats()["categories"] == 1
+    assert index.stats()["domains"] == 2
+    assert all(postings for postings in index.grams.values())
+
+
+class GatedCustomStorage(MemoryCustomStorage):
+    """MemoryCustomStorage whose listing blocks until released, to hold a search index reload open."""
+
+    def __init__(self):
+        super().__init__()
+        self.gate = None
+        self.entered = threading.Event()
+
+    def ListObjectsByVersion(self, collection_name, limit, start=None, **_):  # pylint: disable=invalid-name
+        if self.gate is not None:
+            self.entered.set()
+            self.gate.wait(2)
+        return super().ListObjectsByVersion(collection_name, limit, start)
+
+
+def test_search_index_reload_does_not_block_searches_or_writes(monkeypatch):
+    storage = GatedCustomStorage()
+    storage.objects[("domain", "Games")] = {"category": "Games", "domain": "steam.com"}
+    monkeypatch.setattr(main, "falcon_service", lambda _: storage)
+    monkeypatch.setattr(main, "_SEARCH_INDEX", {"index": None, "version": None, "loaded_at": 0.0, "pending": None})
+    first = main.get_search_index()
+    assert first["index"].search("steam.com")[0] == [("steam.com", ["Games"])]
+
+    storage.gate = threading.Event()
+    main.mark_category_data_changed()  # a write made elsewhere: the next read reloads
+    reload = threading.Thread(target=main.get_search_index)
+    reload.start()
+    assert storage.entered.wait(2)
+
+    writer = threading.Thread(target=main.apply_category_writes, args=({"News": "cnn.com"},))
+    writer.start()
+    writer.join(1)
+    assert not writer.is_alive()
+    during = main.get_search_index()
+    assert during["index"] is first["index"]
+    assert during["index"].search("cnn.com")[0] == [("cnn.com", ["News"])]
+
+    storage.gate.set()
+    reload.join(2)
+    after = main.get_search_index()
+    assert after["index"] is not first["index"]
+    assert after["index"].search("cnn.com")[0] == [("cnn.com", ["News"])]
+    assert after["index"].search("steam.com")[0] == [("steam.com", ["Games"])]
+    assert main.get_search_index()["index"] is after["index"]
+
+
+def test_plan_incremental_import_splits_added_changed_unchanged_and_pruned():
+    records = [(row, {"category": name, "content_hash": name}) for row, name in enumerate(["A", "B", "C"], start=1)]
+
+    delta = main.plan_incremental_import(records, {"A", "B", "Old", "Manual"}, {"A"}, imported_keys=["Old", "A"])
+
+    assert [record["category"] for _, record in delta["to_write"]] == ["B", "C"]
+    assert (delta["added"], delta["changed"], delta["unchanged"]) == (1, 1, 1)
+    assert delta["to_delete"] == ["Old"]
+    assert main.plan_incremental_import(records, {"A"}, {"A"})["to_delete"] == []
+
+
+def write_csv(path, rows):
+    """Write a categories CSV with a header row."""
+    path.write_text("category,urls\n" + "".join(f"{name},{urls}\n" for name, urls in rows), encoding="utf-8")
+
+
+def test_incremental_import_only_reads_pruned_candidates(tmp_path):
+    storage = MemoryCustomStorage()
+    logger = logging.getLogger(__name__)
+    csv_file = tmp_path / "categories.csv"
+    rows = [(f"Category{index}", f"site{index}.com") for index in range(120)]
+    write_csv(csv_file, rows)
+    main.process_csv_records(str(csv_file), storage, logger)
+    storage.objects[("domain", "Manual")] = {"category": "Manual", "domain": "manual.com"}
+
+    rows[3] = ("Category3", "changed.com")
+    write_csv(csv_file, rows[:-1] + [("Brand new", "new.com")])
+    results = main.process_csv_records(str(csv_file), storage, logger, incremental=True, prune=True)
+
+    assert results["delta"]["added"] == 1
+    assert results["delta"]["changed"] == 1
+    assert results["delta"]["unchanged"] == 118
+    assert results["deleted"] == ["Category119"]
+    assert set(results["written"]) == {"Category3", "Brand new"}
+    assert set(storage.reads) == {"Category119", "Manual"}
+    assert ("domain", "Manual") in storage.objects
+    assert storage.objects[("domain", "Category3")]["domain"] == "changed.com"
+
+
+@pytest.mark.parametrize("prune, expected", [
+    (True, True), ("true", True), (False, False), ("false", False), (None, False)
+])
+def test_import_csv_only_prunes_on_an_explicit_true(monkeypatch, prune, expected):
+    seen = {}
+
+    def fake_process(**kwargs):
+        seen.update(kwargs)
+        return {"total_rows": 0, "success_count": 0, "error_count": 0, "failures": [],
+                "throughput": {}, "written": {}}
+
+    monkeypatch.setattr(main, "falcon_service", lambda _: MemoryCustomStorage())
+    monkeypatch.setattr(main, "process_csv_records", fake_process)
+    request = Request()
+    request.body = {"mode": "incremental", "prune": prune}
+
+    assert handler("/import-csv", "POST")(request, None, logging.getLogger(__name__)).code == 200
+    assert seen["prune"] is expected
+
+
+@pytest.mark.parametrize("prune", ["yes", "False", 1, 0, [True]])
+def test_import_csv_rejects_ambiguous_prune_values(monkeypatch, prune):
+    monkeypatch.setattr(main, "falcon_service", lambda _: MemoryCustomStorage())
+    request = Request()
+    request.body = {"mode": "incremental", "prune": prune}
+
+    assert handler("/import-csv", "POST")(request, None, logging.getLogger(__name__)).code == 400
+
+
+class PagedHostGroup:
+    """HostGroup stand-in serving `count` groups through offset paging, recording every call."""
+
+    def __init__(self, count):
+        self.ids = [f"hg{index}" for index in range(count)]
+        self.queries = []
+        self.detail_calls = []
+        self._lock = threading.Lock()
+
+    def query_host_groups(self, limit, offset):
+        with self._lock:
+            self.queries.append((limit, offset))
+        page = self.ids[offset:offset + limit]
+        return {"status_code": 200, "body": {"resources": page, "meta": {"pagination": {"total": len(self.ids)}}}}
+
+    def get_host_groups(self, ids):
+        with self._lock:
+            self.detail_calls.append(list(ids))
+        return {"status_code": 200, "body": {"resources": [{"id": i, "name": f"Group {i}"} for i in ids]}}
+
+
+def test_list_host_groups_pages_and_chunks_every_id_in_order():
+    hostgroup = PagedHostGroup(1234)
+
+    groups = main.list_host_groups(hostgroup, page_size=500, chunk_size=100, max_workers=4)
+
+    assert [group["id"] for group in groups] == hostgroup.ids
+    assert hostgroup.queries == [(500, 0), (500, 500), (500, 1000)]
+    assert max(len(ids) for ids in hostgroup.detail_calls) == 100
+    assert sorted(i for ids in hostgroup.detail_calls for i in ids) == sorted(hostgroup.ids)
+
+
+def test_list_host_groups_raises_with_the_failing_status():
+    hostgroup = PagedHostGroup(10)
+    hostgroup.get_host_groups = lambda ids: {"status_code": 403, "body": {}}
+
+    with pytest.raises(ValueError) as error:
+        main.list_host_groups(hostgroup)
+    assert error.value.args[1] == 403
+
+
+def test_host_groups_are_served_from_the_cache_until_a_refresh_is_asked_for(monkeypatch):
+    hostgroup = PagedHostGroup(3)
+    monkeypatch.setattr(main, "falcon_service", lambda _: hostgroup)
+    monkeypatch.setattr(main, "_HOST_GROUP_CACHE", main.StaleWhileRevalidateCache(ttl=60, grace=0))
+    list_groups = handler("/urlblock", "GET")
+    logger = logging.getLogger(__name__)
+
+    first = list_groups(Request(), None, logger)
+    second = list_groups(Request(), None, logger)
+    refresh = Request()
+    refresh.params.query = {"refresh": ["true"]}
+    third = list_groups(refresh, None, logger)
+
+    assert [response.body["cache"]["status"] for response in (first, second, third)] == ["miss", "hit", "miss"]
+    assert second.body["host_groups"] == first.body["host_groups"]
+    assert len(hostgroup.queries) == 2
+
+
+class GatedCompute:
+    """Counting compute function whose calls can be held open until released."""
+
+    def __init__(self, hold=()):
+        self.calls = 0
+        self.hold = set(hold)  # call numbers that wait for the gate
+        self.gate = threading.Event()
+        self.started = threading.Event()
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            self.calls += 1
+            call = self.calls
+        if call in self.hold:
+            self.started.set()
+            self.gate.wait(2)
+        return f"value{call}"
+
+
+def wait_for(condition, timeout=2.0):
+    """Poll `condition` until it is true or the timeout passes."""
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.005)
+    return condition()
+
+
+def test_stale_entries_are_served_while_exactly_one_refresh_runs():
+    cache = main.StaleWhileRevalidateCache(ttl=0.05, grace=30)
+    compute = GatedCompute(hold={2})
+    assert cache.get("key", compute)[:2] == ("value1", "miss")
+    time.sleep(0.06)
+
+    with main.ThreadPoolExecutor(max_workers=8) as executor:
+        served = list(executor.map(lambda _: cache.get("key", compute)[:2], range(20)))
+
+    assert compute.started.wait(2)
+    assert served == [("value1", "stale")] * 20
+    assert compute.calls == 2
+    compute.gate.set()
+    assert wait_for(lambda: cache.get("key", compute)[:2] == ("value2", "hit"))
+    assert compute.calls == 2
+
+
+def test_concurrent_misses_share_one_computation():
+    cache = main.StaleWhileRevalidateCache(ttl=60, grace=0)
+    compute = GatedCompute(hold={1})
+
+    with main.ThreadPoolExecutor(max_workers=5) as executor:
+        futures = [executor.submit(cache.get, "key", compute) for _ in range(5)]
+        assert compute.started.wait(2)
+        assert wait_for(lambda: sum(1 for f in futures if not f.running() and not f.done()) == 0)
+        compute.gate.set()
+        results = [future.result() for future in futures]
+
+    assert compute.calls == 1
+    assert {value for value, _, _ in results} == {"value1"}
+    assert sorted(status for _, status, _ in results).count("miss") == 1
+
+
+@pytest.mark.parametrize("key", ["key", None])
+def test_invalidating_during_a_refresh_discards_its_result(key):
+    cache = main.StaleWhileRevalidateCache(ttl=60, grace=0)
+    compute = GatedCompute(hold={1})
+
+    with main.ThreadPoolExecutor(max_workers=1) as executor:
+        before = executor.submit(cache.get, "key", compute)
+        assert compute.started.wait(2)
+        cache.invalidate(key)
+
+        # A caller after the invalidation does not share the computation that started before it
+        assert cache.get("key", compute)[:2] == ("value2", "miss")
+        compute.gate.set()
+        assert before.result()[:2] == ("value1", "miss")
+
+    assert cache.get("key", compute)[:2] == ("value2", "hit")
+    assert compute.calls == 2
@@ -15,22 +15,6 @@ const logMessage = (message, data = null, type = 'info') => {
     }
 };
 
-// Helper functions
-const createValidKey = (str) => {
-    // Replace any invalid characters with underscores and ensure it's within length limits
-    return str.replace(/[^a-zA-Z0-9._-]/g, '_').substring(0, 999);
-};
-
-const safeReadCollection = async (collection, key) => {
-    try {
-        const record = await collection.read(key);
-        return record;
-    } catch (error) {
-        logMessage(`Error reading collection for key ${key}:`, error.message);
-        return null;
-    }
-};
-
 function FirewallRules() {
     const { falcon } = useContext(FalconApiContext);
     const [categories, setCategories] = useState([]);
@@ -79,32 +63,26 @@ const [hasImported, setHasImported] = useState(false);
         try {
             setLoading(true);
 
-            // First get relationships for this category
-            const relationshipCollection = falcon.collection({
-                collection: 'relationship'
-            });
-
-            const response = await relationshipCollection.list({
-                limit: 1000
+            // First get relationships for this category with indexed searches
+            const cloudFunction = falcon.cloudFunction({
+                name: 'urlblock',
+                version: 1
             });
 
-            logMessage('List response:', response);
+            const relationships = [];
+            let cursor = '0';
+            while (cursor !== null) {
+                const searchResponse = await cloudFunction
+                    .path(`/search-relationships?category_name=${encodeURIComponent(categoryName)}&limit=500&cursor=${cursor}`)
+                    .get();
 
-            if (!response || !response.resources) {
-                throw new Error('No resources found in response');
-            }
+                logMessage('Search response:', searchResponse);
 
-            // Get all relationships data
-            const relationships = [];
-            for (const key of response.resources) {
-                try {
-                    const record = await relationshipCollection.read(key);
-                    if (record && record.category_name === categoryName) {
-                        relationships.push(record);
-                    }
-                } catch (error) {
-                    logMessage(`Error fetching relationship for key ${key}:`, error.message);
+                if (!searchResponse?.body?.resources) {
+                    throw new Error('No resources found in response');
                 }
+                relationships.push(...searchResponse.body.resources);
+                cursor = searchResponse.body.pagination?.nextCursor ?? null;
             }
 
             if (relationships.length === 0) {
@@ -112,12 +90,6 @@ const [hasImported, setHasImported] = useState(false);
             }
 
             // Call update-rules with only the new domain
-            const config = {
-                name: 'urlblock',
-                version: 1
-            };
-
-            const cloudFunction = falcon.cloudFunction(config);
             const updateResponse = await cloudFunction.path('/update-rules').post({
                 category_name: categoryName,
                 new_urls: newDomain,  // Send only the new URLs
@@ -157,11 +129,11 @@ const [hasImported, setHasImported] = useState(false);
         logMessage(`Fetching details for category: ${category}`);
         try {
             setLoading(true);
-            const collection = falcon.collection({
-                collection: 'domain'
-            });
+            const response = await falcon.cloudFunction({ name: 'urlblock', version: 1 })
+                .path('/batch-categories')
+                .post({ keys: [category] });
 
-            const categoryData = await collection.read(category);
+            const categoryData = response?.body?.records?.[category];
             logMessage('Category data:', categoryData);
 
             if (categoryData) {
@@ -190,16 +162,14 @@ const [hasImported, setHasImported] = useState(false);
     try {
         setLoading(true);
 
-        // First add domain to collection
-        const collection = falcon.collection({
-            collection: 'domain'
+        const cloudFunction = falcon.cloudFunction({
+            name: 'urlblock',
+            version: 1
         });
 
-        // Create a valid key for the collection
-        const safeKey = createValidKey(selectedCategory);
-
         // Get current category data
-        const currentData = await safeReadCollection(collection, safeKey);
+        const readResponse = await cloudFunction.path('/batch-categories').post({ keys: [selectedCategory] });
+        const currentData = readResponse?.body?.records?.[selectedCategory];
         const existingDomains = currentData?.domain || '';
 
         // Add both the original domain and the starred version
@@ -210,12 +180,15 @@ const [hasImported, setHasImported] = useState(false);
             ? `${existingDomains};${domainsToAdd}`
             : domainsToAdd;
 
-        // Update domain in collection
-        await collection.write(safeKey, {
-            ...currentData,
-            domain: updatedDomains,
-            last_updated: new Date().toISOString()
+        // Save through the function so the domains are normalized and its search index and read cache stay current
+        const writeResponse = await cloudFunction.path('/manage-category').post({
+            categoryName: currentData?.category || selectedCategory,
+            key: selectedCategory,
+            urls: updatedDomains.split(';').join(',')
         });
+        if (!writeResponse?.body?.success) {
+            throw new Error(writeResponse?.body?.error || 'Failed to save category');
+        }
 
         // Then update rules with both domains
         await handleUpdateRules(selectedCategory, domainsToAdd);
@@ -233,6 +233,12 @@ function DomainAnalytics() {
     return (
         <div className="container mx-auto p-4">
             <h2 className="text-lg font-semibold text-left mb-4">Domain access analysis</h2>
+            {analyticsData.cache && (
+                <p className="text-sm text-left mb-4" style={{ color: 'var(--sl-color-neutral-600)' }}>
+                    Data as of {Math.round(analyticsData.cache.age_seconds)}s ago
+                    {analyticsData.cache.status === 'stale' ? ' (refreshing in the background)' : ''}
+                </p>
+            )}
             
             <SlCard>
                 <div slot="header">
@@ -120,31 +120,18 @@ function Home() {
         message: 'Loading domains from categories...'
       });
 
-      const collection = falcon.collection({
-        collection: 'domain'
+      // Fetch the records of all selected categories in one call
+      const cloudFunction = falcon.cloudFunction({
+        name: 'urlblock',
+        version: 1
       });
-
-      // Fetch URLs for all selected categories
-      const urlPromises = selectedCategories.map(async (category) => {
-        try {
-          const objectKey = category;
-          console.log(`Fetching domains for category: ${category}, key: ${objectKey}`);
-
-          const record = await collection.read(objectKey);
-          console.log(`Record for ${category}:`, record);
-
-          // Access the domain directly from the record
-          if (record && record.domain) {
-            return record.domain;
-          }
-          return null;
-        } catch (error) {
-          console.warn(`Failed to fetch domains for category ${category}:`, error);
-          return null;
-        }
+      const batchResponse = await cloudFunction.path('/batch-categories').post({
+        keys: selectedCategories
       });
+      const records = batchResponse?.body?.records || {};
+      console.log('Batch category records:', batchResponse?.body?.cache, batchResponse?.body?.missing);
 
-      const urlResults = await Promise.all(urlPromises);
+      const urlResults = selectedCategories.map((category) => records[category]?.domain || null);
       const urls = urlResults.filter(Boolean).join(';');
 
       if (!urls) {